@@ -140,6 +140,19 @@ window.onload = async function () {
             description_node.appendChild(link_node);
             description_node.appendChild(document.createTextNode(" (" + format_size(props.size) + ", last modified " + format_date(props.date) + ")"));
             parent_node.appendChild(description_node);
+
+            // smaller updates for users who already have an older release
+            for (const delta of props.deltas || []) {
+                let delta_node = document.createElement("dd");
+                let delta_link_node = document.createElement("a");
+                delta_link_node.setAttribute("href", delta.url);
+                delta_link_node.setAttribute("download", delta.name);
+                delta_link_node.text = delta.name;
+                delta_node.appendChild(document.createTextNode("Update from " + format_date(delta["from"]) + ": "));
+                delta_node.appendChild(delta_link_node);
+                delta_node.appendChild(document.createTextNode(" (" + format_size(delta.size) + ")"));
+                parent_node.appendChild(delta_node);
+            }
         }
     }
 
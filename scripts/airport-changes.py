@@ -0,0 +1,152 @@
+""" Find the scenery tiles affected by airport changes since the last build
+
+Compares each airport in an apt.dat file (usually the output of
+filter-airports.py for a bucket) with a manifest of content
+fingerprints saved from the last build, then prints the indices of
+all tiles covered by airports that were added, changed, or removed.
+
+Usage:
+
+    python3 airport-changes.py [--idents] [--update] <manifest.json> <apt.dat>
+
+Options:
+
+  --idents  print the idents of added or changed airports instead of tile indices
+  --update  save the current fingerprints to the manifest afterwards
+
+Example:
+
+    for tile in $(python3 airport-changes.py flags/w080n40/FABDEM-airports.json 02-prep/airports/w080n40/apt.dat); do
+        make BUCKET=w080n40 TILE_ID=$tile scenery-tile
+    done
+
+"""
+
+import hashlib, json, os, sys
+
+from aptdat import read_airports
+from tiles import tiles_in_bbox
+
+
+MANIFEST_VERSION = 1
+
+# Padding around an airport's runways and pavement, in degrees
+# (allows for runway width, shoulders, and the surrounding airport area)
+AIRPORT_MARGIN = 0.01
+
+
+def get_fingerprints(input):
+    """ Read the fingerprint of each airport in an apt.dat file
+    Returns a dict of {"hash": ..., "tiles": [...]} dicts, keyed by ident.
+
+    """
+    fingerprints = {}
+    for airport in read_airports(input, rows=(), keep_lines=True, keep_points=True):
+        data = ''.join(airport.lines).encode('latin1')
+        fingerprints[airport.ident] = {
+            'hash': hashlib.sha256(data).hexdigest(),
+            'tiles': get_airport_tiles(airport.points),
+        }
+    return fingerprints
+
+
+def get_airport_tiles(points):
+    """ Return the indices of the tiles covered by an airport's points, with a margin """
+    if not points:
+        return []
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return tiles_in_bbox(
+        max(-180, min(lons) - AIRPORT_MARGIN),
+        max(-90, min(lats) - AIRPORT_MARGIN),
+        min(180, max(lons) + AIRPORT_MARGIN),
+        min(90, max(lats) + AIRPORT_MARGIN),
+    )
+
+
+def compare_fingerprints(old, new):
+    """ Compare old and new fingerprints
+    Returns a tuple of sorted lists (added, changed, removed,) of idents.
+
+    """
+    added = sorted(ident for ident in new if ident not in old)
+    changed = sorted(ident for ident in new if ident in old and new[ident]['hash'] != old[ident]['hash'])
+    removed = sorted(ident for ident in old if ident not in new)
+    return (added, changed, removed,)
+
+
+def get_affected_tiles(old, new):
+    """ Return a sorted list of tile indices affected by the differences between old and new fingerprints
+    For a changed airport, this includes the tiles it covered before as well as now.
+
+    """
+    (added, changed, removed,) = compare_fingerprints(old, new)
+    tiles = set()
+    for ident in added + changed:
+        tiles.update(new[ident]['tiles'])
+    for ident in changed + removed:
+        tiles.update(old[ident]['tiles'])
+    return sorted(tiles)
+
+
+def load_manifest(filename):
+    """ Load fingerprints from a manifest file, or return an empty dict if there isn't one yet """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as input:
+        manifest = json.load(input)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['airports']
+
+
+def save_manifest(filename, fingerprints):
+    """ Save fingerprints to a manifest file """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as output:
+        json.dump({'version': MANIFEST_VERSION, 'airports': fingerprints}, output, separators=(',', ':',))
+    os.replace(tmp_filename, filename)
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+if __name__ == "__main__":
+
+    show_idents = False
+    update = False
+
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        option = args.pop(0)
+        if option == '--idents':
+            show_idents = True
+        elif option == '--update':
+            update = True
+        else:
+            args = []
+            break
+
+    if len(args) != 2:
+        print("Usage: {} [--idents] [--update] <manifest.json> <apt.dat>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
+
+    (manifest_file, apt_file,) = args
+
+    old = load_manifest(manifest_file)
+    with open(apt_file, 'r', encoding='latin1') as input:
+        new = get_fingerprints(input)
+
+    (added, changed, removed,) = compare_fingerprints(old, new)
+    print("{} airports added, {} changed, {} removed".format(len(added), len(changed), len(removed)), file=sys.stderr)
+
+    if show_idents:
+        for ident in added + changed:
+            print(ident)
+    else:
+        for tile in get_affected_tiles(old, new):
+            print(tile)
+
+    if update:
+        save_manifest(manifest_file, new)
@@ -0,0 +1,674 @@
+""" Shared support for reading apt.dat-format files
+
+read_airports() is a streaming parser that yields one compact Airport
+record at a time:
+
+    for airport in read_airports(input, rows=('100', '101', '102',)):
+        for runway in airport.runways:
+            print(airport.ident, runway.get('le_ident'), runway.get('he_ident'))
+
+Records keep the row's tokens and parse individual fields only when a
+caller asks for them, and the rows argument limits which row types are
+turned into records at all.
+
+This module also includes a persistent byte-offset index, so that
+scripts can jump straight to the airports they need instead of
+parsing the whole file.
+The index for apt.dat is saved beside it as apt.dat.idx, and is
+rebuilt automatically whenever the size or modification time of the
+source file changes.
+
+Command-line usage:
+
+    python3 aptdat.py index <file> [file...]
+    python3 aptdat.py airports <file> <ident> [ident...]
+    python3 aptdat.py bucket <file> <bucket>
+
+The "airports" and "bucket" commands print the matching airports in
+apt.dat format, so that they can be piped into the other scripts.
+
+"""
+
+import io, json, mmap, os, sys
+
+from tiles import parse_bucket
+
+
+INDEX_VERSION = 1
+
+#
+# Positions of lat/lon pairs in rows that locate an airport
+#
+
+COORD_POS = {
+    # runway
+    '100': ((9, 10,), (18, 19,),),
+    # water runway
+    '101': ((4, 5,), (7, 8,),),
+    # helipad
+    '102': ((2, 3,),),
+    # feature nodes
+    '111': ((1, 2,),),
+    '112': ((1, 2,),),
+    '113': ((1, 2,),),
+    '114': ((1, 2,),),
+    '115': ((1, 2,),),
+    '116': ((1, 2,),),
+    # positions of various types
+    '14': ((1, 2,),),
+    '15': ((1, 2,),),
+    '18': ((1, 2,),),
+    '19': ((1, 2,),),
+    '20': ((1, 2,),),
+    '21': ((1, 2,),),
+    '1201': ((1, 2,),),
+    '1300': ((1, 2,),),
+}
+
+AIRPORT_TYPES = ('1', '16', '17',)
+
+#
+# Field names for runway rows
+#
+
+RUNWAY_KEYS = {
+    # land runway
+    '100': (
+        'type', 'width', 'surface', 'shoulder', 'smoothness', 'centreline_lighting', 'edge_lighting', 'distance_signs',
+        'le_ident', 'le_lat', 'le_lon', 'le_displaced', 'le_overrun', 'le_markings', 'le_approach_lighting', 'le_tdz_lighting', 'le_reil',
+        'he_ident', 'he_lat', 'he_lon', 'he_displaced', 'he_overrun', 'he_markings', 'he_approach_lighting', 'he_tdz_lighting', 'he_reil',
+    ),
+    # water runway
+    '101': (
+        'type', 'width', 'buoys',
+        'le_ident', 'le_lat', 'le_lon',
+        'he_ident', 'he_lat', 'he_lon',
+    ),
+    # helipad
+    '102': (
+        'type', 'ident', 'lat', 'lon', 'bearing', 'len', 'width', 'surface', 'markings', 'shoulder', 'smoothness', 'edge_lighting',
+    ),
+}
+
+RUNWAY_KEY_POS = {type: {key: i for i, key in enumerate(keys)} for type, keys in RUNWAY_KEYS.items()}
+
+# Row types for frequencies (old 50-56 codes are normalised to 1050-1056)
+FREQUENCY_TYPES = ('50', '51', '52', '53', '54', '55', '56', '1050', '1051', '1052', '1053', '1054', '1055', '1056',)
+
+# Row types that read_airports() parses into records by default
+DEFAULT_ROWS = ('100', '101', '102', '14', '1300', '1302',) + FREQUENCY_TYPES
+
+# Row types for the taxi network and startup locations
+GROUNDNET_ROWS = ('1201', '1202', '1204', '1300', '1301',)
+
+
+#
+# Compact records for apt.dat rows
+#
+
+class Airport:
+    """ An airport (1), seaplane base (16), or heliport (17), with its child records
+
+    Attributes for child records are lists (dict for metadata),
+    filled only for the row types requested from read_airports().
+    taxi_nodes and taxi_edges hold the taxi network (see GROUNDNET_ROWS).
+    If requested, lines holds the airport's raw text lines and
+    points holds (lon, lat,) tuples for its runway ends and nodes.
+
+    """
+
+    __slots__ = ('tokens', 'runways', 'frequencies', 'parking', 'viewpoints', 'metadata', 'taxi_nodes', 'taxi_edges', 'lines', 'points',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.runways = []
+        self.frequencies = []
+        self.parking = []
+        self.viewpoints = []
+        self.metadata = {}
+        self.taxi_nodes = []
+        self.taxi_edges = []
+        self.lines = None
+        self.points = None
+
+    @property
+    def type(self):
+        return self.tokens[0]
+
+    @property
+    def elevation(self):
+        """ Elevation in feet, as a string """
+        return self.tokens[1]
+
+    @property
+    def ident(self):
+        return self.tokens[4]
+
+    @property
+    def name(self):
+        return ' '.join(self.tokens[5:])
+
+
+class Runway:
+    """ A land runway (100), water runway (101), or helipad (102)
+
+    Use get() for individual fields, named as in RUNWAY_KEYS. headings
+    is for the caller to fill in with the calculated heading of each end
+    (apt.dat includes a heading only for helipads).
+
+    """
+
+    __slots__ = ('tokens', 'headings',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.headings = None
+
+    @property
+    def type(self):
+        return self.tokens[0]
+
+    def get(self, key, default=None):
+        """ Get a single field, by its name in RUNWAY_KEYS """
+        pos = RUNWAY_KEY_POS[self.tokens[0]].get(key)
+        if pos is None or pos >= len(self.tokens):
+            return default
+        return self.tokens[pos]
+
+    def fields(self):
+        """ Return all fields as a dict, with the names in RUNWAY_KEYS """
+        keys = RUNWAY_KEYS[self.tokens[0]]
+        return {keys[i]: self.tokens[i] for i in range(len(keys))}
+
+    def ends(self):
+        """ Return a list of (lat, lon,) strings for each end (only one for a helipad) """
+        return [(self.tokens[lat_index], self.tokens[lon_index],) for lat_index, lon_index in COORD_POS[self.tokens[0]]]
+
+
+class Frequency:
+    """ A radio frequency (50-56 or 1050-1056) """
+
+    __slots__ = ('tokens',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    @property
+    def type(self):
+        """ The row type, always in the 1050-1056 form """
+        type = self.tokens[0]
+        return '10' + type if len(type) == 2 else type
+
+    @property
+    def frequency(self):
+        return self.tokens[1]
+
+    @property
+    def name(self):
+        return ' '.join(self.tokens[2:])
+
+
+class Parking:
+    """ A startup location (1300)
+    metadata holds the tokens of the following 1301 row, if any.
+
+    """
+
+    __slots__ = ('tokens', 'metadata',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.metadata = None
+
+    @property
+    def lat(self):
+        return self.tokens[1]
+
+    @property
+    def lon(self):
+        return self.tokens[2]
+
+    @property
+    def heading(self):
+        return self.tokens[3]
+
+    @property
+    def type(self):
+        return self.tokens[4]
+
+    @property
+    def usage(self):
+        """ List of aircraft types that can use the location """
+        return self.tokens[5].split('|')
+
+    @property
+    def name(self):
+        return ' '.join(self.tokens[6:])
+
+    @property
+    def width_code(self):
+        """ ICAO aircraft width code (A-F) from the 1301 row, or None """
+        if self.metadata is not None and len(self.metadata) > 1:
+            return self.metadata[1]
+        return None
+
+    @property
+    def operation_type(self):
+        """ Operation type (e.g. airline, cargo, general_aviation) from the 1301 row, or None """
+        if self.metadata is not None and len(self.metadata) > 2:
+            return self.metadata[2]
+        return None
+
+    @property
+    def airlines(self):
+        """ List of airline codes from the 1301 row """
+        if self.metadata is not None and len(self.metadata) > 3:
+            return ''.join(self.metadata[3:]).lower().split(',')
+        return []
+
+
+class Viewpoint:
+    """ A tower viewpoint (14) """
+
+    __slots__ = ('tokens',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    @property
+    def lat(self):
+        return self.tokens[1]
+
+    @property
+    def lon(self):
+        return self.tokens[2]
+
+    @property
+    def height(self):
+        """ Height of the viewpoint in feet, as a string """
+        return self.tokens[3]
+
+    @property
+    def name(self):
+        return ' '.join(self.tokens[5:])
+
+
+class TaxiNode:
+    """ A taxi network node (1201) """
+
+    __slots__ = ('tokens',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    @property
+    def lat(self):
+        return self.tokens[1]
+
+    @property
+    def lon(self):
+        return self.tokens[2]
+
+    @property
+    def usage(self):
+        """ dest, init, both, or junc """
+        return self.tokens[3]
+
+    @property
+    def id(self):
+        return self.tokens[4]
+
+    @property
+    def name(self):
+        return ' '.join(self.tokens[5:])
+
+
+class TaxiEdge:
+    """ A taxi network edge (1202)
+    active_zones holds (type, runways,) for each following 1204 row,
+    where type is arrival, departure, or ils and runways is a list.
+
+    """
+
+    __slots__ = ('tokens', 'active_zones',)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.active_zones = []
+
+    @property
+    def start(self):
+        """ ID of the first node """
+        return self.tokens[1]
+
+    @property
+    def end(self):
+        """ ID of the second node """
+        return self.tokens[2]
+
+    @property
+    def direction(self):
+        """ oneway or twoway """
+        return self.tokens[3]
+
+    @property
+    def category(self):
+        """ runway, or taxiway (with an optional width-code suffix like taxiway_E) """
+        return self.tokens[4] if len(self.tokens) > 4 else 'taxiway'
+
+    @property
+    def name(self):
+        return ' '.join(self.tokens[5:])
+
+
+#
+# Streaming parser
+#
+
+def add_runway(airport, tokens):
+    airport.runways.append(Runway(tokens))
+
+def add_frequency(airport, tokens):
+    airport.frequencies.append(Frequency(tokens))
+
+def add_parking(airport, tokens):
+    airport.parking.append(Parking(tokens))
+
+def add_viewpoint(airport, tokens):
+    airport.viewpoints.append(Viewpoint(tokens))
+
+def add_parking_metadata(airport, tokens):
+    if airport.parking:
+        airport.parking[-1].metadata = tokens
+
+def add_taxi_node(airport, tokens):
+    airport.taxi_nodes.append(TaxiNode(tokens))
+
+def add_taxi_edge(airport, tokens):
+    airport.taxi_edges.append(TaxiEdge(tokens))
+
+def add_active_zone(airport, tokens):
+    if airport.taxi_edges and len(tokens) > 2:
+        airport.taxi_edges[-1].active_zones.append((tokens[1], tokens[2].split(','),))
+
+def add_metadata(airport, tokens):
+    if len(tokens) > 2:
+        airport.metadata[tokens[1]] = ' '.join(tokens[2:])
+
+ROW_HANDLERS = {
+    '100': add_runway,
+    '101': add_runway,
+    '102': add_runway,
+    '14': add_viewpoint,
+    '1201': add_taxi_node,
+    '1202': add_taxi_edge,
+    '1204': add_active_zone,
+    '1300': add_parking,
+    '1301': add_parking_metadata,
+    '1302': add_metadata,
+}
+ROW_HANDLERS.update({type: add_frequency for type in FREQUENCY_TYPES})
+
+
+def tokenize(input):
+    """ Split an apt.dat file into rows of tokens, skipping the header, blank lines, and the final 99
+    Yields (line, tokens,) for each row.
+
+    """
+    for i, line in enumerate(input):
+        tokens = line.split()
+
+        if not tokens:
+            continue
+
+        type = tokens[0]
+
+        if i == 0 and type in ('I', 'A',):
+            continue
+
+        elif i <= 2 and type in ('1000', '1100', '1200',):
+            continue
+
+        elif type == '99':
+            continue
+
+        yield (line, tokens,)
+
+
+def read_airports(input, rows=DEFAULT_ROWS, keep_lines=False, keep_points=False):
+    """ Iterate over the airports in an apt.dat-format file, one Airport record at a time
+
+    Parameters:
+
+      input: an iterable of lines (e.g. a file object)
+
+      rows: the row types to parse into child records (see ROW_HANDLERS); others are skipped
+
+      keep_lines: if True, save the airport's raw lines in airport.lines
+
+      keep_points: if True, save (lon, lat,) tuples for runway ends and nodes in airport.points
+
+    """
+    handlers = {type: ROW_HANDLERS[type] for type in rows if type in ROW_HANDLERS}
+    airport = None
+
+    for line, tokens in tokenize(input):
+        type = tokens[0]
+
+        if type in AIRPORT_TYPES:
+            if airport is not None:
+                yield airport
+            airport = Airport(tokens)
+            if keep_lines:
+                airport.lines = []
+            if keep_points:
+                airport.points = []
+
+        elif airport is None:
+            continue
+
+        else:
+            handler = handlers.get(type)
+            if handler is not None:
+                handler(airport, tokens)
+            if keep_points and type in COORD_POS:
+                for lat_index, lon_index in COORD_POS[type]:
+                    airport.points.append((float(tokens[lon_index]), float(tokens[lat_index]),))
+
+        if keep_lines:
+            airport.lines.append(line)
+
+    if airport is not None:
+        yield airport
+
+# Fields in each index entry
+IDENT, TYPE, OFFSET, LENGTH, MIN_LON, MIN_LAT, MAX_LON, MAX_LAT = range(8)
+
+
+#
+# Building and loading the index
+#
+
+def index_path(filename):
+    """ Return the path of the index file for an apt.dat file """
+    return filename + '.idx'
+
+
+def get_source_info(filename):
+    """ Return the size and mtime used to check whether an index is stale """
+    stat = os.stat(filename)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def build_index(filename):
+    """ Scan an apt.dat file and build an index of its airports
+
+    Each entry is a list of [ident, type, offset, length, min_lon, min_lat, max_lon, max_lat].
+    The bounding box covers all runway ends and nodes, and is None for
+    an airport without any.
+
+    """
+
+    airports = []
+    entry = None
+
+    def close_entry(offset):
+        nonlocal entry
+        if entry is not None:
+            entry[LENGTH] = offset - entry[OFFSET]
+            airports.append(entry)
+            entry = None
+
+    source = get_source_info(filename)
+    offset = 0
+    with open(filename, 'rb') as input:
+        for i, line in enumerate(input):
+            tokens = line.split()
+            if tokens:
+                type = tokens[0].decode('latin1')
+                if type in AIRPORT_TYPES and len(tokens) > 4:
+                    close_entry(offset)
+                    entry = [tokens[4].decode('latin1'), type, offset, 0, None, None, None, None]
+                elif type == '99':
+                    close_entry(offset)
+                elif entry is not None and type in COORD_POS:
+                    for lat_index, lon_index in COORD_POS[type]:
+                        lon = float(tokens[lon_index])
+                        lat = float(tokens[lat_index])
+                        if entry[MIN_LON] is None:
+                            entry[MIN_LON:] = [lon, lat, lon, lat]
+                        else:
+                            entry[MIN_LON] = min(entry[MIN_LON], lon)
+                            entry[MIN_LAT] = min(entry[MIN_LAT], lat)
+                            entry[MAX_LON] = max(entry[MAX_LON], lon)
+                            entry[MAX_LAT] = max(entry[MAX_LAT], lat)
+            offset += len(line)
+    close_entry(offset)
+
+    return {
+        'version': INDEX_VERSION,
+        'source': source,
+        'airports': airports,
+    }
+
+
+def save_index(filename, index):
+    """ Save an index beside its apt.dat file """
+    path = index_path(filename)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as output:
+        json.dump(index, output, separators=(',', ':',))
+    os.replace(tmp_path, path)
+
+
+def load_index(filename, save=True):
+    """ Load the index for an apt.dat file, rebuilding it if it's missing or stale
+
+    If save is True, a rebuilt index will be written for next time
+    (failures to write are ignored).
+
+    """
+    path = index_path(filename)
+    source = get_source_info(filename)
+
+    try:
+        with open(path, 'r') as input:
+            index = json.load(input)
+        if index.get('version') == INDEX_VERSION and index.get('source') == source:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    print("Indexing {}...".format(filename), file=sys.stderr)
+    index = build_index(filename)
+    if save:
+        try:
+            save_index(filename, index)
+        except OSError as e:
+            print("Cannot save index {}: {}".format(path, e), file=sys.stderr)
+    return index
+
+
+#
+# Looking up airports
+#
+
+def find_airports(index, bounds=None, idents=None):
+    """ Return index entries for airports matching a bounding box and/or list of idents
+
+    Bounds format: (min_lon, min_lat, max_lon, max_lat,)
+
+    An airport matches the bounds if its own bounding box intersects
+    them, so callers needing an exact test must still check the
+    airport's points. Entries are returned in file order.
+
+    """
+    if idents is not None:
+        idents = set(idents)
+    result = []
+    for entry in index['airports']:
+        if idents is not None and entry[IDENT] not in idents:
+            continue
+        if bounds is not None:
+            if entry[MIN_LON] is None:
+                continue
+            if entry[MAX_LON] < bounds[0] or entry[MIN_LON] > bounds[2] or entry[MAX_LAT] < bounds[1] or entry[MIN_LAT] > bounds[3]:
+                continue
+        result.append(entry)
+    return result
+
+
+def read_airports_text(filename, entries):
+    """ Read the raw text for a list of index entries, using mmap to seek to each one """
+    if not entries:
+        return
+    with open(filename, 'rb') as input:
+        with mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for entry in entries:
+                yield data[entry[OFFSET]:entry[OFFSET] + entry[LENGTH]].decode('latin1')
+
+
+def open_airports(filename, bounds=None, idents=None):
+    """ Open an apt.dat file, including only the matching airports
+
+    Returns a file-like object with the text of the selected airports
+    (no header or trailing 99), suitable for any script that reads apt.dat
+    line by line.
+
+    """
+    index = load_index(filename)
+    entries = find_airports(index, bounds=bounds, idents=idents)
+    return io.StringIO(''.join(read_airports_text(filename, entries)))
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'index' and len(sys.argv) >= 3:
+        for filename in sys.argv[2:]:
+            index = build_index(filename)
+            save_index(filename, index)
+            print("{}: {} airports".format(filename, len(index['airports'])), file=sys.stderr)
+
+    elif command in ('airports', 'bucket',) and len(sys.argv) >= 4:
+        filename = sys.argv[2]
+        if command == 'bucket':
+            input = open_airports(filename, bounds=parse_bucket(sys.argv[3]))
+        else:
+            input = open_airports(filename, idents=sys.argv[3:])
+        with open(sys.stdout.fileno(), 'w', encoding='latin1') as output:
+            output.write(input.getvalue())
+
+    else:
+        print("Usage: {} index <file> [file...]".format(sys.argv[0]), file=sys.stderr)
+        print("       {} airports <file> <ident> [ident...]".format(sys.argv[0]), file=sys.stderr)
+        print("       {} bucket <file> <bucket>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
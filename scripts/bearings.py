@@ -0,0 +1,93 @@
+""" Calculate runway bearings, one at a time or in batches
+
+The batch version uses NumPy to calculate the bearings for all the
+runways in a file (or a chunk of it) at once:
+
+    import numpy
+    from bearings import calculate_runway_bearings
+
+    (le_bearings, he_bearings,) = calculate_runway_bearings(le_lats, le_lons, he_lats, he_lons)
+
+"""
+
+import math
+
+import numpy
+
+
+# Function by Jérôme Renard
+# LICENSE: public domain
+def calculate_initial_compass_bearing(pointA, pointB):
+    """
+    Calculates the bearing between two points.
+
+    The formulae used is the following:
+        θ = atan2(sin(Δlong).cos(lat2),
+                  cos(lat1).sin(lat2) − sin(lat1).cos(lat2).cos(Δlong))
+
+    :Parameters:
+      - `pointA: The sequence representing the latitude/longitude for the
+        first point. Latitude and longitude must be in decimal degrees
+      - `pointB: The sequence representing the latitude/longitude for the
+        second point. Latitude and longitude must be in decimal degrees
+
+    :Returns:
+      The bearing in degrees
+
+    :Returns Type:
+      float
+    """
+    lat1 = math.radians(pointA[0])
+    lat2 = math.radians(pointB[0])
+
+    diffLong = math.radians(pointB[1] - pointA[1])
+
+    x = math.sin(diffLong) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
+            * math.cos(lat2) * math.cos(diffLong))
+
+    initial_bearing = math.atan2(x, y)
+
+    # Now we have the initial bearing but math.atan2 return values
+    # from -180° to + 180° which is not what we want for a compass bearing
+    # The solution is to normalize the initial bearing as shown below
+    initial_bearing = math.degrees(initial_bearing)
+    compass_bearing = (initial_bearing + 360) % 360
+
+    return compass_bearing
+
+
+def calculate_initial_compass_bearings(lats1, lons1, lats2, lons2):
+    """ Calculate the bearings from each point in one set of arrays to the matching point in another
+
+    Same formula as calculate_initial_compass_bearing(), but takes
+    array-likes of latitudes and longitudes in decimal degrees, and
+    returns a NumPy array of compass bearings.
+
+    """
+    lat1 = numpy.radians(numpy.asarray(lats1, dtype=numpy.float64))
+    lat2 = numpy.radians(numpy.asarray(lats2, dtype=numpy.float64))
+    diffLong = numpy.radians(numpy.asarray(lons2, dtype=numpy.float64) - numpy.asarray(lons1, dtype=numpy.float64))
+
+    cos_lat2 = numpy.cos(lat2)
+    x = numpy.sin(diffLong) * cos_lat2
+    y = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * cos_lat2 * numpy.cos(diffLong)
+
+    return (numpy.degrees(numpy.arctan2(x, y)) + 360) % 360
+
+
+def calculate_runway_bearings(le_lats, le_lons, he_lats, he_lons):
+    """ Calculate the bearings from both ends of a batch of runways
+
+    Takes array-likes of the low-end and high-end coordinates for each
+    runway, in decimal degrees.
+
+    Returns a tuple of NumPy arrays (le_bearings, he_bearings,), where
+    le_bearings are the initial bearings from the low end towards the
+    high end, and he_bearings are the bearings in the other direction.
+
+    """
+    return (
+        calculate_initial_compass_bearings(le_lats, le_lons, he_lats, he_lons),
+        calculate_initial_compass_bearings(he_lats, he_lons, le_lats, le_lons),
+    )
@@ -0,0 +1,737 @@
+""" Benchmarks and sanity checks for the build scripts
+
+Usage:
+
+    python3 benchmark.py headings [apt.dat]
+    python3 benchmark.py parser <apt.dat>
+
+headings: check the batch runway-bearing calculation against the
+scalar formula, and time both. Uses every land and water runway in
+apt.dat if provided (e.g. the full global file); otherwise, uses
+40,000 random runways.
+
+    python3 benchmark.py generate-apt [--airports=N] [--seed=N] <output.dat>
+    python3 benchmark.py generate-dem [--style=FABDEM|SRTM-3] [--seed=N] <dem-dir> <min-lon> <min-lat> <max-lon> <max-lat>
+    python3 benchmark.py scripts [options]
+
+parser: compare the old style of parsing (re.split() and a dict of
+dicts per airport) with the records from aptdat.read_airports(),
+reporting lines/second and peak RSS. Each parser runs in a fresh
+process and keeps every airport in memory, as gen-thresholds.py does.
+
+generate-apt: write a synthetic apt.dat file (default 20,000
+airports) with land airports, seaplane bases, and heliports, including
+runways, towers, metadata, frequencies, and for the larger airports,
+taxi networks and startup locations. The same seed always gives the
+same file.
+
+generate-dem: create a synthetic FABDEM or SRTM-3 directory tree of
+empty 1x1 deg files, one subdirectory per bucket, with about 30% of
+cells missing (as for open ocean).
+
+scripts: generate test data in a temporary directory, then run
+filter-airports.py, gen-thresholds.py, generate-airport-files.py,
+split-airports.py, list-dem.py, and make-download-links.py (with a
+local stand-in for Dropbox that takes LINK_DELAY seconds per request)
+on it, reporting wall time, CPU
+time, peak RSS, and throughput for each (the fastest of several runs).
+Options:
+
+  --airports=N      airports in the synthetic apt.dat (default: 20000)
+  --repeat=N        runs of each script (default: 3)
+  --only=NAME,...   run only these benchmarks
+  --baseline=FILE   compare with the results saved in FILE
+  --save            save this run's results to the baseline file
+  --threshold=PCT   allowed slowdown or memory growth (default: 20)
+
+Parallel and serial variants of a script, and list-dem.py with and
+without the catalog, must produce identical output. With a baseline,
+a benchmark fails if its output changed, or if it got slower or
+bigger by more than the threshold. Baselines are specific to one
+machine, so keep them out of version control.
+
+    python3 benchmark.py formats [--sql=SQL] [--osmconf=FILE] <source> <min-lon> <min-lat> <max-lon> <max-lat>
+
+formats: extract the same area of a vector source (e.g. a dense
+bucket's OSM PBF) with ogr2ogr as a shapefile (plus the separate
+spatial-index pass), a FlatGeobuf, and a GeoPackage, as the Makefile
+does for each EXTRACT_FORMAT. For each, reports the extract and index
+times, the size on disk, and the time for a spatially filtered read
+of the 1x1 deg cell in the middle of the area, which must return the
+same number of features for every format. --sql and --osmconf are
+passed to ogr2ogr as -sql and -oo CONFIG_FILE=. Needs the GDAL
+command-line tools. For example (see the benchmark-extract-formats
+target in the Makefile):
+
+    python3 benchmark.py formats --osmconf=config/osmconf.ini --sql="$(python3 osm-queries.py sql config/osm-layers.tsv area)" \\
+        02-prep/osm/w080n40.osm.pbf -81 39 -69 51
+
+Apart from formats, everything runs offline; only the Python packages
+in requirements.txt are needed.
+
+"""
+
+import hashlib, json, math, multiprocessing, os, random, re, resource, subprocess, sys, tempfile, time
+
+import numpy
+
+import instrument
+
+from aptdat import read_airports
+from bearings import calculate_initial_compass_bearing, calculate_runway_bearings
+from demcatalog import format_cell
+from partition import FORMATS
+from tiles import get_bucket
+
+
+# Maximum acceptable difference between scalar and batch bearings, in degrees
+BEARING_TOLERANCE = 1e-9
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BASELINE_VERSION = 1
+
+# Area covered by the synthetic DEM tree for the scripts benchmarks
+DEM_BOUNDS = (-100, 20, -60, 60,)
+
+# Fraction of DEM cells that have a file
+DEM_COVERAGE = 0.7
+
+# Filename suffix for each style of DEM tree
+DEM_SUFFIXES = {
+    'FABDEM': '_FABDEM_V1-2.tif',
+    'SRTM-3': '.hgt',
+}
+
+# Seconds for each request to the stand-in for Dropbox in the download-links benchmarks (like a round trip)
+LINK_DELAY = 0.005
+
+# Slowdowns shorter than this are ignored as noise, in seconds
+MIN_SLOWDOWN = 0.1
+
+# Benchmarks for the scripts benchmark, in order. {output} is replaced
+# with a fresh directory for each run, and standard output goes to
+# {output}/stdout. Benchmarks with same_as must match that one's output.
+SCRIPT_BENCHMARKS = (
+    {'name': 'filter-airports', 'args': ['filter-airports.py', 'w080n40', 'apt.dat'], 'items': 'airports'},
+    {'name': 'filter-airports-split', 'args': ['filter-airports.py', '--all-buckets', '{output}', 'apt.dat'], 'items': 'airports'},
+    {'name': 'gen-thresholds', 'args': ['gen-thresholds.py', '{output}', 'apt.dat'], 'items': 'airports'},
+    {'name': 'gen-thresholds-parallel', 'args': ['gen-thresholds.py', '--processes=4', '{output}', 'apt.dat'], 'items': 'airports', 'same_as': 'gen-thresholds'},
+    {'name': 'generate-airport-files', 'args': ['generate-airport-files.py', '{output}'], 'stdin': 'apt.dat', 'items': 'airports'},
+    {'name': 'generate-airport-files-parallel', 'args': ['generate-airport-files.py', '--processes=4', '{output}'], 'stdin': 'apt.dat', 'items': 'airports', 'same_as': 'generate-airport-files'},
+    {'name': 'split-airports', 'args': ['split-airports.py', '{output}'], 'stdin': 'apt.dat', 'items': 'airports'},
+    {'name': 'list-dem', 'args': ['list-dem.py', 'dem', 'w080n40'], 'items': 'dem-files'},
+    {'name': 'list-dem-walk', 'args': ['list-dem.py', '--no-catalog', 'dem', 'w080n40'], 'items': 'dem-files', 'same_as': 'list-dem'},
+    {'name': 'download-links', 'args': ['make-download-links.py', '--local=dropbox', '--local-delay={}'.format(LINK_DELAY), '--jobs=1', 'none', '{output}/links.txt'], 'items': 'releases'},
+    {'name': 'download-links-parallel', 'args': ['make-download-links.py', '--local=dropbox', '--local-delay={}'.format(LINK_DELAY), '--jobs=8', 'none', '{output}/links.txt'], 'items': 'releases', 'same_as': 'download-links'},
+)
+
+# Abbreviation of each kind of item, for throughput
+ITEM_UNITS = {
+    'airports': 'apt',
+    'dem-files': 'dem',
+    'releases': 'file',
+}
+
+
+def read_runway_ends(filename):
+    """ Read the end coordinates of all land and water runways in an apt.dat file
+    Returns a tuple of lists (le_lats, le_lons, he_lats, he_lons,)
+
+    """
+    positions = {
+        '100': (9, 10, 18, 19,),
+        '101': (4, 5, 7, 8,),
+    }
+    ends = ([], [], [], [],)
+    with open(filename, 'r', encoding='latin1') as input:
+        for line in input:
+            tokens = line.split()
+            if tokens and tokens[0] in positions:
+                for i, pos in enumerate(positions[tokens[0]]):
+                    ends[i].append(float(tokens[pos]))
+    return ends
+
+
+def make_runway_ends(count, seed=0):
+    """ Make random runway ends, each about 0.5 to 4 km long
+    Returns a tuple of lists (le_lats, le_lons, he_lats, he_lons,)
+
+    """
+    rng = random.Random(seed)
+    ends = ([], [], [], [],)
+    for i in range(count):
+        lat = rng.uniform(-85.0, 85.0)
+        lon = rng.uniform(-180.0, 180.0)
+        length = rng.uniform(0.005, 0.04)
+        heading = math.radians(rng.uniform(0.0, 360.0))
+        ends[0].append(lat)
+        ends[1].append(lon)
+        ends[2].append(lat + length * math.cos(heading))
+        ends[3].append(lon + length * math.sin(heading) / math.cos(math.radians(lat)))
+    return ends
+
+
+def angle_difference(a, b):
+    """ Return the absolute difference between arrays of compass bearings, allowing for wraparound """
+    diff = numpy.abs(numpy.asarray(a) - numpy.asarray(b)) % 360
+    return numpy.minimum(diff, 360 - diff)
+
+
+def benchmark_headings(filename=None):
+    """ Compare the scalar and batch runway-bearing calculations
+    Returns True if the results agree within BEARING_TOLERANCE.
+
+    """
+    if filename is not None:
+        (le_lats, le_lons, he_lats, he_lons,) = read_runway_ends(filename)
+    else:
+        (le_lats, le_lons, he_lats, he_lons,) = make_runway_ends(40000)
+
+    count = len(le_lats)
+    print("{} runways".format(count))
+
+    start = time.perf_counter()
+    scalar_le = []
+    scalar_he = []
+    for i in range(count):
+        scalar_le.append(calculate_initial_compass_bearing((le_lats[i], le_lons[i],), (he_lats[i], he_lons[i],)))
+        scalar_he.append(calculate_initial_compass_bearing((he_lats[i], he_lons[i],), (le_lats[i], le_lons[i],)))
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    (batch_le, batch_he,) = calculate_runway_bearings(
+        numpy.array(le_lats), numpy.array(le_lons), numpy.array(he_lats), numpy.array(he_lons)
+    )
+    batch_time = time.perf_counter() - start
+
+    max_diff = 0.0
+    if count > 0:
+        max_diff = max(float(angle_difference(scalar_le, batch_le).max()), float(angle_difference(scalar_he, batch_he).max()))
+
+    print("scalar: {:0.4f} s".format(scalar_time))
+    print("batch:  {:0.4f} s ({:0.1f}x)".format(batch_time, scalar_time / batch_time if batch_time > 0 else 0))
+    print("max difference: {:0.3g} deg".format(max_diff))
+
+    if max_diff > BEARING_TOLERANCE:
+        print("FAILED: difference exceeds {} deg".format(BEARING_TOLERANCE), file=sys.stderr)
+        return False
+    return True
+
+
+def legacy_parse(input):
+    """ Parse airports the way the scripts used to, with re.split() and dicts
+    Returns a list of airport dicts.
+
+    """
+    airports = []
+    airport = None
+    for line in input:
+        tokens = re.split(r'\s+', line)
+        type = tokens[0]
+        if type in ('1', '16', '17',):
+            airport = {
+                'type': type,
+                'elev-m': tokens[1],
+                'ident': tokens[4],
+                'name': ' '.join(tokens[5:]).strip(),
+                'runways': [],
+                'frequencies': [],
+                'parking': [],
+                'viewpoints': [],
+                'metadata': {},
+            }
+            airports.append(airport)
+        elif airport is None:
+            continue
+        elif type in ('100', '101', '102',):
+            airport['runways'].append({i: token for i, token in enumerate(tokens)})
+        elif type == '1300':
+            airport['parking'].append({
+                'lat': tokens[1],
+                'lon': tokens[2],
+                'hdg-deg': tokens[3],
+                'type': tokens[4],
+                'usage': tokens[5].split('|'),
+                'name': ' '.join(tokens[6:]).strip(),
+            })
+        elif type == '1302':
+            airport['metadata'][tokens[1]] = ' '.join(tokens[2:]).strip()
+        elif type in ('50', '51', '52', '53', '54', '55', '56', '1050', '1051', '1052', '1053', '1054', '1055', '1056',):
+            airport['frequencies'].append({
+                'type': type,
+                'frequency': tokens[1],
+                'name': ' '.join(tokens[2:]).strip(),
+            })
+        elif type == '14':
+            airport['viewpoints'].append({
+                'lat': tokens[1],
+                'lon': tokens[2],
+                'elev-m': tokens[3],
+                'name': ' '.join(tokens[4:]).strip(),
+            })
+    return airports
+
+
+def records_parse(input):
+    """ Parse airports into compact records with aptdat.read_airports()
+    Returns a list of Airport records.
+
+    """
+    return list(read_airports(input))
+
+
+PARSERS = {
+    'legacy': legacy_parse,
+    'records': records_parse,
+}
+
+
+def run_parser(name, filename, queue):
+    """ Run a single parser in a child process and report (airports, lines, seconds, peak_rss_kb,) """
+    with open(filename, 'r', encoding='latin1') as input:
+        lines = sum(1 for line in input)
+    start = time.perf_counter()
+    with open(filename, 'r', encoding='latin1') as input:
+        airports = PARSERS[name](input)
+    elapsed = time.perf_counter() - start
+    queue.put((len(airports), lines, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,))
+
+
+def benchmark_parser(filename):
+    """ Compare the legacy and record-based parsers on an apt.dat file
+    Returns True if both found the same number of airports.
+
+    """
+    context = multiprocessing.get_context('spawn')
+    counts = set()
+    for name in PARSERS:
+        queue = context.Queue()
+        process = context.Process(target=run_parser, args=(name, filename, queue,))
+        process.start()
+        (airports, lines, elapsed, peak_rss,) = queue.get()
+        process.join()
+        counts.add(airports)
+        print("{:8s} {:8d} airports {:12,.0f} lines/s {:10,d} KB peak RSS".format(
+            name, airports, lines / elapsed if elapsed > 0 else 0, peak_rss
+        ))
+
+    if len(counts) != 1:
+        print("FAILED: parsers found different numbers of airports", file=sys.stderr)
+        return False
+    return True
+
+
+#
+# Synthetic data
+#
+
+def get_runway_ident(heading):
+    """ Return the runway number for a magnetic heading (ignoring variation) """
+    number = int(round(heading / 10)) % 36
+    return "{:02d}".format(number or 36)
+
+
+def get_runway_ends(rng, lat, lon, length):
+    """ Return the (lat, lon, heading,) of both ends of a random runway centred on a point """
+    heading = rng.uniform(0.0, 180.0)
+    dlat = length / 2 * math.cos(math.radians(heading))
+    dlon = length / 2 * math.sin(math.radians(heading)) / math.cos(math.radians(lat))
+    return ((lat - dlat, lon - dlon, heading,), (lat + dlat, lon + dlon, heading + 180.0,),)
+
+
+def write_land_airport(output, rng, ident, lat, lon, large):
+    """ Write the rows for a land airport, with a taxi network if it's large """
+    print("1 {} 0 0 {} Synthetic Airport {}".format(rng.randint(0, 2000), ident, ident), file=output)
+    print("1302 city Synthetic City", file=output)
+    print("1302 country Synthetic Country", file=output)
+    print("1302 icao_code {}".format(ident), file=output)
+    print("1302 datum_lat {:.8f}".format(lat), file=output)
+    print("1302 datum_lon {:.8f}".format(lon), file=output)
+    if large or rng.random() < 0.3:
+        print("14 {:.8f} {:.8f} {} 0 Tower".format(lat + 0.002, lon + 0.002, rng.randint(50, 200)), file=output)
+
+    for i in range(rng.randint(2, 4) if large else rng.randint(1, 2)):
+        (le, he,) = get_runway_ends(rng, lat + i * 0.003, lon, rng.uniform(0.005, 0.04))
+        print("100 {:.2f} {} 0 0.25 1 3 1 {} {:.8f} {:.8f} 0.00 0.00 3 0 0 1 {} {:.8f} {:.8f} 0.00 0.00 3 0 0 1".format(
+            rng.choice((18.0, 30.0, 45.0, 60.0,)), rng.choice((1, 2, 3,)),
+            get_runway_ident(le[2]), le[0], le[1], get_runway_ident(he[2]), he[0], he[1],
+        ), file=output)
+
+    if large:
+        nodes = rng.randint(10, 40)
+        for i in range(nodes):
+            print("1201 {:.8f} {:.8f} both {} A{}".format(lat + rng.uniform(-0.01, 0.01), lon + rng.uniform(-0.01, 0.01), i, i), file=output)
+        for i in range(nodes - 1):
+            category = 'runway' if i == 0 else 'taxiway'
+            print("1202 {} {} twoway {} {}".format(i, i + 1, category, 'R' if i == 0 else 'A'), file=output)
+            if i == 1:
+                print("1204 departure 01", file=output)
+        for i in range(rng.randint(5, 30)):
+            print("1300 {:.8f} {:.8f} {:.2f} {} jets|turboprops G{}".format(
+                lat + rng.uniform(-0.01, 0.01), lon + rng.uniform(-0.01, 0.01), rng.uniform(0, 360), rng.choice(('gate', 'tie-down',)), i,
+            ), file=output)
+            print("1301 {} {} {}".format(rng.choice('ABCDEF'), rng.choice(('airline', 'cargo', 'general_aviation',)), rng.choice(('aal', 'dal,ual', 'swa',))), file=output)
+        print("1050 12800 ATIS", file=output)
+        print("1054 11830 Tower", file=output)
+        print("1053 12170 Ground", file=output)
+    else:
+        print("1051 12290 CTAF", file=output)
+
+
+def make_apt_dat(output, airports=20000, seed=0):
+    """ Write a synthetic apt.dat file with a number of airports
+    The same seed always gives the same output.
+
+    """
+    rng = random.Random(seed)
+    print("I", file=output)
+    print("1200 Generated by benchmark.py\n", file=output)
+    for i in range(airports):
+        ident = "{}{:04X}".format(chr(ord('A') + (i >> 16) % 26), i & 0xffff)
+        lat = rng.uniform(-55.0, 72.0)
+        lon = rng.uniform(-179.5, 179.5)
+        kind = rng.random()
+        if kind < 0.8:
+            write_land_airport(output, rng, ident, lat, lon, rng.random() < 0.1)
+        elif kind < 0.9:
+            print("16 0 0 0 {} Synthetic Seaplane Base {}".format(ident, ident), file=output)
+            (le, he,) = get_runway_ends(rng, lat, lon, rng.uniform(0.01, 0.03))
+            print("101 49.99 0 {} {:.8f} {:.8f} {} {:.8f} {:.8f}".format(
+                get_runway_ident(le[2]), le[0], le[1], get_runway_ident(he[2]), he[0], he[1],
+            ), file=output)
+        else:
+            print("17 {} 0 0 {} Synthetic Heliport {}".format(rng.randint(0, 500), ident, ident), file=output)
+            print("102 H1 {:.8f} {:.8f} {:.2f} 18.29 18.29 1 0 0 0.25 0".format(lat, lon, rng.uniform(0, 360)), file=output)
+        print("", file=output)
+    print("99", file=output)
+
+
+def make_dem_tree(dem_dir, bounds, style='FABDEM', seed=0, coverage=DEM_COVERAGE):
+    """ Create a synthetic DEM directory tree of empty files, one subdirectory per bucket
+    Returns the number of files created.
+
+    """
+    rng = random.Random(seed)
+    (min_lon, min_lat, max_lon, max_lat,) = bounds
+    count = 0
+    for lat in range(min_lat, max_lat):
+        for lon in range(min_lon, max_lon):
+            if rng.random() >= coverage:
+                continue
+            dir = os.path.join(dem_dir, get_bucket(lon, lat))
+            os.makedirs(dir, exist_ok=True)
+            open(os.path.join(dir, format_cell(lat, lon) + DEM_SUFFIXES[style]), 'wb').close()
+            count += 1
+    return count
+
+
+def make_release_dir(downloads_dir, seed=0):
+    """ Create a synthetic Dropbox downloads folder of small release files for every bucket
+    About a third of the buckets also have an older release and a delta from it.
+    Returns the number of files created.
+
+    """
+    rng = random.Random(seed)
+    os.makedirs(downloads_dir, exist_ok=True)
+    count = 0
+    for lat in range(-90, 90, 10):
+        for lon in range(-180, 180, 10):
+            prefix = 'fgfs-americas-scenery-{}-'.format(get_bucket(lon, lat))
+            names = [prefix + '20240911.tar.zst']
+            if rng.random() < 1 / 3:
+                names += [prefix + '20240801.tar', prefix + '20240801-20240911.tar.zst']
+            for name in names:
+                with open(os.path.join(downloads_dir, name), 'wb') as output:
+                    output.write(rng.randbytes(rng.randint(100, 1000)))
+                count += 1
+    return count
+
+
+#
+# Script benchmarks
+#
+
+def tree_digest(path, work_dir):
+    """ Return a SHA-256 hex digest of the names and contents of all files under a directory
+    Occurrences of work_dir in the files (e.g. in absolute paths) are ignored.
+
+    """
+    work_dir = os.fsencode(work_dir)
+    hash = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            hash.update(os.path.relpath(filepath, path).encode('utf-8') + b'\0')
+            with open(filepath, 'rb') as input:
+                hash.update(hashlib.sha256(input.read().replace(work_dir, b'')).digest())
+    return hash.hexdigest()
+
+
+def run_script_benchmark(benchmark, work_dir, repeat):
+    """ Run a script benchmark several times in work_dir
+    Returns a dict of results (fastest wall time, with the CPU time of that run, and the highest peak RSS), or None if it failed
+
+    """
+    result = None
+    for i in range(repeat):
+        output_dir = os.path.join(work_dir, "{}-{}".format(benchmark['name'], i))
+        os.makedirs(output_dir)
+        command = [sys.executable, os.path.join(SCRIPT_DIR, benchmark['args'][0])]
+        command += [arg.replace('{output}', output_dir) for arg in benchmark['args'][1:]]
+        stdin_filename = os.path.join(work_dir, benchmark['stdin']) if 'stdin' in benchmark else os.devnull
+        err_filename = output_dir + '.err'
+        with open(stdin_filename, 'rb') as stdin, open(os.path.join(output_dir, 'stdout'), 'wb') as stdout, open(err_filename, 'wb') as stderr:
+            (status, wall, usage,) = instrument.measure(command, cwd=work_dir, stdin=stdin, stdout=stdout, stderr=stderr)
+        if status != 0:
+            print("{}: failed with status {}:".format(benchmark['name'], status), file=sys.stderr)
+            with open(err_filename, 'r', errors='replace') as input:
+                sys.stderr.write(input.read())
+            return None
+        run = {
+            'wall': round(wall, 3),
+            'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+            'max_rss_kb': usage.ru_maxrss,
+            'digest': tree_digest(output_dir, work_dir),
+        }
+        if result is None:
+            result = run
+        else:
+            if run['digest'] != result['digest']:
+                print("{}: output differs between runs".format(benchmark['name']), file=sys.stderr)
+                return None
+            max_rss_kb = max(result['max_rss_kb'], run['max_rss_kb'])
+            if run['wall'] < result['wall']:
+                result = run
+            result['max_rss_kb'] = max_rss_kb
+    return result
+
+
+def check_regressions(name, result, base, threshold):
+    """ Compare a result with its baseline and return a list of problems """
+    problems = []
+    if result['digest'] != base['digest']:
+        problems.append('output changed')
+    if result['wall'] > base['wall'] * (1 + threshold) and result['wall'] - base['wall'] > MIN_SLOWDOWN:
+        problems.append("{:+0.0f}% wall time".format(100 * (result['wall'] / base['wall'] - 1)))
+    if result['max_rss_kb'] > base['max_rss_kb'] * (1 + threshold):
+        problems.append("{:+0.0f}% peak RSS".format(100 * (result['max_rss_kb'] / base['max_rss_kb'] - 1)))
+    return problems
+
+
+def load_baseline(filename):
+    """ Load saved benchmark results, or return None """
+    try:
+        with open(filename, 'r') as input:
+            baseline = json.load(input)
+    except FileNotFoundError:
+        return None
+    if baseline.get('version') != BASELINE_VERSION:
+        return None
+    return baseline
+
+
+def save_baseline(filename, baseline):
+    """ Save benchmark results """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as output:
+        json.dump(baseline, output, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+#
+# Extract formats benchmark
+#
+
+def get_dir_bytes(path):
+    """ Return the total size of the files in a directory """
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def get_feature_count(filename, bounds):
+    """ Return the number of features in a data file inside an area, from ogrinfo, or None if it fails """
+    result = subprocess.run(
+        ['ogrinfo', '-ro', '-al', '-so', '-spat'] + [str(value) for value in bounds] + [filename],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+    )
+    counts = [int(count) for count in re.findall(r'^Feature Count: (\d+)', result.stdout, re.MULTILINE)]
+    return sum(counts) if result.returncode == 0 and counts else None
+
+
+def benchmark_formats(source, bounds, sql=None, osmconf=None):
+    """ Compare extracting, indexing, and reading an area of a vector source in each of the extract formats
+    Returns True if every format worked and found the same features in the read area.
+
+    """
+    (min_lon, min_lat, max_lon, max_lat,) = bounds
+    lon = math.floor((min_lon + max_lon) / 2)
+    lat = math.floor((min_lat + max_lat) / 2)
+    read_bounds = (lon, lat, lon + 1, lat + 1,)
+
+    ok = True
+    counts = set()
+    print("{:<6} {:>9} {:>9} {:>9} {:>10} {:>9} {:>10}".format('format', 'extract', 'index', 'total', 'size', 'read', 'features'))
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir:
+        for (format, (driver, extension, creation_options,),) in FORMATS.items():
+            format_dir = os.path.join(work_dir, format)
+            os.makedirs(format_dir)
+            filename = os.path.join(format_dir, 'extract' + extension)
+
+            command = ['ogr2ogr', '-f', driver]
+            for option in creation_options:
+                command += ['-lco', option]
+            if osmconf is not None:
+                command += ['-oo', 'CONFIG_FILE=' + osmconf]
+            command += ['-spat'] + [str(value) for value in bounds] + [filename, source]
+            if sql is not None:
+                command += ['-sql', sql]
+            with open(os.devnull, 'wb') as devnull:
+                (status, extract_wall, _,) = instrument.measure(command, stdout=devnull)
+                index_wall = 0
+                if status == 0 and format == 'shp':
+                    (status, index_wall, _,) = instrument.measure(['ogrinfo', '-sql', 'CREATE SPATIAL INDEX ON extract', filename], stdout=devnull)
+                if status == 0:
+                    (status, read_wall, _,) = instrument.measure(
+                        ['ogrinfo', '-ro', '-al', '-q', '-spat'] + [str(value) for value in read_bounds] + [filename], stdout=devnull,
+                    )
+            if status != 0:
+                print("{}: failed with status {}".format(format, status), file=sys.stderr)
+                ok = False
+                continue
+
+            count = get_feature_count(filename, read_bounds)
+            counts.add(count)
+            print("{:<6} {:>9} {:>9} {:>9} {:>10} {:>9} {:>10}".format(
+                format,
+                instrument.format_seconds(extract_wall),
+                instrument.format_seconds(index_wall) if format == 'shp' else '-',
+                instrument.format_seconds(extract_wall + index_wall),
+                instrument.format_bytes(get_dir_bytes(format_dir)),
+                instrument.format_seconds(read_wall),
+                "{:,d}".format(count) if count is not None else '?',
+            ))
+
+    if len(counts) > 1:
+        print("FAILED: the formats found different numbers of features in {}".format(read_bounds), file=sys.stderr)
+        ok = False
+    return ok
+
+
+def benchmark_scripts(airports=20000, repeat=3, only=None, baseline_file=None, save=False, threshold=0.2):
+    """ Benchmark the build scripts on synthetic data
+    Returns True if all outputs matched and nothing regressed.
+
+    """
+    benchmarks = [benchmark for benchmark in SCRIPT_BENCHMARKS if only is None or benchmark['name'] in only]
+    params = {'airports': airports, 'dem_bounds': list(DEM_BOUNDS)}
+
+    baseline = load_baseline(baseline_file) if baseline_file else None
+    if baseline is not None and baseline['params'] != params:
+        print("Baseline in {} used different data; not comparing".format(baseline_file), file=sys.stderr)
+        baseline = None
+
+    ok = True
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir:
+        with open(os.path.join(work_dir, 'apt.dat'), 'w', encoding='latin1') as output:
+            make_apt_dat(output, airports)
+        counts = {
+            'airports': airports,
+            'dem-files': make_dem_tree(os.path.join(work_dir, 'dem'), DEM_BOUNDS),
+            'releases': make_release_dir(os.path.join(work_dir, 'dropbox', 'Downloads')),
+        }
+
+        print("{:<32} {:>8} {:>8} {:>9} {:>14}  {}".format('benchmark', 'wall', 'cpu', 'peak RSS', 'throughput', 'status'))
+        for benchmark in benchmarks:
+            name = benchmark['name']
+            result = run_script_benchmark(benchmark, work_dir, repeat)
+            if result is None:
+                ok = False
+                continue
+            results[name] = result
+
+            problems = []
+            same_as = benchmark.get('same_as')
+            if same_as in results and results[same_as]['digest'] != result['digest']:
+                problems.append("output differs from " + same_as)
+            if baseline is not None and name in baseline['results']:
+                problems += check_regressions(name, result, baseline['results'][name], threshold)
+            ok = ok and not problems
+
+            print("{:<32} {:>8} {:>8} {:>9} {:>14}  {}".format(
+                name,
+                instrument.format_seconds(result['wall']),
+                instrument.format_seconds(result['cpu']),
+                instrument.format_bytes(result['max_rss_kb'] * 1024),
+                "{:,.0f} {}/s".format(counts[benchmark['items']] / max(result['wall'], 1e-9), ITEM_UNITS[benchmark['items']]),
+                'FAILED: ' + ', '.join(problems) if problems else 'ok',
+            ))
+
+    if save and baseline_file:
+        saved = baseline['results'] if baseline is not None else {}
+        saved.update(results)
+        save_baseline(baseline_file, {'version': BASELINE_VERSION, 'params': params, 'results': saved})
+        print("Saved results to {}".format(baseline_file))
+
+    return ok
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} headings [apt.dat]".format(sys.argv[0]), file=sys.stderr)
+    print("       {} parser <apt.dat>".format(sys.argv[0]), file=sys.stderr)
+    print("       {} generate-apt [--airports=N] [--seed=N] <output.dat>".format(sys.argv[0]), file=sys.stderr)
+    print("       {} generate-dem [--style=FABDEM|SRTM-3] [--seed=N] <dem-dir> <min-lon> <min-lat> <max-lon> <max-lat>".format(sys.argv[0]), file=sys.stderr)
+    print("       {} scripts [--airports=N] [--repeat=N] [--only=NAME,...] [--baseline=FILE] [--save] [--threshold=PCT]".format(sys.argv[0]), file=sys.stderr)
+    print("       {} formats [--sql=SQL] [--osmconf=FILE] <source> <min-lon> <min-lat> <max-lon> <max-lat>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    args = sys.argv[2:]
+
+    options = {}
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        options[key] = value
+
+    if command == 'headings' and not options and len(args) <= 1:
+        ok = benchmark_headings(args[0] if args else None)
+
+    elif command == 'parser' and not options and len(args) == 1:
+        ok = benchmark_parser(args[0])
+
+    elif command == 'generate-apt' and set(options) <= {'airports', 'seed'} and len(args) == 1:
+        with open(args[0], 'w', encoding='latin1') as output:
+            make_apt_dat(output, int(options.get('airports', 20000)), int(options.get('seed', 0)))
+        ok = True
+
+    elif command == 'generate-dem' and set(options) <= {'style', 'seed'} and options.get('style', 'FABDEM') in DEM_SUFFIXES and len(args) == 5:
+        count = make_dem_tree(args[0], tuple(int(arg) for arg in args[1:]), options.get('style', 'FABDEM'), int(options.get('seed', 0)))
+        print("Created {} files in {}".format(count, args[0]))
+        ok = True
+
+    elif command == 'scripts' and set(options) <= {'airports', 'repeat', 'only', 'baseline', 'save', 'threshold'} and not args:
+        ok = benchmark_scripts(
+            airports=int(options.get('airports', 20000)),
+            repeat=int(options.get('repeat', 3)),
+            only=options['only'].split(',') if options.get('only') else None,
+            baseline_file=options.get('baseline'),
+            save='save' in options,
+            threshold=float(options.get('threshold', 20)) / 100,
+        )
+
+    elif command == 'formats' and set(options) <= {'sql', 'osmconf'} and len(args) == 5:
+        ok = benchmark_formats(args[0], tuple(float(arg) for arg in args[1:]), options.get('sql'), options.get('osmconf'))
+
+    else:
+        usage()
+
+    sys.exit(0 if ok else 1)
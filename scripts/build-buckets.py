@@ -0,0 +1,328 @@
+""" Build many 10x10 buckets concurrently, using the Makefile for each one
+
+Treats each bucket's preparation (make extract prepare), build (make
+scenery) and archive (make archive) as jobs, and runs jobs from
+different buckets at the same time, up to a maximum number of
+workers. Dependencies:
+
+- each bucket's preparation waits for the OSM PBFs of all the buckets
+  (make osm-split-all), which are clipped in a single pass over the
+  source
+- each bucket's preparation also waits for the landmass store (make
+  landmass-store), which all the buckets share, so that concurrent
+  builds don't all try to build it at once
+- each bucket's build waits for its preparation
+- buckets that touch (at an edge or a corner, including across the
+  antimeridian) never build at the same time, since tg-construct
+  shares the edge files between them in WORK_DIR/Shared (as with the
+  cells of one bucket; see construct-tiles.py), but their
+  preparations can run alongside anything
+- each bucket's archive waits for its build
+- only one archive runs at a time, since archives share the scenery
+  output directory (thresholds are pruned for each bucket)
+
+Job state and runtimes are saved to a JSON file after every change,
+so after a crash or a failure, rerunning the same command skips the
+jobs that already finished. When several jobs are ready, the one that
+took longest last time starts first (jobs with no history go first),
+so that the long buckets don't end up running alone at the end.
+
+Usage:
+
+    python3 build-buckets.py [options] <bucket-list>
+
+Options:
+
+  --jobs=N             number of jobs to run at once (default: 1)
+  --threads=N          THREADS for each make (default: CPU count / jobs)
+  --state=FILE         job-state file (default: flags/build-buckets.json)
+  --log-dir=DIR        where to write each job's make output (default: flags/logs)
+  --no-archive         build scenery only
+  --restart            forget which jobs finished (keep their runtimes)
+  --executor=MOD:CLASS use a different executor (default: LocalExecutor)
+  --dry-run            show the jobs in dependency order without running them
+
+The bucket list has one bucket per line (e.g. config/bucket-list.txt).
+Each job's output goes to <log-dir>/<job>.log
+
+An executor is any class with the same methods as LocalExecutor: its
+constructor takes the number of workers, submit() starts a command and
+returns a concurrent.futures.Future for its exit status, and
+shutdown() waits for everything to stop. For example, an executor
+could run the commands on other hosts with ssh.
+
+"""
+
+import concurrent.futures, importlib, json, os, subprocess, sys, time
+
+from tiles import parse_bucket
+
+
+STATE_VERSION = 1
+
+# Job that clips the OSM PBFs for all the buckets
+OSM_SPLIT_JOB = 'osm-split'
+
+# Job that builds the landmass store for all the buckets
+LANDMASS_STORE_JOB = 'landmass-store'
+
+# Resource that only one archive job can use at a time
+ARCHIVE_RESOURCE = 'scenery-dir'
+
+# Prefix for the resource shared by the build jobs of two touching buckets
+SHARED_EDGES_RESOURCE = 'shared-edges:'
+
+# Job statuses
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+BLOCKED = 'blocked' # a dependency failed
+
+
+class LocalExecutor:
+    """ Run commands as subprocesses on this host """
+
+    def __init__(self, workers):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, command, log_filename):
+        """ Start a command (a list) and return a Future for its exit status """
+        return self.pool.submit(run_command, command, log_filename)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+def run_command(command, log_filename):
+    """ Run a command, sending its output to a log file, and return its exit status """
+    with open(log_filename, 'a') as log:
+        log.write("\n### {} {}\n".format(time.strftime('%Y-%m-%d %H:%M:%S'), ' '.join(command)))
+        log.flush()
+        return subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+
+
+class Job:
+    """ A make command for one bucket (or all of them), with its dependencies """
+
+    __slots__ = ('id', 'command', 'depends', 'resources',)
+
+    def __init__(self, id, command, depends=(), resources=()):
+        self.id = id
+        self.command = command
+        self.depends = list(depends)
+        self.resources = list(resources)
+
+
+def find_neighbours(buckets):
+    """ Return a dict of the set of buckets touching each bucket (at an edge or a corner, including across the antimeridian), by bucket """
+    bounds = {bucket: parse_bucket(bucket) for bucket in buckets}
+    neighbours = {bucket: set() for bucket in buckets}
+    for (bucket, (min_lon, min_lat, max_lon, max_lat,),) in bounds.items():
+        for (other, (other_min_lon, other_min_lat, other_max_lon, other_max_lat,),) in bounds.items():
+            if other != bucket and other_min_lat <= max_lat and min_lat <= other_max_lat \
+               and any(other_min_lon + shift <= max_lon and min_lon <= other_max_lon + shift for shift in (-360, 0, 360,)):
+                neighbours[bucket].add(other)
+    return neighbours
+
+
+def make_jobs(bucket_list, threads, archive=True):
+    """ Return a list of jobs to build (and optionally archive) the buckets in a bucket-list file """
+    jobs = [
+        Job(OSM_SPLIT_JOB, ['make', 'BUCKET_LIST=' + bucket_list, 'THREADS={}'.format(threads), 'osm-split-all']),
+        Job(LANDMASS_STORE_JOB, ['make', 'THREADS={}'.format(threads), 'landmass-store']),
+    ]
+    buckets = list(dict.fromkeys(read_bucket_list(bucket_list)))
+    neighbours = find_neighbours(buckets) # fails early on a bad bucket name
+    for bucket in buckets:
+        jobs.append(Job(
+            'prepare-' + bucket,
+            ['make', 'BUCKET=' + bucket, 'THREADS={}'.format(threads), 'extract', 'prepare'],
+            depends=[OSM_SPLIT_JOB, LANDMASS_STORE_JOB],
+        ))
+        jobs.append(Job(
+            'build-' + bucket,
+            ['make', 'BUCKET=' + bucket, 'THREADS={}'.format(threads), 'scenery'],
+            depends=['prepare-' + bucket],
+            resources=[SHARED_EDGES_RESOURCE + '+'.join(sorted((bucket, other,))) for other in sorted(neighbours[bucket])],
+        ))
+        if archive:
+            jobs.append(Job(
+                'archive-' + bucket,
+                ['make', 'BUCKET=' + bucket, 'THREADS={}'.format(threads), 'archive'],
+                depends=['build-' + bucket],
+                resources=[ARCHIVE_RESOURCE],
+            ))
+    return jobs
+
+
+def read_bucket_list(filename):
+    """ Read bucket names, one per line, skipping blank lines and # comments """
+    with open(filename, 'r') as input:
+        return [line.strip() for line in input if line.strip() and not line.startswith('#')]
+
+
+def load_state(filename):
+    """ Load the saved state of each job, or return an empty dict """
+    try:
+        with open(filename, 'r') as input:
+            state = json.load(input)
+    except FileNotFoundError:
+        return {}
+    if state.get('version') != STATE_VERSION:
+        return {}
+    return state['jobs']
+
+
+def save_state(filename, job_states):
+    """ Save the state of each job """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as output:
+        json.dump({'version': STATE_VERSION, 'jobs': job_states}, output, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def get_ready_jobs(jobs, job_states, busy_resources):
+    """ Return the pending jobs whose dependencies are done and resources are free, longest first """
+    ready = [
+        job for job in jobs
+        if job_states[job.id]['status'] == PENDING
+        and all(job_states[dep]['status'] == DONE for dep in job.depends)
+        and not any(resource in busy_resources for resource in job.resources)
+    ]
+    return sorted(ready, key=lambda job: -job_states[job.id].get('runtime', float('inf')))
+
+
+def block_dependents(jobs, job_states, failed_id):
+    """ Mark every job that depends (directly or not) on a failed job as blocked """
+    blocked = {failed_id}
+    changed = True
+    while changed:
+        changed = False
+        for job in jobs:
+            if job.id not in blocked and job_states[job.id]['status'] == PENDING and any(dep in blocked for dep in job.depends):
+                job_states[job.id]['status'] = BLOCKED
+                blocked.add(job.id)
+                changed = True
+
+
+def run_jobs(jobs, executor, workers, state_file, log_dir, restart=False):
+    """ Run jobs with an executor, respecting dependencies and resources
+    Returns a list of the ids of jobs that failed or were blocked
+
+    """
+    job_states = load_state(state_file)
+    for job in jobs:
+        job_state = job_states.setdefault(job.id, {})
+        if restart or job_state.get('status') != DONE:
+            job_state['status'] = PENDING
+    save_state(state_file, job_states)
+
+    os.makedirs(log_dir, exist_ok=True)
+    running = {}
+    busy_resources = set()
+
+    while True:
+        for job in get_ready_jobs(jobs, job_states, busy_resources):
+            if len(running) >= workers:
+                break
+            if any(resource in busy_resources for resource in job.resources):
+                continue
+            print("Starting {}".format(job.id))
+            future = executor.submit(job.command, os.path.join(log_dir, job.id + '.log'))
+            running[future] = (job, time.time(),)
+            busy_resources.update(job.resources)
+            job_states[job.id]['status'] = RUNNING
+        save_state(state_file, job_states)
+
+        if not running:
+            break
+
+        (finished, _,) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            (job, start,) = running.pop(future)
+            busy_resources.difference_update(job.resources)
+            job_state = job_states[job.id]
+            job_state['runtime'] = round(time.time() - start, 1)
+            try:
+                status = future.result()
+            except Exception as e:
+                print("{}: {}".format(job.id, e), file=sys.stderr)
+                status = -1
+            if status == 0:
+                job_state['status'] = DONE
+                print("Finished {} in {:0.0f} s".format(job.id, job_state['runtime']))
+            else:
+                job_state['status'] = FAILED
+                block_dependents(jobs, job_states, job.id)
+                print("FAILED {} with status {} (see {})".format(job.id, status, os.path.join(log_dir, job.id + '.log')), file=sys.stderr)
+        save_state(state_file, job_states)
+
+    return [job.id for job in jobs if job_states[job.id]['status'] in (FAILED, BLOCKED,)]
+
+
+def load_executor(name):
+    """ Load an executor class from a module:Class name """
+    (module_name, _, class_name,) = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--jobs=N] [--threads=N] [--state=FILE] [--log-dir=DIR] [--no-archive] [--restart] [--executor=MOD:CLASS] [--dry-run] <bucket-list>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    options = {
+        'jobs': '1',
+        'threads': None,
+        'state': 'flags/build-buckets.json',
+        'log-dir': 'flags/logs',
+        'executor': None,
+    }
+    flags = set()
+
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key in ('no-archive', 'restart', 'dry-run',) and not value:
+            flags.add(key)
+        elif key in options and value:
+            options[key] = value
+        else:
+            usage()
+
+    if len(args) != 1:
+        usage()
+
+    workers = int(options['jobs'])
+    threads = int(options['threads']) if options['threads'] else max(1, (os.cpu_count() or 1) // workers)
+
+    jobs = make_jobs(args[0], threads, archive='no-archive' not in flags)
+
+    if 'dry-run' in flags:
+        for job in jobs:
+            print("{}: {}{}".format(job.id, ' '.join(job.command), " (after {})".format(', '.join(job.depends)) if job.depends else ''))
+        sys.exit(0)
+
+    # measure the whole fleet as one run (see instrument.py)
+    os.environ.setdefault('INSTRUMENT_RUN', time.strftime('%Y%m%dT%H%M%S'))
+
+    executor_class = load_executor(options['executor']) if options['executor'] else LocalExecutor
+    executor = executor_class(workers)
+    try:
+        failed = run_jobs(jobs, executor, workers, options['state'], options['log-dir'], restart='restart' in flags)
+    finally:
+        executor.shutdown()
+
+    if failed:
+        print("Failed or blocked: {}".format(' '.join(failed)), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
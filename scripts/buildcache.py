@@ -0,0 +1,220 @@
+""" Content-hash build cache for scenery stages
+
+The flag files in flags/<bucket> only record when a stage last ran,
+so touching a script or editing one row of a layers TSV reruns every
+downstream stage. This module computes a key for a stage from the
+things that actually affect its output:
+
+- the content of its input files (shapefiles include their .shx,
+  .dbf, .prj, and .cpg siblings)
+- the executables of the tools it runs (standing in for versions)
+- named parameters, such as Makefile options
+
+A stage is skipped when its key matches the one saved after its last
+successful run (and its outputs still exist).
+
+File hashes are cached by path, size, and mtime in hashes.json in the
+state directory, so large inputs are read only when they change.
+
+Command-line usage (e.g. from the Makefile):
+
+    python3 buildcache.py check [options] <state-dir> <stage> [input-file...]
+    python3 buildcache.py record [options] <state-dir> <stage> [input-file...]
+
+Options:
+
+  --tool=NAME          include the executable NAME from PATH
+  --param=NAME=VALUE   include a named parameter
+  --output=PATH        (check only) the stage is out of date if PATH doesn't exist
+
+check exits with status 0 if the stage is up to date, or 1 if it
+needs to run. record saves the current key after the stage succeeds.
+
+"""
+
+import hashlib, json, os, shutil, sys
+
+
+# Increase to invalidate all saved keys if the way they're calculated changes
+KEY_VERSION = 1
+
+HASHES_FILENAME = 'hashes.json'
+
+# Files that belong with a shapefile
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg',)
+
+# Bytes to read at a time when hashing a file
+READ_SIZE = 1024 * 1024
+
+
+#
+# File hashes
+#
+
+def load_hashes(state_dir):
+    """ Load the cache of file hashes from the state directory, or return an empty dict """
+    try:
+        with open(os.path.join(state_dir, HASHES_FILENAME), 'r') as input:
+            return json.load(input)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_hashes(state_dir, hashes):
+    """ Save the cache of file hashes to the state directory """
+    os.makedirs(state_dir, exist_ok=True)
+    filename = os.path.join(state_dir, HASHES_FILENAME)
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, 'w') as output:
+        json.dump(hashes, output, separators=(',', ':',))
+    os.replace(tmp_filename, filename)
+
+
+def hash_file(filename, hashes):
+    """ Return the SHA-256 hex digest of a file, reusing the cached hash if its size and mtime haven't changed """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    entry = hashes.get(path)
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+        return entry[2]
+
+    hash = hashlib.sha256()
+    with open(path, 'rb') as input:
+        for block in iter(lambda: input.read(READ_SIZE), b''):
+            hash.update(block)
+    digest = hash.hexdigest()
+    hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+
+def expand_inputs(filenames):
+    """ Add the sibling files of any shapefiles to a list of input files
+    Returns a sorted list without duplicates
+
+    """
+    result = set()
+    for filename in filenames:
+        result.add(filename)
+        (base, ext,) = os.path.splitext(filename)
+        if ext.lower() == '.shp':
+            for sibling_ext in SHAPEFILE_EXTENSIONS:
+                if os.path.exists(base + sibling_ext):
+                    result.add(base + sibling_ext)
+    return sorted(result)
+
+
+def hash_tool(name, hashes):
+    """ Return a hash identifying the version of an executable, or "missing" if it isn't in PATH """
+    path = shutil.which(name)
+    if path is None:
+        return 'missing'
+    return hash_file(os.path.realpath(path), hashes)
+
+
+#
+# Stage keys
+#
+
+def make_key(hashes, files=(), tools=(), params=None):
+    """ Return the key for a stage from its input files, tools, and parameters
+
+    Parameters:
+
+      hashes: the file-hash cache (see load_hashes()), updated in place
+
+      files: a list of input filenames (order doesn't matter)
+
+      tools: a list of executable names
+
+      params: a dict of parameter names and values
+
+    """
+    data = {
+        'version': KEY_VERSION,
+        'files': {os.path.abspath(filename): hash_file(filename, hashes) for filename in expand_inputs(files)},
+        'tools': {name: hash_tool(name, hashes) for name in tools},
+        'params': {name: str(value) for name, value in (params or {}).items()},
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def key_path(state_dir, stage):
+    return os.path.join(state_dir, stage + '.key')
+
+
+def is_current(state_dir, stage, key, outputs=()):
+    """ Check whether a stage last succeeded with the same key, and all its outputs still exist """
+    for output in outputs:
+        if not os.path.exists(output):
+            return False
+    try:
+        with open(key_path(state_dir, stage), 'r') as input:
+            return input.read().strip() == key
+    except FileNotFoundError:
+        return False
+
+
+def record(state_dir, stage, key):
+    """ Save the key for a stage after it succeeds """
+    os.makedirs(state_dir, exist_ok=True)
+    with open(key_path(state_dir, stage), 'w') as output:
+        output.write(key + "\n")
+
+
+def forget(state_dir, stage):
+    """ Remove the saved key for a stage, so that it will run next time """
+    try:
+        os.remove(key_path(state_dir, stage))
+    except FileNotFoundError:
+        pass
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} check|record [--tool=NAME] [--param=NAME=VALUE] [--output=PATH] <state-dir> <stage> [input-file...]".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    if not args or args[0] not in ('check', 'record',):
+        usage()
+    command = args.pop(0)
+
+    tools = []
+    params = {}
+    outputs = []
+    while args and args[0].startswith('--'):
+        (option, _, value,) = args.pop(0).partition('=')
+        if option == '--tool' and value:
+            tools.append(value)
+        elif option == '--param' and '=' in value:
+            (name, _, value,) = value.partition('=')
+            params[name] = value
+        elif option == '--output' and value:
+            outputs.append(value)
+        else:
+            usage()
+
+    if len(args) < 2:
+        usage()
+
+    (state_dir, stage,) = args[:2]
+    files = args[2:]
+
+    hashes = load_hashes(state_dir)
+    key = make_key(hashes, files, tools, params)
+    save_hashes(state_dir, hashes)
+
+    if command == 'check':
+        if is_current(state_dir, stage, key, outputs):
+            print("{} is up to date".format(stage), file=sys.stderr)
+            sys.exit(0)
+        sys.exit(1)
+    else:
+        record(state_dir, stage, key)
+        sys.exit(0)
@@ -0,0 +1,314 @@
+""" Run tg-construct for an area in small units, several at a time
+
+Replaces the serial loop in the Makefile's scenery target. The area
+is split into 1x1 deg cells (or single scenery tiles, using the same
+tile numbering as tiles.py and tg-construct's --tile-id), and each
+unit is a separate tg-construct process. Up to --jobs units run at
+once.
+
+Units start largest first, so that a big unit doesn't end up running
+alone at the end. A unit's size is its wall time from the last
+successful run (saved in the history file), or, for units with no
+history, an estimate from the size of its work files in each area
+directory (scaled to seconds using the units that do have history).
+The units wait in a single queue, and whenever a worker is free, it
+takes the largest unit left, so fast workers pick up the work that
+slow ones haven't got to yet.
+
+Units that touch (at an edge or a corner) never run at the same time,
+because tg-construct shares the edges between them through the files
+in <work-dir>/Shared, and one unit could otherwise read a neighbour's
+edge files while the neighbour is still writing them. A free worker
+skips any unit with a running neighbour, and takes the largest unit
+that has none.
+
+A failed unit is retried, and the other units carry on. Each run is
+measured for the timings log (see instrument.py).
+
+Usage:
+
+    python3 construct-tiles.py [options] <min-lon> <min-lat> <max-lon> <max-lat> -- <tg-construct options and areas...>
+
+Options:
+
+  --jobs=N        number of tg-construct processes to run at once (default: 1)
+  --unit=UNIT     "cell" for 1x1 deg cells or "tile" for single tiles (default: cell)
+  --retries=N     times to retry a failed unit (default: 1)
+  --history=FILE  JSON file of past wall times for each unit (default: none)
+  --log-dir=DIR   where to write each unit's output (default: ./temp/construct-logs)
+  --bucket=BUCKET the bucket being built (for the timings log)
+
+tg-construct's --work-dir option and its area arguments (the words
+after -- that aren't options) are used to find the work files for the
+size estimates.
+
+Example (from the Makefile):
+
+    python3 construct-tiles.py --jobs=4 --unit=cell -80 40 -70 50 -- \\
+        --threads=8 --work-dir=./03-work --output-dir=./04-output/Terrain SRTM-3/DEM Default osm-road
+
+"""
+
+import concurrent.futures, json, os, subprocess, sys, time
+
+import instrument
+
+from math import floor
+from tiles import get_bucket, get_cell, tile_bounds, tiles_in_bbox
+
+
+HISTORY_VERSION = 1
+
+UNIT_TYPES = ('cell', 'tile',)
+
+# Seconds to wait before the first retry (doubles for each later retry)
+RETRY_DELAY = 5
+
+# Tolerance (in degrees) for deciding whether two units touch
+TOUCH_EPSILON = 1e-9
+
+
+class Unit:
+    """ A part of the area to build with one tg-construct run """
+
+    __slots__ = ('id', 'bounds', 'tile', 'estimate',)
+
+    def __init__(self, id, bounds, tile=None):
+        self.id = id
+        self.bounds = bounds
+        self.tile = tile
+        self.estimate = 0
+
+    def get_args(self):
+        """ Return the tg-construct options that select this unit """
+        if self.tile is not None:
+            return ['--tile-id={}'.format(self.tile)]
+        (min_lon, min_lat, max_lon, max_lat,) = self.bounds
+        return ['--min-lat={:g}'.format(min_lat), '--min-lon={:g}'.format(min_lon), '--max-lat={:g}'.format(max_lat), '--max-lon={:g}'.format(max_lon)]
+
+
+def make_units(bounds, unit_type='cell'):
+    """ Split an area into cells or tiles """
+    (min_lon, min_lat, max_lon, max_lat,) = bounds
+    if unit_type == 'tile':
+        # stay just inside the edges, so that neighbouring tiles aren't included
+        return [
+            Unit('tile-{}'.format(tile), tile_bounds(tile), tile)
+            for tile in tiles_in_bbox(min_lon, min_lat, max_lon - 1e-9, max_lat - 1e-9)
+        ]
+    units = []
+    for lat in range(int(floor(min_lat)), int(floor(max_lat - 1e-9)) + 1):
+        for lon in range(int(floor(min_lon)), int(floor(max_lon - 1e-9)) + 1):
+            units.append(Unit(get_cell(lon, lat), (max(lon, min_lon), max(lat, min_lat), min(lon + 1, max_lon), min(lat + 1, max_lat),)))
+    return units
+
+
+def find_neighbours(units):
+    """ Return a dict of the set of ids of the units touching each unit (at an edge or a corner), by unit id """
+    # index the units by the 1x1 deg cells they're in, so that only nearby units are compared
+    grid = {}
+    for unit in units:
+        (min_lon, min_lat, max_lon, max_lat,) = unit.bounds
+        for lon in range(int(floor(min_lon)), int(floor(max_lon - TOUCH_EPSILON)) + 1):
+            for lat in range(int(floor(min_lat)), int(floor(max_lat - TOUCH_EPSILON)) + 1):
+                grid.setdefault((lon, lat,), []).append(unit)
+
+    neighbours = {unit.id: set() for unit in units}
+    for unit in units:
+        (min_lon, min_lat, max_lon, max_lat,) = unit.bounds
+        for lon in range(int(floor(min_lon)) - 1, int(floor(max_lon - TOUCH_EPSILON)) + 2):
+            for lat in range(int(floor(min_lat)) - 1, int(floor(max_lat - TOUCH_EPSILON)) + 2):
+                for other in grid.get((lon, lat,), ()):
+                    if other.id != unit.id \
+                       and other.bounds[0] <= max_lon + TOUCH_EPSILON and min_lon <= other.bounds[2] + TOUCH_EPSILON \
+                       and other.bounds[1] <= max_lat + TOUCH_EPSILON and min_lat <= other.bounds[3] + TOUCH_EPSILON:
+                        neighbours[unit.id].add(other.id)
+    return neighbours
+
+
+def get_work_bytes(unit, work_dir, areas):
+    """ Return the total size of a unit's work files in all the area directories
+    Work files are in <work-dir>/<area>/<bucket>/<cell>/, named after the tile index.
+
+    """
+    (min_lon, min_lat, _, _,) = unit.bounds
+    subdir = os.path.join(get_bucket(min_lon, min_lat), get_cell(min_lon, min_lat))
+    prefix = '{}.'.format(unit.tile) if unit.tile is not None else ''
+    total = 0
+    for area in areas:
+        try:
+            entries = os.scandir(os.path.join(work_dir, area, subdir))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and entry.is_file():
+                    total += entry.stat().st_size
+    return total
+
+
+def add_estimates(units, history, work_dir, areas):
+    """ Set each unit's estimated wall time from its history, or from the size of its work files """
+    sizes = {unit.id: get_work_bytes(unit, work_dir, areas) for unit in units}
+
+    # seconds per byte, from the units that have both a history and work files
+    known = [unit.id for unit in units if unit.id in history and sizes[unit.id]]
+    rate = sum(history[id] for id in known) / sum(sizes[id] for id in known) if known else 1
+
+    for unit in units:
+        unit.estimate = history[unit.id] if unit.id in history else sizes[unit.id] * rate
+
+
+def load_history(filename):
+    """ Load the last successful wall time of each unit, or return an empty dict """
+    if filename is None:
+        return {}
+    try:
+        with open(filename, 'r') as input:
+            history = json.load(input)
+    except FileNotFoundError:
+        return {}
+    if history.get('version') != HISTORY_VERSION:
+        return {}
+    return history['units']
+
+
+def save_history(filename, history):
+    """ Save the last successful wall time of each unit """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as output:
+        json.dump({'version': HISTORY_VERSION, 'units': history}, output, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def construct_unit(unit, tg_opts, areas, log_dir, bucket, retries):
+    """ Run tg-construct for one unit, retrying on failure
+    Returns a tuple (ok, attempts, seconds,), where seconds is the wall time of the last attempt
+
+    """
+    command = ['tg-construct'] + list(tg_opts) + unit.get_args() + list(areas)
+    log_filename = os.path.join(log_dir, unit.id + '.log')
+
+    attempts = 0
+    while True:
+        attempts += 1
+        start = time.perf_counter()
+        with open(log_filename, 'w') as log:
+            status = instrument.run(
+                command, stage='tg-construct', layer=unit.id, bucket=bucket,
+                stdout=log, stderr=subprocess.STDOUT,
+            )
+        if status == 0:
+            return (True, attempts, time.perf_counter() - start,)
+        if attempts > retries:
+            return (False, attempts, time.perf_counter() - start,)
+        print("{}: tg-construct failed with status {}; retrying".format(unit.id, status), file=sys.stderr)
+        time.sleep(RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def construct_units(units, tg_opts, areas, log_dir, bucket=None, jobs=1, retries=1, history_file=None):
+    """ Build a list of units, up to jobs at a time, largest first, never running two units that touch at once
+    Returns a list of the ids of units that failed
+
+    """
+    history = load_history(history_file)
+    os.makedirs(log_dir, exist_ok=True)
+    neighbours = find_neighbours(units)
+
+    pending = sorted(units, key=lambda unit: -unit.estimate)
+    running = {}
+    running_ids = set()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # start the largest units that have no running neighbours
+            for unit in list(pending):
+                if len(running) >= jobs:
+                    break
+                if neighbours[unit.id] & running_ids:
+                    continue
+                pending.remove(unit)
+                running[executor.submit(construct_unit, unit, tg_opts, areas, log_dir, bucket, retries)] = unit
+                running_ids.add(unit.id)
+
+            (finished, _,) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                unit = running.pop(future)
+                running_ids.discard(unit.id)
+                (ok, attempts, seconds,) = future.result()
+                if ok:
+                    history[unit.id] = round(seconds, 1)
+                    if history_file is not None:
+                        save_history(history_file, history)
+                    print("{}: done in {:0.1f} s".format(unit.id, seconds))
+                else:
+                    failed.append(unit.id)
+                    print("{}: FAILED after {} attempts (see {})".format(unit.id, attempts, os.path.join(log_dir, unit.id + '.log')), file=sys.stderr)
+
+    return sorted(failed)
+
+
+def get_work_dir(tg_opts):
+    """ Return the value of tg-construct's --work-dir option, or "." """
+    for opt in tg_opts:
+        if opt.startswith('--work-dir='):
+            return opt[11:]
+    return '.'
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--jobs=N] [--unit=cell|tile] [--retries=N] [--history=FILE] [--log-dir=DIR] [--bucket=BUCKET] <min-lon> <min-lat> <max-lon> <max-lat> -- <tg-construct options and areas...>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    options = {
+        'jobs': '1',
+        'unit': 'cell',
+        'retries': '1',
+        'history': None,
+        'log-dir': './temp/construct-logs',
+        'bucket': None,
+    }
+
+    args = sys.argv[1:]
+    if '--' not in args:
+        usage()
+    construct_args = args[args.index('--')+1:]
+    args = args[:args.index('--')]
+
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in options:
+            usage()
+        elif value: # empty values (e.g. --bucket= with no BUCKET) are ignored
+            options[key] = value
+
+    if len(args) != 4 or options['unit'] not in UNIT_TYPES:
+        usage()
+
+    bounds = tuple(float(arg) for arg in args)
+    tg_opts = [arg for arg in construct_args if arg.startswith('-')]
+    areas = [arg for arg in construct_args if not arg.startswith('-')]
+
+    units = make_units(bounds, options['unit'])
+    add_estimates(units, load_history(options['history']), get_work_dir(tg_opts), areas)
+    jobs = int(options['jobs'])
+    print("Constructing {} {}s, {} at a time".format(len(units), options['unit'], jobs))
+
+    failed = construct_units(
+        units, tg_opts, areas, options['log-dir'],
+        bucket=options['bucket'], jobs=jobs, retries=int(options['retries']), history_file=options['history'],
+    )
+
+    if failed:
+        print("Failed units: {}".format(' '.join(failed)), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,293 @@
+""" Run ogr-decode for the layers in a layers TSV file, several at a time
+
+Replaces the serial shell loop over config/landcover-layers.tsv and
+config/osm-layers.tsv. The layers don't depend on each other, so they
+are decoded concurrently, as many at once as the CPU and memory
+budgets allow. Each layer is decoded into <temp-dir>/<name>, then
+moved to <work-dir>/<name>/<bucket> when it succeeds. Its output goes
+to <temp-dir>/<name>/<bucket>.log, so that buckets decoded at the same
+time don't share logs. Each ogr-decode run is measured for the timings
+log (see instrument.py).
+
+The shapefile can also be a FlatGeobuf (.fgb) or GeoPackage (.gpkg)
+file (see EXTRACT_FORMAT in the Makefile).
+
+With --partition-dir, the shapefile is first split into one small
+file per layer, in the same format, in a single pass (see
+partition.py), and each
+ogr-decode reads only its own layer's file, with no --where. A feature
+matching more than one query is copied to every one of those layers,
+as with separate --where queries (e.g. a highway goes to both its
+easement layer and its road layer), and tg-construct's material
+priorities settle the overlaps. The split is skipped if the shapefile and queries haven't
+changed since the last one.
+
+A failed layer is retried (after cleaning its temp directory), and
+the other layers carry on. If --state-dir is given, the build cache
+(see buildcache.py) records a key for each finished layer, made from
+its TSV row and other ogr-decode options, the shapefile's content
+(or its own partition's), and the ogr-decode executable. A layer is skipped if its key hasn't
+changed and its <work-dir>/<name>/<bucket> directory still exists (it's
+created even when ogr-decode writes nothing), so rerunning after a
+failure or after editing one TSV row decodes only the layers that
+need it.
+
+Usage:
+
+    python3 decode-layers.py [options] <layers.tsv> <area|line> <shapefile> -- [ogr-decode options...]
+
+Options:
+
+  --bucket=BUCKET      the bucket being built (required)
+  --temp-dir=DIR       where ogr-decode writes (default: ./temp)
+  --work-dir=DIR       where finished layers go (default: ./03-work)
+  --state-dir=DIR      build-cache directory for finished layers (default: none)
+  --partition-dir=DIR  split the shapefile into per-layer files here first (default: don't)
+  --cpus=N             total CPU budget (default: 1)
+  --job-threads=N      threads used by each ogr-decode (default: 1)
+  --memory=MB          total memory budget (default: no limit)
+  --job-memory=MB      estimated memory for each ogr-decode (default: 2048)
+  --retries=N          times to retry a failed layer (default: 1)
+
+The number of concurrent layers is cpus / job-threads, reduced if
+needed so that the estimated memory stays within the memory budget.
+
+Example (from the Makefile):
+
+    python3 decode-layers.py --bucket=w080n40 --cpus=32 --job-threads=4 \
+        config/osm-layers.tsv area 02-prep/osm/w080n40/osm-areas.shp -- --spat -81 39 -69 51 --threads 4
+
+"""
+
+import concurrent.futures, os, shutil, subprocess, sys, time
+
+import buildcache, instrument, partition
+
+from partition import read_layers
+
+# Seconds to wait before the first retry (doubles for each later retry)
+RETRY_DELAY = 5
+
+# Lines of ogr-decode output to show for a failed layer
+LOG_TAIL_LINES = 20
+
+
+def get_command(layer, shapefile, temp_dir, decode_opts, where=True):
+    """ Return the ogr-decode command line for a layer, as a list
+    If where is False, the shapefile has only the layer's features, so the query is left out.
+
+    """
+    command = ['ogr-decode'] + list(decode_opts)
+    if layer['type'] == 'line':
+        command += ['--texture-lines', '--line-width', layer['line_width']]
+    command += ['--area-type', layer['material']]
+    if where:
+        command += ['--where', layer['query']]
+    command += [os.path.join(temp_dir, layer['name']), shapefile]
+    return command
+
+
+def get_concurrency(cpus, job_threads, memory=None, job_memory=2048):
+    """ Return the number of layers to decode at once within the CPU and memory budgets """
+    jobs = max(1, cpus // max(1, job_threads))
+    if memory is not None:
+        jobs = min(jobs, max(1, memory // max(1, job_memory)))
+    return jobs
+
+
+def get_key(command, shapefile, hashes):
+    """ Return the build-cache key for a layer
+    The --threads option doesn't affect the output, so it's left out.
+
+    """
+    params = []
+    skip = False
+    for arg in command:
+        if skip:
+            skip = False
+        elif arg == '--threads':
+            skip = True
+        else:
+            params.append(arg)
+    return buildcache.make_key(hashes, files=[shapefile], tools=['ogr-decode'], params={'command': '\0'.join(params)})
+
+
+def decode_layer(layer, command, bucket, temp_dir, work_dir, retries):
+    """ Decode one layer, retrying on failure, and move the result into work_dir
+    Returns a tuple (ok, attempts, seconds,)
+
+    """
+    name = layer['name']
+    temp_layer_dir = os.path.join(temp_dir, name)
+    temp_bucket_dir = os.path.join(temp_layer_dir, bucket)
+    log_filename = os.path.join(temp_layer_dir, bucket + '.log')
+
+    start = time.perf_counter()
+    attempts = 0
+    while True:
+        attempts += 1
+        shutil.rmtree(temp_bucket_dir, ignore_errors=True)
+        os.makedirs(temp_layer_dir, exist_ok=True)
+        with open(log_filename, 'w') as log:
+            status = instrument.run(
+                command, stage='decode-{}s'.format(layer['type']), layer=name, bucket=bucket, outputs=[temp_bucket_dir],
+                stdout=log, stderr=subprocess.STDOUT,
+            )
+        if status == 0:
+            break
+        if attempts > retries:
+            print_log_tail(name, log_filename)
+            return (False, attempts, time.perf_counter() - start,)
+        print("{}: ogr-decode failed with status {}; retrying".format(name, status), file=sys.stderr)
+        time.sleep(RETRY_DELAY * 2 ** (attempts - 1))
+
+    work_bucket_dir = os.path.join(work_dir, name, bucket)
+    shutil.rmtree(work_bucket_dir, ignore_errors=True)
+    if os.path.isdir(temp_bucket_dir):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+        shutil.move(temp_bucket_dir, work_bucket_dir)
+    else:
+        # an empty layer still needs its directory, for the build cache (see decode_layers)
+        os.makedirs(work_bucket_dir, exist_ok=True)
+
+    return (True, attempts, time.perf_counter() - start,)
+
+
+def print_log_tail(name, log_filename):
+    """ Show the end of a failed layer's ogr-decode output """
+    with open(log_filename, 'r', errors='replace') as input:
+        lines = input.readlines()[-LOG_TAIL_LINES:]
+    print("{}: ogr-decode failed; last lines of {}:".format(name, log_filename), file=sys.stderr)
+    for line in lines:
+        print("  " + line, end='', file=sys.stderr)
+
+
+def partition_shapefile(layers, shapefile, partition_dir, state_dir=None):
+    """ Split a shapefile into one file per layer, unless the build cache shows the split is current """
+    stage = 'partition-' + os.path.splitext(os.path.basename(shapefile))[0]
+    key = None
+    if state_dir is not None:
+        hashes = buildcache.load_hashes(state_dir)
+        key = buildcache.make_key(
+            hashes, files=[shapefile, partition.__file__],
+            params={
+                'queries': '\0'.join(layer['name'] + '\t' + layer['query'] for layer in layers),
+                'all_matches': 'yes',
+            },
+        )
+        buildcache.save_hashes(state_dir, hashes)
+        outputs = [partition.layer_path(partition_dir, layer['name'], partition.get_format(shapefile)) for layer in layers]
+        if buildcache.is_current(state_dir, stage, key, outputs):
+            print("{}: unchanged".format(stage))
+            return
+
+    start = time.perf_counter()
+    counts = partition.partition_layers(layers, shapefile, partition_dir, all_matches=True)
+    print("{}: split {} features into {} layers in {:0.1f} s".format(stage, sum(counts.values()), len(counts), time.perf_counter() - start))
+    if key is not None:
+        buildcache.record(state_dir, stage, key)
+
+
+def decode_layers(layers, shapefile, bucket, temp_dir, work_dir, decode_opts, jobs=1, retries=1, state_dir=None, partition_dir=None):
+    """ Decode a list of layers, up to jobs at a time
+    If partition_dir is not None, split the shapefile into per-layer files there first.
+    Returns a list of the names of layers that failed
+
+    """
+    if partition_dir is not None:
+        partition_shapefile(layers, shapefile, partition_dir, state_dir)
+
+    hashes = buildcache.load_hashes(state_dir) if state_dir is not None else {}
+    pending = []
+    for layer in layers:
+        layer_shapefile = partition.layer_path(partition_dir, layer['name'], partition.get_format(shapefile)) if partition_dir is not None else shapefile
+        command = get_command(layer, layer_shapefile, temp_dir, decode_opts, where=partition_dir is None)
+        key = get_key(command, layer_shapefile, hashes) if state_dir is not None else None
+        if key is not None and buildcache.is_current(state_dir, layer['name'], key, [os.path.join(work_dir, layer['name'], bucket)]):
+            print("{}: unchanged".format(layer['name']))
+        else:
+            pending.append((layer, command, key,))
+    if state_dir is not None:
+        buildcache.save_hashes(state_dir, hashes)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(decode_layer, layer, command, bucket, temp_dir, work_dir, retries): (layer, key,)
+            for (layer, command, key,) in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            (layer, key,) = futures[future]
+            (ok, attempts, seconds,) = future.result()
+            if ok:
+                if key is not None:
+                    buildcache.record(state_dir, layer['name'], key)
+                print("{}: done in {:0.1f} s".format(layer['name'], seconds))
+            else:
+                failed.append(layer['name'])
+                print("{}: FAILED after {} attempts".format(layer['name'], attempts), file=sys.stderr)
+
+    return sorted(failed)
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [options] <layers.tsv> <area|line> <shapefile> -- [ogr-decode options...]".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    options = {
+        'bucket': None,
+        'temp-dir': './temp',
+        'work-dir': './03-work',
+        'state-dir': None,
+        'partition-dir': None,
+        'cpus': '1',
+        'job-threads': '1',
+        'memory': None,
+        'job-memory': '2048',
+        'retries': '1',
+    }
+
+    args = sys.argv[1:]
+    decode_opts = []
+    if '--' in args:
+        decode_opts = args[args.index('--')+1:]
+        args = args[:args.index('--')]
+
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in options or not value:
+            usage()
+        options[key] = value
+
+    if len(args) != 3 or args[1] not in ('area', 'line',) or options['bucket'] is None:
+        usage()
+
+    (tsv_file, type, shapefile,) = args
+
+    jobs = get_concurrency(
+        int(options['cpus']),
+        int(options['job-threads']),
+        int(options['memory']) if options['memory'] else None,
+        int(options['job-memory']),
+    )
+
+    layers = read_layers(tsv_file, type)
+    print("Decoding {} {} layers, {} at a time".format(len(layers), type, jobs))
+
+    failed = decode_layers(
+        layers, shapefile, options['bucket'], options['temp-dir'], options['work-dir'], decode_opts,
+        jobs=jobs, retries=int(options['retries']), state_dir=options['state-dir'], partition_dir=options['partition-dir'],
+    )
+
+    if failed:
+        print("Failed layers: {}".format(' '.join(failed)), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
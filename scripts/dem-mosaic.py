@@ -0,0 +1,163 @@
+""" Build a VRT mosaic of DEM files for gdalchop
+
+Passing gdalchop hundreds of 1x1 deg DEM files (from list-dem.py)
+makes it open them all at once. A VRT mosaic is a single small GDAL
+dataset that refers to the files, so gdalchop reads just the windows
+it needs, and a smaller area can be chopped by clipping the mosaic
+(--bounds) instead of finding the right files by hand.
+
+With --cog-dir, each source file is first converted to a tiled,
+compressed, cloud-optimized GeoTIFF (losslessly), and the mosaic
+refers to those instead. A file is converted only if its COG is
+missing or older than the source, several at a time. The COGs keep
+the source's path relative to --source-dir, with a .tif extension.
+
+Each gdal_translate and gdalbuildvrt run is measured for the timings
+log (see instrument.py).
+
+Usage:
+
+    python3 dem-mosaic.py [options] <output.vrt> <dem-file...>
+
+Options:
+
+  --bounds=MIN_LON,MIN_LAT,MAX_LON,MAX_LAT  clip the mosaic to an area
+  --cog-dir=DIR     convert the sources to COGs in DIR first
+  --source-dir=DIR  the top of the source tree, for COG paths (default: common parent of the files)
+  --jobs=N          COG conversions to run at once (default: 1)
+  --bucket=BUCKET   the bucket being built (for the timings log)
+
+Example (from the Makefile):
+
+    python3 dem-mosaic.py --bucket=w080n40 02-prep/dem/FABDEM/w080n40.vrt $(python3 list-dem.py 01-inputs/FABDEM/Unpacked w080n40)
+
+"""
+
+import concurrent.futures, os, sys, tempfile
+
+import instrument
+
+
+# gdal_translate options for the COGs (DEFLATE with a predictor is lossless and suits elevations)
+COG_OPTS = ('-of', 'COG', '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=2', '-co', 'BLOCKSIZE=512', '-co', 'OVERVIEWS=NONE',)
+
+
+def get_cog_path(filename, source_dir, cog_dir):
+    """ Return the COG path for a source file, keeping its place in the source tree """
+    relpath = os.path.relpath(os.path.abspath(filename), os.path.abspath(source_dir))
+    if relpath.startswith('..'):
+        raise ValueError("{} is not under {}".format(filename, source_dir))
+    return os.path.join(cog_dir, os.path.splitext(relpath)[0] + '.tif')
+
+
+def needs_conversion(source, cog):
+    """ Check whether a COG is missing or older than its source """
+    try:
+        return os.path.getmtime(cog) < os.path.getmtime(source)
+    except FileNotFoundError:
+        return True
+
+
+def convert_to_cog(source, cog, bucket=None):
+    """ Convert a DEM file to a COG, writing to a temporary file first
+    Returns the exit status of gdal_translate
+
+    """
+    os.makedirs(os.path.dirname(cog), exist_ok=True)
+    tmp_cog = cog + '.tmp.tif'
+    status = instrument.run(['gdal_translate', '-q'] + list(COG_OPTS) + [source, tmp_cog], stage='dem-cog', layer=os.path.basename(source), bucket=bucket)
+    if status == 0:
+        os.replace(tmp_cog, cog)
+    elif os.path.exists(tmp_cog):
+        os.remove(tmp_cog)
+    return status
+
+
+def convert_sources(sources, source_dir, cog_dir, jobs=1, bucket=None):
+    """ Convert any sources whose COGs are missing or out of date
+    Returns a tuple (cog_filenames, failed_sources,)
+
+    """
+    cogs = [get_cog_path(source, source_dir, cog_dir) for source in sources]
+    pending = [(source, cog,) for (source, cog,) in zip(sources, cogs) if needs_conversion(source, cog)]
+    print("Converting {} of {} DEM files to COGs".format(len(pending), len(sources)))
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(convert_to_cog, source, cog, bucket): source for (source, cog,) in pending}
+        for future in concurrent.futures.as_completed(futures):
+            if future.result() != 0:
+                failed.append(futures[future])
+    return (cogs, sorted(failed),)
+
+
+def build_vrt(output, filenames, bounds=None, bucket=None):
+    """ Build a VRT mosaic of DEM files, replacing output only if gdalbuildvrt succeeds
+    Returns the exit status of gdalbuildvrt
+
+    """
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    tmp_output = output + '.tmp.vrt'
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as file_list:
+        for filename in filenames:
+            file_list.write(os.path.abspath(filename) + "\n")
+        file_list.flush()
+        command = ['gdalbuildvrt', '-q', '-overwrite']
+        if bounds is not None:
+            command += ['-te'] + [str(value) for value in bounds]
+        command += ['-input_file_list', file_list.name, tmp_output]
+        status = instrument.run(command, stage='dem-vrt', bucket=bucket)
+    if status == 0:
+        os.replace(tmp_output, output)
+    return status
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--bounds=MIN_LON,MIN_LAT,MAX_LON,MAX_LAT] [--cog-dir=DIR] [--source-dir=DIR] [--jobs=N] [--bucket=BUCKET] <output.vrt> <dem-file...>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    options = {
+        'bounds': None,
+        'cog-dir': None,
+        'source-dir': None,
+        'jobs': '1',
+        'bucket': None,
+    }
+
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in options:
+            usage()
+        elif value: # empty values (e.g. --bucket= with no BUCKET) are ignored
+            options[key] = value
+
+    if len(args) < 2:
+        usage()
+
+    (output, sources,) = (args[0], args[1:],)
+    bounds = tuple(float(value) for value in options['bounds'].split(',')) if options['bounds'] else None
+    if bounds is not None and len(bounds) != 4:
+        usage()
+
+    filenames = sources
+    if options['cog-dir']:
+        source_dir = options['source-dir'] or os.path.commonpath([os.path.abspath(os.path.dirname(source)) for source in sources])
+        (filenames, failed,) = convert_sources(sources, source_dir, options['cog-dir'], int(options['jobs']), options['bucket'])
+        if failed:
+            print("Failed to convert: {}".format(' '.join(failed)), file=sys.stderr)
+            sys.exit(1)
+
+    status = build_vrt(output, filenames, bounds, options['bucket'])
+    if status != 0:
+        print("gdalbuildvrt failed with status {}".format(status), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
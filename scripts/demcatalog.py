@@ -0,0 +1,201 @@
+""" Persistent catalog of DEM source files (FABDEM *.tif or SRTM-3 *.hgt)
+
+Walking a large DEM tree on every build is slow, so this module keeps
+an SQLite catalog of every 1x1 deg DEM file, keyed by the integer
+latitude and longitude of its bottom-left corner, with its path, size,
+and modification time.
+
+Refreshing the catalog rescans only directories whose modification
+time has changed since the last refresh (adding, removing, or renaming
+a file changes its directory's mtime).
+
+The catalog for a DEM directory like 01-inputs/FABDEM/Unpacked is
+saved beside it as 01-inputs/FABDEM/Unpacked-catalog.sqlite
+
+Command-line usage:
+
+    python3 demcatalog.py refresh <dem-dir>
+    python3 demcatalog.py bucket <dem-dir> <bucket>
+
+"""
+
+import os, re, sqlite3, sys
+
+from tiles import parse_bucket
+
+
+DEM_EXTENSIONS = ('.tif', '.hgt',)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+  path TEXT PRIMARY KEY,
+  parent TEXT,
+  mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS tiles (
+  path TEXT PRIMARY KEY,
+  dir TEXT,
+  lat INTEGER,
+  lon INTEGER,
+  size INTEGER,
+  mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS tiles_dir ON tiles(dir);
+CREATE INDEX IF NOT EXISTS tiles_latlon ON tiles(lat, lon);
+"""
+
+
+def catalog_path(dem_dir):
+    """ Return the path of the catalog file for a DEM directory """
+    return os.path.abspath(dem_dir).rstrip(os.sep) + '-catalog.sqlite'
+
+
+def parse_dem_name(filename):
+    """ Parse a DEM filename in the format N00W000 (etc) with a .tif or .hgt extension
+    Returns (lat, lon,) for the bottom-left corner, or None if the name isn't recognised
+
+    """
+    result = re.match(r'([NS])(\d{2})([EW])(\d{3}).*\.(TIF|HGT)$', filename.upper())
+    if not result:
+        return None
+    lat = int(result.group(2)) * (1 if result.group(1) == 'N' else -1)
+    lon = int(result.group(4)) * (1 if result.group(3) == 'E' else -1)
+    return (lat, lon,)
+
+
+def open_catalog(dem_dir, refresh=True):
+    """ Open the catalog for a DEM directory, creating it if needed
+    If refresh is True, bring it up to date with the directory first.
+
+    """
+    db = sqlite3.connect(catalog_path(dem_dir))
+    db.executescript(SCHEMA)
+    if refresh:
+        refresh_catalog(db, dem_dir)
+    return db
+
+
+def refresh_catalog(db, dem_dir):
+    """ Rescan any directories under dem_dir that changed since the last refresh
+    Returns the number of directories rescanned.
+
+    """
+    root = os.path.abspath(dem_dir)
+    rescanned = 0
+    stack = [(root, None,)]
+
+    with db:
+        while stack:
+            (path, parent,) = stack.pop()
+
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                forget_dir(db, path)
+                continue
+
+            row = db.execute("SELECT mtime_ns FROM dirs WHERE path=?", (path,)).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                # unchanged: reuse the subdirectories we already know about
+                for (child,) in db.execute("SELECT path FROM dirs WHERE parent=?", (path,)).fetchall():
+                    stack.append((child, path,))
+                continue
+
+            rescanned += 1
+            subdirs = set()
+            files = set()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirs.add(entry.path)
+                    elif entry.is_file() and entry.name.endswith(DEM_EXTENSIONS):
+                        latlon = parse_dem_name(entry.name)
+                        if latlon is None:
+                            print("Skipping badly-formatted DEM name {}".format(entry.path), file=sys.stderr)
+                            continue
+                        stat = entry.stat()
+                        files.add(entry.path)
+                        db.execute(
+                            "INSERT OR REPLACE INTO tiles (path, dir, lat, lon, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)",
+                            (entry.path, path, latlon[0], latlon[1], stat.st_size, stat.st_mtime_ns,)
+                        )
+
+            # forget files and subdirectories that have disappeared
+            for (tile_path,) in db.execute("SELECT path FROM tiles WHERE dir=?", (path,)).fetchall():
+                if tile_path not in files:
+                    db.execute("DELETE FROM tiles WHERE path=?", (tile_path,))
+            for (child,) in db.execute("SELECT path FROM dirs WHERE parent=?", (path,)).fetchall():
+                if child not in subdirs:
+                    forget_dir(db, child)
+
+            db.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)", (path, parent, mtime_ns,))
+            for child in subdirs:
+                stack.append((child, path,))
+
+    return rescanned
+
+
+def forget_dir(db, path):
+    """ Remove a directory, its subdirectories, and their files from the catalog """
+    for (child,) in db.execute("SELECT path FROM dirs WHERE parent=?", (path,)).fetchall():
+        forget_dir(db, child)
+    db.execute("DELETE FROM tiles WHERE dir=?", (path,))
+    db.execute("DELETE FROM dirs WHERE path=?", (path,))
+
+
+def add_file(db, path):
+    """ Add or update a single DEM file in the catalog (e.g. after unpacking it) """
+    path = os.path.abspath(path)
+    latlon = parse_dem_name(os.path.basename(path))
+    if latlon is None:
+        raise Exception("Badly-formatted DEM name " + path)
+    stat = os.stat(path)
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO tiles (path, dir, lat, lon, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, os.path.dirname(path), latlon[0], latlon[1], stat.st_size, stat.st_mtime_ns,)
+        )
+
+
+def find_tiles(db, bounds):
+    """ Return a sorted list of DEM paths whose corners fall inside bounds (inclusive)
+    Bounds format: (min_lon, min_lat, max_lon, max_lat,)
+
+    """
+    (min_lon, min_lat, max_lon, max_lat,) = bounds
+    rows = db.execute(
+        "SELECT path FROM tiles WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? ORDER BY path",
+        (min_lat, max_lat, min_lon, max_lon,)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+def format_cell(lat, lon):
+    """ Format a 1x1 deg cell name in DEM style, e.g. N40W074 """
+    return "{}{:02d}{}{:03d}".format("S" if lat < 0 else "N", abs(lat), "W" if lon < 0 else "E", abs(lon))
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'refresh' and len(sys.argv) == 3:
+        db = open_catalog(sys.argv[2], refresh=False)
+        rescanned = refresh_catalog(db, sys.argv[2])
+        count = db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        print("{} directories rescanned, {} DEM files".format(rescanned, count), file=sys.stderr)
+
+    elif command == 'bucket' and len(sys.argv) == 4:
+        db = open_catalog(sys.argv[2])
+        for path in find_tiles(db, parse_bucket(sys.argv[3])):
+            print(path)
+
+    else:
+        print("Usage: {} refresh <dem-dir>".format(sys.argv[0]), file=sys.stderr)
+        print("       {} bucket <dem-dir> <bucket>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
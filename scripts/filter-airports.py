@@ -1,16 +1,34 @@
 """ Filter airports in one or more apt.dat-format files for a specific bucket
-n
+
 Example:
 
     zcat apt.dat.gz | python3 filter-airports.py w080n40 > w080n40/apt.dat
 
 Will include all airports with a runway end or node within the bucket.
 
+To split the input into many buckets in a single pass, use --bucket-list
+(buckets listed one per line in a file) or --all-buckets (every bucket
+that contains an airport) with an output directory:
+
+    python3 filter-airports.py --bucket-list config/bucket-list.txt 02-prep/airports custom/*.dat apt.dat
+
+That will write 02-prep/airports/<bucket>/apt.dat for each bucket.
+
+If an airport appears in more than one file, only the first copy is
+used, so list custom files before the global apt.dat.
+
+In single-bucket mode, the script uses the byte-offset index from
+aptdat.py (creating or refreshing it as needed) to read only the
+airports near the bucket.
+
 Expects apt.dat version 1000. Use downgrade-apt.py to downgrade if needed.
 
 """
 
-import re, sys
+import os, sys
+
+from aptdat import open_airports, read_airports
+from tiles import get_point_buckets, parse_bucket
 
 
 OPENING = """I"""
@@ -19,105 +37,113 @@ VERSION = """1200 version - Copyright © 2013, Robin A. Peel (robin@x-plane.com)
 
 END = """99"""
 
-def filter_airports(bounds, input, output):
+
+def filter_airports(bounds, input, output, airports_seen=None):
     """ Filter to dump only airports that appear in the specified boundaries.
 
     Bounds format: (min_lon, min_lat, max_lon, max_lat,)
 
-    """
-
-    airports_seen = set()
+    Airports whose ident is already in airports_seen are skipped; pass
+    the same set for each file to let earlier files override later ones.
 
-    current_airport = ""
-    in_bounds = False
+    """
 
-    
-    def check_bounds(fields, lat_index, lon_index):
-        """ Pull a lat/lon pair from an array and check if it's in bounds
-        The indices into the array are provided.
+    if airports_seen is None:
+        airports_seen = set()
 
-        """
-        nonlocal in_bounds
-        if not in_bounds:
-            lat = float(fields[lat_index])
-            lon = float(fields[lon_index])
+    for airport in read_airports(input, rows=(), keep_lines=True, keep_points=True):
+        if airport.ident in airports_seen:
+            continue
+        for lon, lat in airport.points:
             if (bounds[0] <= lon <= bounds[2]) and (bounds[1] <= lat <= bounds[3]):
-                in_bounds = True
+                output.writelines(airport.lines)
+                airports_seen.add(airport.ident)
+                break
 
-    for i, line in enumerate(input):
 
-        tokens = re.split(r'\s+', line)
+def partition_airports(input, get_output, buckets=None, airports_seen=None):
+    """ Split airports among all the buckets they touch, in a single pass
 
-        type = tokens[0]
+    get_output is a function that takes a bucket name and returns a file
+    object for writing, or None to skip the bucket. If buckets is not
+    None, only airports in those buckets will be considered.
 
-        if i == 0 and type in ('I', 'A',):
-            continue
+    Airports whose ident is already in airports_seen are skipped, as
+    in filter_airports().
 
-        elif i <= 2 and type in ('1000', '1100', '1200',):
-            continue
-
-        # new airport
-        elif type in ('1', '16', '17'):
-            ident = tokens[4]
-            if in_bounds and current_airport and ident not in airports_seen:
-                print(current_airport, end='', file=output)
-                airports_seen.add(ident)
-            current_airport = ''
-            in_bounds = False
-
-        # runway
-        elif type in ('100',):
-            check_bounds(tokens, 9, 10)
-            check_bounds(tokens, 18, 19)
-
-        # water runway
-        elif type in ('101',):
-            check_bounds(tokens, 4, 5)
-            check_bounds(tokens, 7, 8)
-
-        # helipad
-        elif type in ('102',):
-            check_bounds(tokens, 2, 3)
-
-        # feature node
-        elif type in ('111', '112', '113', '114', '115', '116',):
-            check_bounds(tokens, 1, 2)
-
-        # positions of various types
-        elif type in ('14', '15', '18', '19', '20', '21', '1201', '1300',):
-            check_bounds(tokens, 1, 2)
-
-        # see if there's a better identifier
-        elif type in ('1302',):
-            pass
-
-        elif type in ('99'):
-            continue
-
-        current_airport += line
-
-    # print final airport
-    if current_airport:
-        print(current_airport, end='', file=output)
+    """
 
+    if airports_seen is None:
+        airports_seen = set()
 
-def parse_bucket(bucket):
-    """ Parse a bucket into a 4-element tuple
-    (min_lon, min_lat, max_lon, max_lat,)
+    for airport in read_airports(input, rows=(), keep_lines=True, keep_points=True):
+        if airport.ident in airports_seen:
+            continue
+        airport_buckets = set()
+        for lon, lat in airport.points:
+            airport_buckets.update(get_point_buckets(lon, lat))
+        if buckets is not None:
+            airport_buckets &= buckets
+        if airport_buckets:
+            airports_seen.add(airport.ident)
+            for bucket in sorted(airport_buckets):
+                output = get_output(bucket)
+                if output is not None:
+                    output.writelines(airport.lines)
+
+
+def read_bucket_list(filename):
+    """ Read a list of buckets, one per line (blank lines and # comments ignored) """
+    buckets = set()
+    with open(filename, 'r') as input:
+        for line in input:
+            bucket = line.split('#', 1)[0].strip().lower()
+            if bucket:
+                parse_bucket(bucket) # check the format
+                buckets.add(bucket)
+    return buckets
+
+
+def split_files(output_dir, files, buckets=None):
+    """ Write output_dir/<bucket>/apt.dat for every bucket, reading each file only once
+
+    If buckets is None, write every bucket that contains at least one airport.
+    Returns a dict of airport counts by bucket.
 
     """
 
-    result = re.match(r'^([ew])(\d{3})([ns])(\d{2})$', bucket.lower())
-    if not result:
-        raise Exception("Badly formatted bucket \"{}\"".format(bucket))
-    min_lon = int(result.group(2))
-    if result.group(1) == 'w':
-        min_lon *= -1
-    min_lat = int(result.group(4))
-    if result.group(3) == 's':
-        min_lat *= -1
+    outputs = {}
+    counts = {}
+
+    def get_output(bucket):
+        if bucket not in outputs:
+            path = os.path.join(output_dir, bucket)
+            os.makedirs(path, exist_ok=True)
+            output = open(os.path.join(path, 'apt.dat'), 'w', encoding='latin1')
+            print(OPENING, file=output)
+            print(VERSION, file=output)
+            outputs[bucket] = output
+            counts[bucket] = 0
+        counts[bucket] += 1
+        return outputs[bucket]
+
+    try:
+        # make sure every requested bucket gets a file, even if empty
+        if buckets is not None:
+            for bucket in buckets:
+                get_output(bucket)
+                counts[bucket] = 0
+
+        airports_seen = set()
+        for file in files:
+            with open(file, 'r', encoding='latin1') as input:
+                partition_airports(input, get_output, buckets, airports_seen)
+    finally:
+        for output in outputs.values():
+            print(END, file=output)
+            output.close()
 
-    return (min_lon, min_lat, min_lon+10, min_lat+10,)
+    return counts
 
 
 ########################################################################
@@ -126,17 +152,33 @@ def parse_bucket(bucket):
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 3:
+    if len(sys.argv) >= 4 and sys.argv[1] == '--all-buckets':
+        counts = split_files(sys.argv[2], sys.argv[3:])
+
+    elif len(sys.argv) >= 5 and sys.argv[1] == '--bucket-list':
+        counts = split_files(sys.argv[3], sys.argv[4:], read_bucket_list(sys.argv[2]))
+
+    elif len(sys.argv) >= 3 and not sys.argv[1].startswith('--'):
+        counts = None
+
+    else:
         print("Usage: {} <bucket> <file> [file...] > dest.apt".format(sys.argv[0]), file=sys.stderr)
+        print("       {} --bucket-list <list-file> <output-dir> <file> [file...]".format(sys.argv[0]), file=sys.stderr)
+        print("       {} --all-buckets <output-dir> <file> [file...]".format(sys.argv[0]), file=sys.stderr)
         sys.exit(2)
 
+    if counts is not None:
+        for bucket in sorted(counts):
+            print("{}: {} airports".format(bucket, counts[bucket]), file=sys.stderr)
+        sys.exit(0)
+
     bounds = parse_bucket(sys.argv[1])
 
     with open(sys.stdout.fileno(), 'w', encoding='latin1') as output:
         print(OPENING, file=output)
         print(VERSION, file=output)
+        airports_seen = set()
         for file in sys.argv[2:]:
-            with open(file, 'r', encoding='latin1') as input:
-                filter_airports(bounds, input, output)
+            with open_airports(file, bounds=bounds) as input:
+                filter_airports(bounds, input, output, airports_seen)
         print(END, file=output)
-
@@ -1,39 +1,30 @@
 """ Generate FlightGear threshold files for airports in apt.dat format
 
 Usage:
-    python3 get-thresholds.py <output-dir> [files...]
+    python3 get-thresholds.py [--processes=N] [--prune] <output-dir> [files...]
 
 If no files are provided, the script will read from standard input.
 
 The script will create <output-dir> and its subdirectories as needed.
 
+Threshold files are written only if their content has changed, so
+unchanged files keep their modification times. Use --processes to
+format and write airports in parallel, and --prune to remove threshold
+files for airports that are no longer in the input.
+
 """
 
-import collections, io, math, os, re, sys, xml.etree.ElementTree
+import hashlib, io, multiprocessing, os, re, sys
 
+from aptdat import read_airports
+from bearings import calculate_runway_bearings
 
-#
-# Keys for reading variables from an apt.dat file
-#
 
-RUNWAY_KEYS = {
-    # land runway
-    '100': (
-        'type', 'width', 'surface', 'shoulder', 'smoothness', 'centreline_lighting', 'edge_lighting', 'distance_signs',
-        'le_ident', 'le_lat', 'le_lon', 'le_displaced', 'le_overrun', 'le_markings', 'le_approach_lighting', 'le_tdz_lighting', 'le_reil',
-        'he_ident', 'he_lat', 'he_lon', 'he_displaced', 'he_overrun', 'he_markings', 'he_approach_lighting', 'he_tdz_lighting', 'he_reil',
-    ),
-    # water runway
-    '101': (
-        'type', 'width', 'buoys',
-        'le_ident', 'le_lat', 'le_lon',
-        'he_ident', 'he_lat', 'he_lon',
-    ),
-    # helipad
-    '102': (
-        'type', 'ident', 'lat', 'lon', 'bearing', 'len', 'width', 'surface', 'markings', 'shoulder', 'smoothness', 'edge_lighting',
-    ),
-}
+# Runway row types (see aptdat.RUNWAY_KEYS)
+RUNWAY_TYPES = ('100', '101', '102',)
+
+# Number of airports to handle at once (bearings are calculated for the whole chunk)
+CHUNK_SIZE = 256
 
 
 #
@@ -95,76 +86,138 @@ RUNWAY_XML_TEMPLATES = {
 # Functions
 #
 
-def gen_airports(output_dir, input):
-    """ Read through a file containing one or more airport definitions """
-    line = next(input)
-    while(line):
-        result = re.match(r'^(1|16|17)\s+(\d+)\s+\d+\s+\d+\s+([a-zA-Z0-9]+)\s+(.+)$', line)
-        if result:
-            airport = {
-                'code': result.group(3),
-                'name': result.group(4),
-                'type': result.group(1),
-                'elevation': result.group(2),
-                'runways': [],
-            }
-            line = gen_airport(output_dir, input, airport)
-        else:
-            try:
-                line = next(input) # gen_airport has read ahead a line
-            except StopIteration:
-                break
+def gen_airports(output_dir, input, processes=1, written_files=None):
+    """ Generate threshold files for all the airports in a file
+
+    If processes is more than 1, the airports are formatted and saved
+    by a pool of worker processes.
 
-def gen_airport(output_dir, input, airport):
-    """ Read a single airport's definition.
-    Returns:
-      The first line that's not part of the airport definition
+    Files whose contents haven't changed are left alone, so that their
+    modification times stay the same. If written_files is not None, the
+    paths of all threshold files (changed or not) are added to it.
+
+    Returns a tuple of (written, skipped,) counts.
 
     """
-    for line in input:
-        values = re.split(r'\s+', line)
-        if values[0] in RUNWAY_KEYS:
-            keys = RUNWAY_KEYS[values[0]]
-            airport['runways'].append({keys[i] : values[i] for i in range(len(keys))})
-        elif re.match(r'^(1|16|17)\s+', line):
-            save_airport(output_dir, airport)
-            return line
 
-    if airport is not None:
-        save_airport(output_dir, airport)
+    airports = [airport for airport in read_airports(input, rows=RUNWAY_TYPES) if re.match(r'^[a-zA-Z0-9]+$', airport.ident)]
+
+    # Create all the directories up front, rather than checking for each airport
+    jobs = []
+    dirs = set()
+    for airport in airports:
+        path = get_path(output_dir, airport.ident)
+        dirs.add(path)
+        jobs.append((os.path.join(path, airport.ident + '.threshold.xml'), airport,))
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+
+    if written_files is not None:
+        written_files.update(job[0] for job in jobs)
+
+    # Bearings are calculated for a whole chunk of airports at once
+    chunks = [jobs[i:i+CHUNK_SIZE] for i in range(0, len(jobs), CHUNK_SIZE)]
+
+    if processes > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = [result for chunk_results in pool.imap_unordered(save_airports_chunk, chunks) for result in chunk_results]
+    else:
+        results = [result for chunk in chunks for result in save_airports_chunk(chunk)]
+
+    written = sum(1 for result in results if result)
+    return (written, len(results) - written,)
+
+
+def save_airports_chunk(jobs):
+    """ Save a list of (filename, airport,) jobs; used by the worker pool
+    Returns a list of booleans: True if a file was written, or False if it was unchanged
+
+    """
+    airports_runways = [[runway.fields() for runway in airport.runways] for (filename, airport,) in jobs]
+    add_bearings([runway for runways in airports_runways for runway in runways])
+    return [write_if_changed(filename, format_runways(runways)) for (filename, airport,), runways in zip(jobs, airports_runways)]
 
 
 def save_airport(output_dir, airport):
-    """ Save a single airport to a file in output_dir """
+    """ Save a single airport to a file in output_dir
+    Returns True if the file was written, or False if it was unchanged
 
-    code = airport['code']
+    """
+    code = airport.ident
     path = make_path(output_dir, code)
+    runways = [runway.fields() for runway in airport.runways]
+    add_bearings(runways)
+    return write_if_changed(os.path.join(path, code + '.threshold.xml'), format_runways(runways))
 
-    print("Saving {}...".format(code), file=sys.stderr)
 
-    # Make the thresholds file
-    threshold_file = os.path.join(path, code + '.threshold.xml')
-    with open(threshold_file, 'w') as output:
-        print(PROPERTIES_PRE_XML, file=output)
-        
-        for runway in airport['runways']:
+def format_runways(runways):
+    """ Return the threshold XML for an airport's runways as a string
+    Takes a list of runway dicts (see aptdat.Runway.fields()). Call
+    add_bearings() for the runways first.
 
-            # These are missing for land and water runways
-            add_bearings(runway)
-            
-            # too lazy to use a library like ElementTree
-            escape_values(runway)
-            print(RUNWAY_XML_TEMPLATES[runway['type']].format(**runway), file=output)
+    """
 
-        print(PROPERTIES_POST_XML, file=output)
+    output = [PROPERTIES_PRE_XML]
 
+    for runway in runways:
 
-def make_path(output_dir, code):
-    """ Ensure that the output path for an airport exists, and return it """
+        # too lazy to use a library like ElementTree
+        escape_values(runway)
+        output.append(RUNWAY_XML_TEMPLATES[runway['type']].format(**runway))
+
+    output.append(PROPERTIES_POST_XML)
+    return "\n".join(output) + "\n"
+
+
+def write_if_changed(filename, content):
+    """ Write content to a file, unless the file already has the same content hash
+    Returns True if the file was written.
+
+    """
+    data = content.encode('utf-8')
+    try:
+        with open(filename, 'rb') as input:
+            if hashlib.sha256(input.read()).digest() == hashlib.sha256(data).digest():
+                return False
+    except FileNotFoundError:
+        pass
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as output:
+        output.write(data)
+    os.replace(tmp_filename, filename)
+    return True
+
+
+def prune_thresholds(output_dir, keep_files):
+    """ Remove any threshold files under output_dir that aren't in keep_files
+    Returns the number of files removed.
+
+    """
+    keep_files = set(os.path.normpath(filename) for filename in keep_files)
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for filename in filenames:
+            if filename.endswith('.threshold.xml'):
+                path = os.path.normpath(os.path.join(dirpath, filename))
+                if path not in keep_files:
+                    os.remove(path)
+                    removed += 1
+    return removed
+
+
+def get_path(output_dir, code):
+    """ Return the output path for an airport (e.g. K/B/O for KBOS) """
     path = output_dir
     for i in range(0, 3):
         if i < len(code) - 1:
             path = os.path.join(path, code[i])
+    return path
+
+
+def make_path(output_dir, code):
+    """ Ensure that the output path for an airport exists, and return it """
+    path = get_path(output_dir, code)
     if not os.path.exists(path):
         os.makedirs(path)
     return path
@@ -179,62 +232,25 @@ def escape_values(runway):
     return runway
 
 
-def add_bearings(runway):
-    """ Calculate and add bearings to a directional runway """
-    if 'he_lat' in runway:
-        runway['le_bearing'] = "{:0.8f}".format(calculate_initial_compass_bearing(
-            (float(runway['le_lat']), float(runway['le_lon']),),
-            (float(runway['he_lat']), float(runway['he_lon']),),
-        ))
-        runway['he_bearing'] = "{:0.8f}".format(calculate_initial_compass_bearing(
-            (float(runway['he_lat']), float(runway['he_lon']),),
-            (float(runway['le_lat']), float(runway['le_lon']),),
-        ))
-
-
-# Function by Jérôme Renard
-# LICENSE: public domain
-def calculate_initial_compass_bearing(pointA, pointB):
-    """
-    Calculates the bearing between two points.
-
-    The formulae used is the following:
-        θ = atan2(sin(Δlong).cos(lat2),
-                  cos(lat1).sin(lat2) − sin(lat1).cos(lat2).cos(Δlong))
-
-    :Parameters:
-      - `pointA: The tuple representing the latitude/longitude for the
-        first point. Latitude and longitude must be in decimal degrees
-      - `pointB: The tuple representing the latitude/longitude for the
-        second point. Latitude and longitude must be in decimal degrees
-
-    :Returns:
-      The bearing in degrees
+def add_bearings(runways):
+    """ Calculate and add bearings to all the directional runways in a list
+    Helipads already have a bearing in apt.dat, so they're skipped.
 
-    :Returns Type:
-      float
     """
-    if (type(pointA) != tuple) or (type(pointB) != tuple):
-        raise TypeError("Only tuples are supported as arguments")
-
-    lat1 = math.radians(pointA[0])
-    lat2 = math.radians(pointB[0])
-
-    diffLong = math.radians(pointB[1] - pointA[1])
-
-    x = math.sin(diffLong) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
-            * math.cos(lat2) * math.cos(diffLong))
+    runways = [runway for runway in runways if 'he_lat' in runway]
+    if not runways:
+        return
 
-    initial_bearing = math.atan2(x, y)
+    (le_bearings, he_bearings,) = calculate_runway_bearings(
+        [float(runway['le_lat']) for runway in runways],
+        [float(runway['le_lon']) for runway in runways],
+        [float(runway['he_lat']) for runway in runways],
+        [float(runway['he_lon']) for runway in runways],
+    )
 
-    # Now we have the initial bearing but math.atan2 return values
-    # from -180° to + 180° which is not what we want for a compass bearing
-    # The solution is to normalize the initial bearing as shown below
-    initial_bearing = math.degrees(initial_bearing)
-    compass_bearing = (initial_bearing + 360) % 360
-
-    return compass_bearing
+    for runway, le_bearing, he_bearing in zip(runways, le_bearings, he_bearings):
+        runway['le_bearing'] = "{:0.8f}".format(le_bearing)
+        runway['he_bearing'] = "{:0.8f}".format(he_bearing)
 
 
 #
@@ -243,19 +259,44 @@ def calculate_initial_compass_bearing(pointA, pointB):
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 2:
-        print("Usage: {} <output-dir> [file...]".format(sys.argv[0]), file=sys.stderr)
+    processes = 1
+    prune = False
+
+    args = sys.argv[1:]
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option.startswith('--processes='):
+            processes = int(option[12:])
+        elif option == '--prune':
+            prune = True
+        else:
+            args = []
+            break
+
+    if len(args) < 1:
+        print("Usage: {} [--processes=N] [--prune] <output-dir> [file...]".format(sys.argv[0]), file=sys.stderr)
         exit(2)
 
-    output_dir = sys.argv[1]
+    output_dir = args[0]
+    written_files = set()
+    written = 0
+    skipped = 0
 
-    if len(sys.argv) == 2:
+    if len(args) == 1:
         with io.open(sys.stdin.fileno(), 'r', encoding='latin-1') as input:
-            gen_airports(output_dir, input)
+            (written, skipped,) = gen_airports(output_dir, input, processes, written_files)
 
     else:
-        for filename in sys.argv[2:]:
+        for filename in args[1:]:
             with open(filename, 'r', encoding='latin-1') as input:
-                gen_airports(output_dir, input)
+                counts = gen_airports(output_dir, input, processes, written_files)
+                written += counts[0]
+                skipped += counts[1]
+
+    print("{} threshold files written, {} unchanged".format(written, skipped), file=sys.stderr)
+
+    if prune:
+        removed = prune_thresholds(output_dir, written_files)
+        print("{} old threshold files removed".format(removed), file=sys.stderr)
 
 # end
@@ -3,11 +3,14 @@
 
 This script uses the general term "facility" to refer to an land or water aerodrome or a helipad.
 
-The script parses facility data into a JSON-like object, then uses that to generate the output files.
+The script parses facility data into compact records (see aptdat.py), then uses those to generate the output files.
+XML is written a line at a time through XMLWriter, without building an element tree.
 
 Command-line example:
 
-    cat apt.dat | python3 generate-airport-files.py scenery/Airports
+    cat apt.dat | python3 generate-airport-files.py [--processes=N] scenery/Airports
+
+With --processes, chunks of facilities are written by a pool of worker processes.
 
 The main programmatic entry point is generate_facility_files()
 
@@ -15,20 +18,35 @@ Started 2023-02-17 by David Megginson
 
 """
 
-import json, math, os, re, sys
+import collections, math, multiprocessing, os, sys
+
+from xml.sax.saxutils import escape
+
+from aptdat import DEFAULT_ROWS, GROUNDNET_ROWS, read_airports
+from bearings import calculate_initial_compass_bearings
+
 
-import xml.etree.cElementTree as X
+# Number of facilities to parse before dumping (headings are calculated for the whole chunk)
+CHUNK_SIZE = 256
 
+# Maximum number of chunks waiting for each worker process (limits memory use)
+CHUNKS_PER_PROCESS = 2
 
-RUNWAY_COORD_POS = {
-    '100': (9, 10, 18, 19,),
-    '101': (4, 5, 7, 8,),
-    '102': (2, 3,),
+# Parking radius in metres for each ICAO aircraft width code (apt.dat 1301)
+PARKING_RADIUS = {
+    'A': 7.5,
+    'B': 14,
+    'C': 18,
+    'D': 26,
+    'E': 33,
+    'F': 40,
 }
-    
+
+# Default parking radius when there is no width code
+DEFAULT_PARKING_RADIUS = 18
 
 
-def generate_facility_files(output_dir, input):
+def generate_facility_files(output_dir, input, processes=1):
     """ Create FlightGear Airport/* files from an apt.dat file
 
     Parameters:
@@ -37,258 +55,299 @@ def generate_facility_files(output_dir, input):
 
       input: a file object from which to read the apt.dat data
 
+      processes: if more than 1, write chunks of facilities with a pool of worker processes
+
     """
-    
-    current_facility = None
-    for line in input:
-        tokens = re.split(r'\s+', line)
-        type = tokens[0]
-        
-        if type in ('1', '16', '17',): # facilities
-            if current_facility is not None:
-                dump_facility(output_dir, current_facility)
-            current_facility = parse_facility(tokens)
-            
-        elif type in ('100', '101', '102',): # landing/takeoff surfaces
-            current_facility['runways'].append(parse_runway(tokens))
-
-        elif type in ('1300',): # parking (no network)
-            if current_facility:
-                current_facility['parking'].append({
-                    'type': tokens[4],
-                    'lat': tokens[1],
-                    'lon': tokens[2],
-                    'hdg-deg': tokens[3],
-                    'usage': tokens[5].split('|'),
-                    'name': ' '.join(tokens[6:]).strip(),
-                })
-            
-        elif type in ('1302'):
-            if current_facility is not None and tokens[1]:
-                value = ' '.join(tokens[2:]).strip()
-                if value:
-                    current_facility['metadata'][tokens[1]] = value
-
-        elif type in ('50', '51', '52', '53', '54', '55', '56', '1050', '1051', '1052', '1053', '1054', '1055', '1056',):
-            if len(type) == 2:
-                type = '10' + type
-            current_facility['frequencies'].append({
-                'type': type,
-                'frequency': tokens[1],
-                'name': ' '.join(tokens[2:]).strip(),
-            })
 
-        elif type in ('14',):
-            current_facility['viewpoints'].append({
-                'lat': tokens[1],
-                'lon': tokens[2],
-                'elev-m': tokens[3],
-                'name': ' '.join(tokens[4:]).strip(),
-            })
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    pending = collections.deque()
+
+    def submit(facilities):
+        if pool is None:
+            dump_facilities(output_dir, facilities)
+            return
+        # wait for the oldest chunk if too many are queued, so that parsing can't run far ahead
+        while len(pending) >= processes * CHUNKS_PER_PROCESS:
+            pending.popleft().get()
+        pending.append(pool.apply_async(dump_facilities, (output_dir, facilities,)))
+
+    try:
+        facilities = []
+        for facility in read_airports(input, rows=DEFAULT_ROWS + GROUNDNET_ROWS):
+            if len(facilities) >= CHUNK_SIZE:
+                submit(facilities)
+                facilities = []
+            facilities.append(facility)
+        submit(facilities)
+
+        while pending:
+            pending.popleft().get()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+class XMLWriter:
+    """ Write indented XML to a file one element at a time, without building a tree """
+
+    def __init__(self, output):
+        self.output = output
+        self.stack = []
+        output.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+    def start(self, tag, attrs=None):
+        """ Open an element that will have child elements """
+        self.output.write("{}<{}{}>\n".format('  ' * len(self.stack), tag, self.format_attrs(attrs)))
+        self.stack.append(tag)
+
+    def end(self):
+        """ Close the most-recently opened element """
+        tag = self.stack.pop()
+        self.output.write("{}</{}>\n".format('  ' * len(self.stack), tag))
+
+    def element(self, tag, text=None, attrs=None):
+        """ Write a complete element with optional text content """
+        indent = '  ' * len(self.stack)
+        if text is None:
+            self.output.write("{}<{}{} />\n".format(indent, tag, self.format_attrs(attrs)))
+        else:
+            self.output.write("{}<{}{}>{}</{}>\n".format(indent, tag, self.format_attrs(attrs), escape(str(text)), tag))
+
+    @staticmethod
+    def format_attrs(attrs):
+        if not attrs:
+            return ''
+        return ''.join(' {}="{}"'.format(key, escape(str(value), {'"': '&quot;'})) for key, value in attrs.items())
+
+
+def get_thresholds(runway):
+    """ Return a list of threshold property dicts for each end of a runway record """
+    type = runway.type
+
+    if type == '102': # helipad
+        return [
+            {
+                'rwy': runway.get('ident'),
+                'lat': runway.get('lat'),
+                'lon': runway.get('lon'),
+                'hdg-deg': runway.get('bearing'),
+            },
+        ]
+
+    thresholds = []
+    for i, end in enumerate(('le', 'he',)):
+        threshold = {
+            'rwy': runway.get(end + '_ident'),
+            'lat': runway.get(end + '_lat'),
+            'lon': runway.get(end + '_lon'),
+            'hdg-deg': runway.headings[i] if runway.headings else None,
+        }
+        if type == '100': # land runway
+            threshold['displ-m'] = runway.get(end + '_displaced')
+            threshold['stopw-m'] = runway.get(end + '_overrun')
+        thresholds.append(threshold)
+    return thresholds
 
 
-def parse_facility(tokens):
-    """ Start an facility object from a record """
-    return {
-        'type': tokens[0],
-        'elev-m': int(tokens[1]),
-        'ident': tokens[4],
-        'name': ' '.join(tokens[5:]).strip(),
-        'runways': [],
-        'frequencies': [],
-        'parking': [],
-        'viewpoints': [],
-        'metadata': {},
-    }
-
-
-def parse_runway(tokens):
-    """ Create a runway record, including thresholds """
-    type = tokens[0]
-    pos = RUNWAY_COORD_POS[type]
-
-    # Grab the coordinates for each end
-    lat1 = tokens[pos[0]]
-    lon1 = tokens[pos[1]]
-
-    # If we have two ends
-    if len(pos) > 2:
-        lat2 = tokens[pos[2]]
-        lon2 = tokens[pos[3]]
-
-        # Calculate the headings (not in the apt.dat file)
-        heading1 = round(calc_heading((float(lat1), float(lon1),), (float(lat2), float(lon2),)), 2)
-        heading2 = round((heading1 + 180.0) % 360.0, 2) # reciprocal
-    
-    if type == '100': # land runway
-        return {
-            'type': type,
-            'width': tokens[1],
-            'surface': tokens[2],
-            'thresholds': [
-                {
-                    'rwy': tokens[8],
-                    'lat': lat1,
-                    'lon': lon1,
-                    'hdg-deg': heading1,
-                    'displ-m': tokens[11],
-                    'stopw-m': tokens[12],
-                },
-                {
-                    'rwy': tokens[17],
-                    'lat': lat2,
-                    'lon': lon2,
-                    'hdg-deg': heading2,
-                    'displ-m': tokens[20],
-                    'stopw-m': tokens[21],
-                },
-            ],
-        }
-    elif type == '101': # water runway
-        return {
-            'type': type,
-            'width': tokens[1],
-            'surface': tokens[2],
-            'thresholds': [
-                {
-                    'rwy': tokens[3],
-                    'lat': lat1,
-                    'lon': lon1,
-                    'hdg-deg': heading1,
-                },
-                {
-                    'rwy': tokens[6],
-                    'lat': lat2,
-                    'lon': lon2,
-                    'hdg-deg': heading2,
-                },
-            ],
-        }
-    elif type == '102': # helipad
-        return {
-            'type': type,
-            'width': tokens[6],
-            'length': tokens[5],
-            'surface': tokens[7],
-            'thresholds': [
-                {
-                    'rwy': tokens[1],
-                    'lat': tokens[2],
-                    'lon': tokens[3],
-                    'hdg-deg': tokens[4],
-                },
-            ],
-        }
-    else:
-        raise TypeError("Not a runway: {}".format(str(tokens)))
+def add_headings(runways):
+    """ Calculate the missing threshold headings for a list of runways, all at once
+    Helipads already have a heading in apt.dat, so they're skipped.
+
+    """
+    runways = [runway for runway in runways if runway.type != '102']
+    if not runways:
+        return
+
+    headings = calculate_initial_compass_bearings(
+        [float(runway.get('le_lat')) for runway in runways],
+        [float(runway.get('le_lon')) for runway in runways],
+        [float(runway.get('he_lat')) for runway in runways],
+        [float(runway.get('he_lon')) for runway in runways],
+    )
+
+    for runway, heading in zip(runways, headings):
+        heading1 = round(float(heading), 2)
+        runway.headings = (heading1, round((heading1 + 180.0) % 360.0, 2),) # reciprocal
+
+
+def dump_facilities(output_dir, facilities):
+    """ Create files for a chunk of facilities """
+    add_headings([runway for facility in facilities for runway in facility.runways])
+    for facility in facilities:
+        dump_facility(output_dir, facility)
 
 
 def dump_facility(output_dir, facility):
     """ Create files for a facility in the appropriate directory """
 
-    dir = make_path(output_dir, facility['ident'])
+    dir = make_path(output_dir, facility.ident)
     dump_thresholds(dir, facility)
     dump_tower(dir, facility)
     dump_groundnet(dir, facility)
 
 
 def dump_thresholds(dir, facility):
-    filename = os.path.join(dir, "{}.threshold.xml".format(facility['ident']))
+    filename = os.path.join(dir, "{}.threshold.xml".format(facility.ident))
 
-    p = X.Element('PropertyList')
-    for runway in facility['runways']:
-        for threshold in runway['thresholds']:
-            r = X.SubElement(p, 'runway')
-            for prop in ('lon', 'lat', 'rwy', 'hdg-deg', 'displ-m', 'stopw-m',):
-                if prop in threshold:
-                    X.SubElement(r, prop).text = str(threshold[prop])
-
-    save_xml(filename, p)
+    with open(filename, 'w', encoding='utf-8') as output:
+        writer = XMLWriter(output)
+        writer.start('PropertyList')
+        for runway in facility.runways:
+            for threshold in get_thresholds(runway):
+                writer.start('runway')
+                for prop in ('lon', 'lat', 'rwy', 'hdg-deg', 'displ-m', 'stopw-m',):
+                    if prop in threshold:
+                        writer.element(prop, threshold[prop])
+                writer.end()
+        writer.end()
 
 
 def dump_tower(dir, facility):
     
-    if not facility['viewpoints']: # no tower
+    if not facility.viewpoints: # no tower
         return
     
-    filename = os.path.join(dir, "{}.twr.xml".format(facility['ident']))
-
-    twr = facility['viewpoints'][0] # assume first viewpoint is tower
+    filename = os.path.join(dir, "{}.twr.xml".format(facility.ident))
 
-    p = X.Element('PropertyList')
-    x = X.SubElement(p, 'tower')
-    y = X.SubElement(x, 'twr')
-    for prop in ('lon', 'lat', 'elev-m',):
-        X.SubElement(y, prop, twr[prop])
+    viewpoint = facility.viewpoints[0] # assume first viewpoint is tower
 
-    save_xml(filename, p)
+    with open(filename, 'w', encoding='utf-8') as output:
+        writer = XMLWriter(output)
+        writer.start('PropertyList')
+        writer.start('tower')
+        writer.start('twr')
+        writer.element('lon', viewpoint.lon)
+        writer.element('lat', viewpoint.lat)
+        writer.element('elev-m', viewpoint.height)
+        writer.end()
+        writer.end()
+        writer.end()
 
 
 def dump_groundnet(dir, facility):
-    filename = os.path.join(dir, "{}.groundnet.xml".format(facility['ident']))
-    print(filename)
-
-
-def make_path(output_dir, ident):
-    """ Ensure that the output path for an airport exists, and return it """
-    path = output_dir
-    for i in range(0, 3):
-        if i < len(ident) - 1:
-            path = os.path.join(path, ident[i])
-    if not os.path.exists(path):
-        os.makedirs(path)
-    return path
+    """ Write the taxi network and startup locations in FlightGear groundnet format
+
+    Nodes on runway edges are marked isOnRunway="1". A node at the
+    taxiway end of an edge with an active zone (1204), where it meets
+    an edge without one, is marked as a hold point (unless it's on a
+    runway). Parking positions are numbered after the highest
+    taxi-node ID, since parking and nodes share one index space. Each
+    two-way edge is written as a pair of one-way arcs. Each parking
+    position is linked to the nearest taxi node off the runways (or
+    the nearest node, if they're all on runways) by a pair of arcs,
+    since FlightGear's AI traffic routes from the parking index.
 
+    """
 
-def save_xml(filename, root):
-    tree = X.ElementTree(root)
-    X.indent(tree, space='  ', level=0)
-    tree.write(filename, encoding='utf-8', xml_declaration=True)
+    if not facility.taxi_nodes and not facility.parking: # no ground network
+        return
 
+    filename = os.path.join(dir, "{}.groundnet.xml".format(facility.ident))
+
+    runway_nodes = set()
+    zone_nodes = set()
+    taxiway_nodes = set()
+    for edge in facility.taxi_edges:
+        if edge.category == 'runway':
+            runway_nodes.update((edge.start, edge.end,))
+        elif edge.active_zones:
+            zone_nodes.update((edge.start, edge.end,))
+        else:
+            taxiway_nodes.update((edge.start, edge.end,))
+    hold_nodes = (zone_nodes & taxiway_nodes) - runway_nodes
+
+    next_index = 1 + max((int(node.id) for node in facility.taxi_nodes), default=-1)
+
+    parking_nodes = [node for node in facility.taxi_nodes if node.id not in runway_nodes] or facility.taxi_nodes
+    parking_nodes = [(float(node.lat), float(node.lon), node.id,) for node in parking_nodes]
+
+    with open(filename, 'w', encoding='utf-8') as output:
+        writer = XMLWriter(output)
+        writer.start('groundnet')
+        writer.element('version', 1)
+
+        writer.start('parkingList')
+        for i, parking in enumerate(facility.parking):
+            writer.element('Parking', attrs={
+                'index': next_index + i,
+                'type': get_parking_type(parking),
+                'name': parking.name,
+                'lat': format_groundnet_coord(parking.lat, 'N', 'S'),
+                'lon': format_groundnet_coord(parking.lon, 'E', 'W'),
+                'heading': parking.heading,
+                'radius': PARKING_RADIUS.get(parking.width_code, DEFAULT_PARKING_RADIUS),
+                'airlineCodes': ','.join(parking.airlines).upper(),
+            })
+        writer.end()
+
+        writer.start('TaxiNodes')
+        for node in facility.taxi_nodes:
+            writer.element('node', attrs={
+                'index': node.id,
+                'lat': format_groundnet_coord(node.lat, 'N', 'S'),
+                'lon': format_groundnet_coord(node.lon, 'E', 'W'),
+                'isOnRunway': 1 if node.id in runway_nodes else 0,
+                'holdPointType': 'normal' if node.id in hold_nodes else 'none',
+            })
+        writer.end()
 
-# Function by Jérôme Renard
-# LICENSE: public domain
-def calc_heading(pointA, pointB):
-    """
-    Calculates the bearing between two points.
+        writer.start('TaxiWaySegments')
+        for edge in facility.taxi_edges:
+            writer.element('arc', attrs={'begin': edge.start, 'end': edge.end, 'isPushBackRoute': 0, 'name': edge.name})
+            if edge.direction == 'twoway':
+                writer.element('arc', attrs={'begin': edge.end, 'end': edge.start, 'isPushBackRoute': 0, 'name': edge.name})
+        for i, parking in enumerate(facility.parking):
+            node_id = find_nearest_node(parking.lat, parking.lon, parking_nodes)
+            if node_id is not None:
+                writer.element('arc', attrs={'begin': next_index + i, 'end': node_id, 'isPushBackRoute': 0, 'name': parking.name})
+                writer.element('arc', attrs={'begin': node_id, 'end': next_index + i, 'isPushBackRoute': 0, 'name': parking.name})
+        writer.end()
 
-    The formulae used is the following:
-        θ = atan2(sin(Δlong).cos(lat2),
-                  cos(lat1).sin(lat2) − sin(lat1).cos(lat2).cos(Δlong))
+        writer.end()
 
-    :Parameters:
-      - `pointA: The tuple representing the latitude/longitude for the
-        first point. Latitude and longitude must be in decimal degrees
-      - `pointB: The tuple representing the latitude/longitude for the
-        second point. Latitude and longitude must be in decimal degrees
 
-    :Returns:
-      The bearing in degrees
+def find_nearest_node(lat, lon, nodes):
+    """ Return the ID of the node nearest to lat, lon, or None if there are no nodes
+    nodes is a list of (lat, lon, id,) tuples. Distances are on a flat projection, which is close enough within an airport.
 
-    :Returns Type:
-      float
     """
-    if (type(pointA) != tuple) or (type(pointB) != tuple):
-        raise TypeError("Only tuples are supported as arguments")
-
-    lat1 = math.radians(pointA[0])
-    lat2 = math.radians(pointB[0])
-
-    diffLong = math.radians(pointB[1] - pointA[1])
+    (lat, lon,) = (float(lat), float(lon),)
+    scale = math.cos(math.radians(lat)) ** 2
+    nearest = min(nodes, key=lambda node: (node[0] - lat) ** 2 + scale * (node[1] - lon) ** 2, default=None)
+    return nearest[2] if nearest is not None else None
+
+
+def get_parking_type(parking):
+    """ Map an apt.dat startup location to a FlightGear parking type """
+    operation_type = parking.operation_type
+    if operation_type == 'cargo':
+        return 'cargo'
+    elif operation_type == 'military':
+        return 'mil-cargo'
+    elif parking.type == 'gate':
+        return 'gate'
+    else:
+        return 'ga'
 
-    x = math.sin(diffLong) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1)
-            * math.cos(lat2) * math.cos(diffLong))
 
-    initial_bearing = math.atan2(x, y)
+def format_groundnet_coord(value, positive, negative):
+    """ Format decimal degrees for groundnet.xml, e.g. "N42 21.600" """
+    value = float(value)
+    hemisphere = positive if value >= 0 else negative
+    # round to thousandths of a minute before splitting, so that the minutes never round up to 60
+    (degrees, thousandths,) = divmod(round(abs(value) * 60000), 60000)
+    return "{}{} {:.3f}".format(hemisphere, degrees, thousandths / 1000)
 
-    # Now we have the initial bearing but math.atan2 return values
-    # from -180° to + 180° which is not what we want for a compass bearing
-    # The solution is to normalize the initial bearing as shown below
-    initial_bearing = math.degrees(initial_bearing)
-    compass_bearing = (initial_bearing + 360) % 360
 
-    return compass_bearing
+def make_path(output_dir, ident):
+    """ Ensure that the output path for an airport exists, and return it """
+    path = output_dir
+    for i in range(0, 3):
+        if i < len(ident) - 1:
+            path = os.path.join(path, ident[i])
+    os.makedirs(path, exist_ok=True) # may race with other worker processes
+    return path
 
 
 ########################################################################
@@ -296,12 +355,18 @@ def calc_heading(pointA, pointB):
 ########################################################################
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage {} <output-directory>".format(sys.argv[0]), file=sys.stderr)
-    else:
-        output_dir = sys.argv[1]
+    args = sys.argv[1:]
+    processes = 1
+    if args and args[0].startswith('--processes='):
+        processes = int(args.pop(0)[12:])
+
+    if len(args) != 1:
+        print("Usage {} [--processes=N] <output-directory>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
+
+    output_dir = args[0]
 
     with open(sys.stdin.fileno(), 'r', encoding='latin1') as input:
-        generate_facility_files(output_dir, input)
+        generate_facility_files(output_dir, input, processes)
 
     sys.exit(0)
@@ -0,0 +1,287 @@
+""" Measure build stages and report where the time goes
+
+The run command wraps an external tool or script, passing its output
+through unchanged, and appends one JSON line per command to a log:
+
+    {"run": "20240301T120000", "bucket": "w080n40", "stage": "landmass-extract",
+     "layer": null, "start": 1709294400.1, "wall": 812.4, "user": 790.2, "sys": 12.1,
+     "max_rss_kb": 1843200, "read_bytes": 104857600, "write_bytes": 52428800,
+     "output_bytes": 51234567, "status": 0, "command": "ogr2ogr ..."}
+
+CPU time, peak RSS, and I/O come from the kernel's resource usage for
+the command and all of its child processes. Bytes read and written
+count only actual block I/O (reads served from the page cache don't
+count).
+
+The report command prints a timeline for each bucket in a run, or
+compares the durations of the same stages in two runs.
+
+Usage:
+
+    python3 instrument.py run [options] -- <command> [args...]
+    python3 instrument.py report [--run=ID] [--compare=ID] <log>
+
+Options for run:
+
+  --stage=NAME     the build stage (e.g. osm-areas-extract)
+  --layer=NAME     the layer or part of the area, if any
+  --bucket=BUCKET  the bucket being built
+  --output=PATH    a file or directory whose size to record (repeatable)
+  --log=FILE       the JSON-lines log (default: $INSTRUMENT_LOG)
+  --run=ID         an identifier for the whole build (default: $INSTRUMENT_RUN)
+
+If there's no log, the command runs without being measured.
+run exits with the command's exit status.
+
+By default, report shows the latest run in the log.
+
+"""
+
+import json, os, shlex, subprocess, sys, time
+
+
+# Bytes in each block counted by getrusage()
+BLOCK_SIZE = 512
+
+# Width of the timeline bars in the report
+BAR_WIDTH = 40
+
+
+#
+# Measuring commands
+#
+
+def get_output_bytes(paths):
+    """ Return the total size of files and directories """
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    try:
+                        total += os.path.getsize(os.path.join(dirpath, filename))
+                    except OSError:
+                        pass
+    return total
+
+
+def measure(command, **kwargs):
+    """ Run a command and measure it, without logging
+    Extra keyword arguments go to subprocess.Popen (e.g. stdout).
+    Returns a tuple (status, wall_seconds, rusage,), where rusage covers
+    the command and all of its child processes.
+
+    """
+    start = time.time()
+    process = subprocess.Popen(command, **kwargs)
+    (pid, wait_status, usage,) = os.wait4(process.pid, 0)
+    status = os.waitstatus_to_exitcode(wait_status)
+    process.returncode = status
+    return (status, time.time() - start, usage,)
+
+
+def run(command, stage=None, layer=None, bucket=None, outputs=(), log=None, run_id=None, **kwargs):
+    """ Run a command, and append its measurements to a log if there is one
+
+    Extra keyword arguments go to subprocess.Popen (e.g. stdout).
+    log and run_id default to the INSTRUMENT_LOG and INSTRUMENT_RUN
+    environment variables.
+
+    Returns the command's exit status (negative if it was killed by a signal).
+
+    """
+    log = log or os.environ.get('INSTRUMENT_LOG')
+    run_id = run_id or os.environ.get('INSTRUMENT_RUN')
+
+    start = time.time()
+    (status, wall, usage,) = measure(command, **kwargs)
+
+    if log:
+        entry = {
+            'run': run_id,
+            'bucket': bucket,
+            'stage': stage,
+            'layer': layer,
+            'start': round(start, 3),
+            'wall': round(wall, 3),
+            'user': round(usage.ru_utime, 3),
+            'sys': round(usage.ru_stime, 3),
+            'max_rss_kb': usage.ru_maxrss,
+            'read_bytes': usage.ru_inblock * BLOCK_SIZE,
+            'write_bytes': usage.ru_oublock * BLOCK_SIZE,
+            'output_bytes': get_output_bytes(outputs),
+            'status': status,
+            'command': ' '.join(shlex.quote(str(arg)) for arg in command),
+        }
+        # a single short append is atomic, so concurrent commands can share the log
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(log)), exist_ok=True)
+            with open(log, 'a') as output:
+                output.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print("Can't write to {}: {}".format(log, e), file=sys.stderr)
+
+    return status
+
+
+#
+# Reports
+#
+
+def read_log(filename):
+    """ Read all entries from a JSON-lines log, skipping damaged lines """
+    entries = []
+    with open(filename, 'r') as input:
+        for line in input:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                pass
+    return entries
+
+
+def format_bytes(value):
+    for unit in ('B', 'KB', 'MB', 'GB',):
+        if abs(value) < 1024:
+            return "{:0.0f} {}".format(value, unit)
+        value /= 1024
+    return "{:0.1f} TB".format(value)
+
+
+def format_seconds(value):
+    if value < 60:
+        return "{:0.1f}s".format(value)
+    (minutes, seconds,) = divmod(int(round(value)), 60)
+    (hours, minutes,) = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def stage_name(entry):
+    return entry['stage'] + ('/' + entry['layer'] if entry.get('layer') else '') if entry.get('stage') else entry['command'].split()[0]
+
+
+def print_timeline(entries, output=sys.stdout):
+    """ Print a timeline for each bucket in a list of log entries """
+    buckets = sorted(set(entry.get('bucket') or '-' for entry in entries))
+    for bucket in buckets:
+        bucket_entries = sorted((entry for entry in entries if (entry.get('bucket') or '-') == bucket), key=lambda entry: entry['start'])
+        first = bucket_entries[0]['start']
+        last = max(entry['start'] + entry['wall'] for entry in bucket_entries)
+        span = max(last - first, 1e-9)
+
+        print("\nBucket {} ({} elapsed)\n".format(bucket, format_seconds(last - first)), file=output)
+        print("{:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}  {:<{}}  {}".format(
+            'start', 'wall', 'cpu', 'peak RSS', 'read', 'written', 'output', 'timeline', BAR_WIDTH, 'stage'
+        ), file=output)
+        for entry in bucket_entries:
+            offset = int((entry['start'] - first) / span * BAR_WIDTH)
+            length = max(1, int(entry['wall'] / span * BAR_WIDTH))
+            bar = (' ' * offset + '#' * length)[:BAR_WIDTH]
+            print("{:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}  {:<{}}  {}{}".format(
+                format_seconds(entry['start'] - first),
+                format_seconds(entry['wall']),
+                format_seconds(entry['user'] + entry['sys']),
+                format_bytes(entry['max_rss_kb'] * 1024),
+                format_bytes(entry['read_bytes']),
+                format_bytes(entry['write_bytes']),
+                format_bytes(entry['output_bytes']),
+                bar, BAR_WIDTH,
+                stage_name(entry),
+                '' if entry['status'] == 0 else " (FAILED: {})".format(entry['status']),
+            ), file=output)
+
+        print("\nSlowest stages:", file=output)
+        for entry in sorted(bucket_entries, key=lambda entry: -entry['wall'])[:5]:
+            print("  {:>8} {:5.1f}%  {}".format(format_seconds(entry['wall']), 100 * entry['wall'] / span, stage_name(entry)), file=output)
+
+
+def print_comparison(old_entries, new_entries, output=sys.stdout):
+    """ Print the wall time of each bucket and stage in two runs, slowest changes first """
+
+    def totals(entries):
+        result = {}
+        for entry in entries:
+            key = (entry.get('bucket') or '-', stage_name(entry),)
+            result[key] = result.get(key, 0) + entry['wall']
+        return result
+
+    old = totals(old_entries)
+    new = totals(new_entries)
+    keys = sorted(set(old) | set(new), key=lambda key: -abs(new.get(key, 0) - old.get(key, 0)))
+
+    print("{:<10} {:>9} {:>9} {:>9} {:>8}  {}".format('bucket', 'old', 'new', 'change', '', 'stage'), file=output)
+    for key in keys:
+        (old_time, new_time,) = (old.get(key), new.get(key),)
+        change = (new_time or 0) - (old_time or 0)
+        percent = "{:+0.0f}%".format(100 * change / old_time) if old_time and new_time is not None else ''
+        print("{:<10} {:>9} {:>9} {:>9} {:>8}  {}".format(
+            key[0],
+            format_seconds(old_time) if old_time is not None else '-',
+            format_seconds(new_time) if new_time is not None else '-',
+            ('-' if change < 0 else '+') + format_seconds(abs(change)),
+            percent,
+            key[1],
+        ), file=output)
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} run [--stage=NAME] [--layer=NAME] [--bucket=BUCKET] [--output=PATH] [--log=FILE] [--run=ID] -- <command> [args...]".format(sys.argv[0]), file=sys.stderr)
+    print("       {} report [--run=ID] [--compare=ID] <log>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    args = sys.argv[2:]
+
+    if command == 'report': # allow options after the log filename
+        args = sorted(args, key=lambda arg: not arg.startswith('--'))
+
+    options = {}
+    outputs = []
+    while args and args[0].startswith('--') and args[0] != '--':
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key == 'output':
+            if value:
+                outputs.append(value)
+        elif value: # empty values (e.g. --bucket= with no BUCKET) are ignored
+            options[key] = value
+
+    if command == 'run':
+        if not args or args[0] != '--' or len(args) < 2 or not set(options) <= {'stage', 'layer', 'bucket', 'log', 'run'}:
+            usage()
+        try:
+            status = run(
+                args[1:], stage=options.get('stage'), layer=options.get('layer'), bucket=options.get('bucket'),
+                outputs=outputs, log=options.get('log'), run_id=options.get('run'),
+            )
+        except FileNotFoundError as e:
+            print(e, file=sys.stderr)
+            status = 127
+        sys.exit(status if status >= 0 else 128 - status) # killed by a signal, as in the shell
+
+    elif command == 'report':
+        if len(args) != 1 or not set(options) <= {'run', 'compare'}:
+            usage()
+        entries = read_log(args[0])
+        if not entries:
+            print("No entries in {}".format(args[0]), file=sys.stderr)
+            sys.exit(1)
+        run_id = options.get('run', entries[-1].get('run'))
+        run_entries = [entry for entry in entries if entry.get('run') == run_id]
+        if 'compare' in options:
+            print("Comparing run {} (old) with {} (new)\n".format(options['compare'], run_id))
+            print_comparison([entry for entry in entries if entry.get('run') == options['compare']], run_entries)
+        else:
+            print("Run {}".format(run_id))
+            print_timeline(run_entries)
+
+    else:
+        usage()
@@ -0,0 +1,408 @@
+""" Keep a valid copy of the landmass polygons in 1x1 deg cells, and extract buckets from it
+
+Extracting a bucket's landmass straight from land_polygons.shp runs
+ST_MakeValid on every coastline polygon in the area, so the same
+geometries are made valid again for every bucket (including the
+1 deg overlap with each neighbour) and every rebuild. Instead, the
+build command makes each source polygon valid once, clips it to the
+1x1 deg cells it touches, and writes one FlatGeobuf file per cell
+(with a spatial index) to <store-dir>/<bucket>/<cell>.fgb. Cells with
+no land have no file.
+
+The store is built one 10x10 deg bucket at a time, several at once
+in worker processes (by default, every bucket of the globe; those
+outside the source's extent are just marked empty). The index file <store-dir>/index.json records
+the source's size and modification time and the feature count in
+each cell, and is saved after each bucket, so an interrupted build
+picks up where it left off. If the source changes, the whole store
+is rebuilt. A build holds an exclusive lock on <store-dir>/.lock (and
+an extract a shared one), so a second build started at the same time
+waits for the first, then finds the buckets it built already done.
+
+The extract command finds the cells inside an area by their names
+and copies their features into one file (in any of the formats from
+partition.py), with no geometry operations at all. The features are
+clipped at the cell edges, and each one goes into only one cell, so
+nothing is duplicated where cells meet.
+
+Needs the GDAL Python bindings (osgeo.ogr), with GEOS.
+
+Usage:
+
+    python3 landmass-store.py build [--processes=N] [--bounds=MIN_LON,MIN_LAT,MAX_LON,MAX_LAT] <land_polygons.shp> <store-dir>
+    python3 landmass-store.py extract [--format=shp|fgb|gpkg] <store-dir> <min-lon> <min-lat> <max-lon> <max-lat> <output>
+
+Example (from the Makefile):
+
+    python3 landmass-store.py build --processes=8 01-inputs/land-polygons-split-4326/land_polygons.shp 02-prep/landmass-cells
+    python3 landmass-store.py extract 02-prep/landmass-cells -81 39 -69 51 02-prep/landmass/w080n40.shp
+
+"""
+
+import fcntl, json, multiprocessing, os, shutil, sys
+
+from math import ceil, floor
+
+from partition import FORMATS, get_format
+from tiles import get_bucket, get_cell, parse_bucket
+
+
+INDEX_VERSION = 1
+
+# Driver, extension, and layer creation options for the cell files
+CELL_FORMAT = FORMATS['fgb']
+
+
+#
+# Store layout
+#
+
+def get_index_path(store_dir):
+    """ Return the filename of the store's index """
+    return os.path.join(store_dir, 'index.json')
+
+
+def lock_store(store_dir, exclusive):
+    """ Wait for a lock on the store, and return the open lock file (the lock is released when it closes) """
+    os.makedirs(store_dir, exist_ok=True)
+    lock_file = open(os.path.join(store_dir, '.lock'), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return lock_file
+
+
+def get_cell_path(store_dir, lon, lat):
+    """ Return the filename for the cell with its southwest corner at lon, lat """
+    return os.path.join(store_dir, get_bucket(lon, lat), get_cell(lon, lat) + CELL_FORMAT[1])
+
+
+def list_cells(bounds):
+    """ Return the (lon, lat,) southwest corners of all 1x1 deg cells that overlap bounds """
+    (min_lon, min_lat, max_lon, max_lat,) = bounds
+    return [
+        (lon, lat,)
+        for lon in range(int(floor(min_lon)), max(int(ceil(max_lon)), int(floor(min_lon)) + 1))
+        for lat in range(int(floor(min_lat)), max(int(ceil(max_lat)), int(floor(min_lat)) + 1))
+        if -180 <= lon < 180 and -90 <= lat < 90
+    ]
+
+
+def list_buckets(bounds):
+    """ Return the sorted names of all buckets that overlap bounds """
+    return sorted(set(get_bucket(lon, lat) for (lon, lat,) in list_cells(bounds)))
+
+
+def get_source_signature(source):
+    """ Return the size and modification time of the source, to tell when it changes """
+    info = os.stat(source)
+    return {'path': os.path.abspath(source), 'size': info.st_size, 'mtime': info.st_mtime_ns}
+
+
+def load_index(store_dir):
+    """ Load the store's index, or return None if there isn't one """
+    try:
+        with open(get_index_path(store_dir), 'r') as input:
+            index = json.load(input)
+    except FileNotFoundError:
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def save_index(store_dir, index):
+    """ Save the store's index """
+    os.makedirs(store_dir, exist_ok=True)
+    filename = get_index_path(store_dir)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as output:
+        json.dump(index, output, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+#
+# Building the store
+#
+
+def get_polygons(geometry):
+    """ Return the polygonal parts of a geometry as a MultiPolygon, or None if there are none
+    (making a polygon valid or clipping it can leave stray lines and points)
+
+    """
+    from osgeo import ogr
+    if geometry is None or geometry.IsEmpty():
+        return None
+    type = ogr.GT_Flatten(geometry.GetGeometryType())
+    if type in (ogr.wkbPolygon, ogr.wkbMultiPolygon,):
+        return ogr.ForceToMultiPolygon(geometry.Clone())
+    if type == ogr.wkbGeometryCollection:
+        result = ogr.Geometry(ogr.wkbMultiPolygon)
+        for i in range(geometry.GetGeometryCount()):
+            part = get_polygons(geometry.GetGeometryRef(i))
+            if part is not None:
+                for j in range(part.GetGeometryCount()):
+                    result.AddGeometry(part.GetGeometryRef(j))
+        return result if result.GetGeometryCount() > 0 else None
+    return None
+
+
+def make_valid(geometry):
+    """ Return a valid copy of a geometry (MakeValid needs GDAL 3.0 and GEOS 3.8; otherwise buffer by 0) """
+    if geometry.IsValid():
+        return geometry
+    if hasattr(geometry, 'MakeValid'):
+        return geometry.MakeValid()
+    return geometry.Buffer(0)
+
+
+def make_box(min_lon, min_lat, max_lon, max_lat):
+    """ Return a rectangular polygon """
+    from osgeo import ogr
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for (lon, lat,) in ((min_lon, min_lat,), (max_lon, min_lat,), (max_lon, max_lat,), (min_lon, max_lat,), (min_lon, min_lat,)):
+        ring.AddPoint_2D(lon, lat)
+    box = ogr.Geometry(ogr.wkbPolygon)
+    box.AddGeometry(ring)
+    return box
+
+
+def build_bucket(task):
+    """ Write the cell files for one bucket, replacing any that are there (runs in a worker process)
+    Returns a tuple (bucket, counts, error,), where counts is a dict of feature counts by cell name
+
+    """
+    (source, store_dir, bucket,) = task
+    from osgeo import ogr, osr
+    ogr.UseExceptions()
+
+    bounds = parse_bucket(bucket)
+    bucket_dir = os.path.join(store_dir, bucket)
+    tmp_dir = bucket_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    (driver_name, extension, creation_options,) = CELL_FORMAT
+    driver = ogr.GetDriverByName(driver_name)
+    outputs = {}
+    counts = {}
+    try:
+        dataset = ogr.Open(source)
+        if dataset is None:
+            raise IOError("Can't open {}".format(source))
+        source_layer = dataset.GetLayer(0)
+        srs = source_layer.GetSpatialRef() or osr.SpatialReference()
+        source_layer.SetSpatialFilterRect(*bounds)
+
+        for feature in source_layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None or geometry.IsEmpty():
+                continue
+            geometry = make_valid(geometry)
+            (min_lon, max_lon, min_lat, max_lat,) = geometry.GetEnvelope()
+            for (lon, lat,) in list_cells((max(min_lon, bounds[0]), max(min_lat, bounds[1]), min(max_lon, bounds[2]), min(max_lat, bounds[3]),)):
+                if get_bucket(lon, lat) != bucket:
+                    continue
+                clipped = get_polygons(geometry.Intersection(make_box(lon, lat, lon + 1, lat + 1)))
+                if clipped is None:
+                    continue
+                cell = get_cell(lon, lat)
+                if cell not in outputs:
+                    cell_dataset = driver.CreateDataSource(os.path.join(tmp_dir, cell + extension))
+                    layer = cell_dataset.CreateLayer(cell, srs, ogr.wkbMultiPolygon, options=creation_options)
+                    outputs[cell] = (cell_dataset, layer, layer.GetLayerDefn(),)
+                    counts[cell] = 0
+                (layer, layer_definition,) = outputs[cell][1:]
+                output_feature = ogr.Feature(layer_definition)
+                output_feature.SetGeometry(clipped)
+                layer.CreateFeature(output_feature)
+                counts[cell] += 1
+    except Exception as e:
+        return (bucket, None, "{}: {}".format(bucket, e),)
+    finally:
+        # the files close when nothing refers to their datasets
+        dataset = source_layer = cell_dataset = layer = output_feature = None
+        outputs.clear()
+
+    if os.path.exists(bucket_dir):
+        shutil.rmtree(bucket_dir)
+    os.replace(tmp_dir, bucket_dir)
+    return (bucket, counts, None,)
+
+
+def get_source_bounds(source):
+    """ Return the extent of the source as (min_lon, min_lat, max_lon, max_lat,) """
+    from osgeo import ogr
+    ogr.UseExceptions()
+    dataset = ogr.Open(source)
+    if dataset is None:
+        raise IOError("Can't open {}".format(source))
+    (min_lon, max_lon, min_lat, max_lat,) = dataset.GetLayer(0).GetExtent()
+    return (min_lon, min_lat, max_lon, max_lat,)
+
+
+def build_store(source, store_dir, bounds=None, processes=1):
+    """ Build the store for the buckets overlapping bounds (default: the whole globe), skipping buckets already built from the same source
+    Buckets outside the source's extent are recorded as having no land, without reading the source.
+    Returns a list of error messages (empty if everything worked)
+
+    """
+    with lock_store(store_dir, exclusive=True):
+        return build_locked_store(source, store_dir, bounds, processes)
+
+
+def build_locked_store(source, store_dir, bounds, processes):
+    """ Build the store for build_store, once it holds the lock """
+    signature = get_source_signature(source)
+    index = load_index(store_dir)
+    if index is None or index['source'] != signature:
+        if index is not None:
+            print("{} has changed; rebuilding the store".format(source))
+        index = {'version': INDEX_VERSION, 'source': signature, 'buckets': {}}
+        # remove buckets from the old source, so that they can't be mistaken for current ones
+        if os.path.isdir(store_dir):
+            for name in os.listdir(store_dir):
+                if os.path.isdir(os.path.join(store_dir, name)):
+                    shutil.rmtree(os.path.join(store_dir, name))
+
+    buckets = list_buckets(bounds or (-180, -90, 180, 90,))
+    source_buckets = set(list_buckets(get_source_bounds(source)))
+    for bucket in buckets:
+        if bucket not in source_buckets:
+            index['buckets'][bucket] = {}
+    save_index(store_dir, index)
+    pending = [bucket for bucket in buckets if bucket not in index['buckets']]
+    print("Building {} of {} buckets".format(len(pending), len(buckets)))
+
+    errors = []
+    with multiprocessing.Pool(processes) as pool:
+        for (bucket, counts, error,) in pool.imap_unordered(build_bucket, [(source, store_dir, bucket,) for bucket in pending]):
+            if error is not None:
+                errors.append(error)
+                continue
+            index['buckets'][bucket] = counts
+            save_index(store_dir, index)
+            print("{}: {} features in {} cells".format(bucket, sum(counts.values()), len(counts)))
+    return errors
+
+
+#
+# Extracting from the store
+#
+
+def extract(store_dir, bounds, output, format=None):
+    """ Merge the cells overlapping bounds into one file, in the format given (default: by output's extension)
+    Raises an exception if any of the buckets overlapping bounds is missing from the store.
+    Returns the number of features written.
+
+    """
+    if not os.path.isdir(store_dir):
+        raise IOError("No landmass store in {} (run the build command first)".format(store_dir))
+    with lock_store(store_dir, exclusive=False):
+        return extract_locked(store_dir, bounds, output, format)
+
+
+def extract_locked(store_dir, bounds, output, format):
+    """ Extract from the store for extract, once it holds the lock """
+    from osgeo import gdal, ogr, osr
+    ogr.UseExceptions()
+
+    index = load_index(store_dir)
+    if index is None:
+        raise IOError("No landmass store in {} (run the build command first)".format(store_dir))
+    missing = [bucket for bucket in list_buckets(bounds) if bucket not in index['buckets']]
+    if missing:
+        raise IOError("Buckets missing from the landmass store: {}".format(' '.join(missing)))
+
+    if format is None:
+        format = get_format(output)
+    (driver_name, _, creation_options,) = FORMATS[format]
+    if format == 'gpkg':
+        from partition import GPKG_DATE
+        gdal.SetConfigOption('OGR_CURRENT_DATE', GPKG_DATE)
+
+    driver = ogr.GetDriverByName(driver_name)
+    if os.path.exists(output):
+        driver.DeleteDataSource(output)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    count = 0
+    output_dataset = driver.CreateDataSource(output)
+    try:
+        layer = output_dataset.CreateLayer(os.path.splitext(os.path.basename(output))[0], srs, ogr.wkbMultiPolygon, options=creation_options)
+        layer_definition = layer.GetLayerDefn()
+        for (lon, lat,) in list_cells(bounds):
+            if not index['buckets'][get_bucket(lon, lat)].get(get_cell(lon, lat)):
+                continue
+            cell_dataset = ogr.Open(get_cell_path(store_dir, lon, lat))
+            if cell_dataset is None:
+                raise IOError("Can't open {}".format(get_cell_path(store_dir, lon, lat)))
+            for feature in cell_dataset.GetLayer(0):
+                output_feature = ogr.Feature(layer_definition)
+                output_feature.SetGeometry(feature.GetGeometryRef())
+                layer.CreateFeature(output_feature)
+                count += 1
+            cell_dataset = None
+    except Exception:
+        output_dataset = layer = None
+        if os.path.exists(output):
+            driver.DeleteDataSource(output)
+        raise
+    finally:
+        # the file closes when nothing refers to its dataset
+        output_dataset = layer = output_feature = None
+
+    return count
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} build [--processes=N] [--bounds=MIN_LON,MIN_LAT,MAX_LON,MAX_LAT] <land_polygons.shp> <store-dir>".format(sys.argv[0]), file=sys.stderr)
+    print("       {} extract [--format=shp|fgb|gpkg] <store-dir> <min-lon> <min-lat> <max-lon> <max-lat> <output>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('build', 'extract',):
+        usage()
+
+    command = sys.argv[1]
+    options = {
+        'processes': '1',
+        'bounds': None,
+        'format': None,
+    }
+
+    args = sys.argv[2:]
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in options:
+            usage()
+        elif value:
+            options[key] = value
+
+    if command == 'build':
+        if len(args) != 2:
+            usage()
+        bounds = tuple(float(value) for value in options['bounds'].split(',')) if options['bounds'] else None
+        if bounds is not None and len(bounds) != 4:
+            usage()
+        errors = build_store(args[0], args[1], bounds, int(options['processes']))
+        if errors:
+            for error in errors:
+                print(error, file=sys.stderr)
+            sys.exit(1)
+
+    elif command == 'extract':
+        if len(args) != 6 or (options['format'] is not None and options['format'] not in FORMATS):
+            usage()
+        count = extract(args[0], tuple(float(value) for value in args[1:5]), args[5], options['format'])
+        print("{}: {} features".format(args[5], count))
+
+    sys.exit(0)
@@ -4,55 +4,22 @@ Include a 1 deg overlap on each side
 
 Usage:
 
-  python list-dem.py DEM_SOURCE_PATH BUCKET
+  python list-dem.py [--no-catalog] DEM_SOURCE_PATH BUCKET
 
 Where BUCKET is a 10x10 deg bucket name like w080n40.
 
-"""
-
-import pathlib, re, sys
-
-def parse_bucket (bucket):
-    """ Parse a bucket into its bounds, with a 1 deg overlap in each direction"""
+By default, files come from the DEM catalog (see demcatalog.py), which
+rescans only directories that changed since the last run. Use
+--no-catalog to walk the whole directory tree instead. Either way, a
+warning on stderr lists any 1x1 cells in the bucket without a file
+(normal for open ocean).
 
-    def norm_lon(lon):
-        if lon < -180:
-            lon = -180
-        elif lon > 180:
-            lon -= 180
-        return lon
+"""
 
-    def norm_lat(lat):
-        if lat < -90:
-            lat = -90
-        elif lat > 90:
-            lat = 90
-        return lat
-    
-    result = re.match(r'^([ew])(\d{3})([ns])(\d{2})$', bucket)
-    if not result:
-        raise Exception("Badly-formatted bucket " + bucket)
-    min_lon = norm_lon(int(result.group(2)) * (1 if result.group(1) == 'e' else -1))
-    min_lat = norm_lat(int(result.group(4)) * (1 if result.group(3) == 'n' else -1))
-    return (
-        norm_lon(min_lon - 1),
-        norm_lat(min_lat - 1),
-        norm_lon(min_lon + 11),
-        norm_lat(min_lat + 11),
-    )
-
-
-def get_bucket (lon, lat):
-    """ Get the 10x10 bucket that contains lon and lat (e.g. w080n40) """
-    lon -= lon % 10
-    lat -= lat % 10
-    return "{}{:03d}{}{:02d}".format(
-        "w" if lon < 0.0 else "e",
-        abs(lon),
-        "s" if lat < 0.0 else "n",
-        abs(lat)
-    )
+import pathlib, sys
 
+from demcatalog import find_tiles, format_cell, open_catalog, parse_dem_name
+from tiles import expand_bounds, parse_bucket
 
 def check_in_bounds(lon, lat, bounds):
     """ Check that a point appears in bounds 
@@ -71,12 +38,10 @@ def dem_file_in_bounds_p (filename, bounds):
     The filename is in the format N00W000 (etc) with a .tif or .hgt extension
     
     """
-    result = re.match(r'([NS])(\d{2})([EW])(\d{3}).*\.(TIF|HGT)$', filename.upper())
-    if not result:
+    latlon = parse_dem_name(filename)
+    if latlon is None:
         raise Exception("Badly-formatted DEM name " + filename)
-    lat = int(result.group(2)) * (1 if result.group(1) == 'N' else -1)
-    lon = int(result.group(4)) * (1 if result.group(3) == 'E' else -1)
-    return check_in_bounds(lon, lat, bounds)
+    return check_in_bounds(latlon[1], latlon[0], bounds)
 
 
 def find_matching_dem_files (input_dir, bounds):
@@ -93,20 +58,50 @@ def find_matching_dem_files (input_dir, bounds):
     return sorted(files)
 
 
+def find_missing_cells (files, bounds):
+    """ Return a sorted list of (lat, lon,) 1x1 deg cells in bounds with none of the DEM files
+    Bounds format: (min_lon, min_lat, max_lon, max_lat,); the max edges are exclusive
+
+    """
+    present = set(parse_dem_name(pathlib.Path(file).name) for file in files)
+    (min_lon, min_lat, max_lon, max_lat,) = bounds
+    return [
+        (lat, lon,)
+        for lat in range(min_lat, max_lat)
+        for lon in range(min_lon, max_lon)
+        if (lat, lon,) not in present
+    ]
+
+
 #
 # Run the script from the command line
 #
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-       print("Usage: {} INPUT_DIR BUCKET".format(sys.argv[0]), file=sys.stderr)
+    args = sys.argv[1:]
+    use_catalog = True
+    if args and args[0] == '--no-catalog':
+        use_catalog = False
+        args.pop(0)
+
+    if len(args) != 2:
+       print("Usage: {} [--no-catalog] INPUT_DIR BUCKET".format(sys.argv[0]), file=sys.stderr)
        sys.exit(2)
 
-    INPUT_DIR=sys.argv[1]
-    BUCKET=sys.argv[2]
+    INPUT_DIR=args[0]
+    BUCKET=args[1]
 
-    bounds = parse_bucket(BUCKET)
-    files = find_matching_dem_files(INPUT_DIR, bounds)
+    bounds = expand_bounds(parse_bucket(BUCKET), 1)
+    if use_catalog:
+        files = find_tiles(open_catalog(INPUT_DIR), bounds)
+    else:
+        files = find_matching_dem_files(INPUT_DIR, bounds)
     for file in files:
         print(file)
 
+    missing = find_missing_cells(files, parse_bucket(BUCKET))
+    if missing:
+        print("Warning: no DEM file for {} of 100 cells in {}: {}".format(
+            len(missing), BUCKET, ' '.join(format_cell(lat, lon) for (lat, lon,) in missing)
+        ), file=sys.stderr)
+
     exit(0)
@@ -1,70 +1,337 @@
 """ Generate a JSON index of Dropbox download links
 
-Requires a private token in the file config/dropbox-token.txt (not included in the git repo)
+Each bucket has its latest full release, and a list of "deltas" with
+only the files that changed since an older release (from
+package-release.py delta), for the deltas that lead to the latest one.
+
+Every page of the Dropbox /Downloads listing is read. Shared links are
+saved in a cache file, keyed by file name and Dropbox content hash, so
+a later run reuses the link for any file that hasn't changed, and only
+new or changed files need a request to Dropbox. Those requests run a
+few at a time, and a request that fails with a transient error (e.g.
+a rate limit) is retried after a backoff.
+
+Dropbox is reached through a client object (DropboxClient). LocalClient
+has the same methods, but lists a local directory and makes file://
+links, so the script can run without a token or a network (e.g. for
+benchmark.py).
+
+Requires a private token in the file config/dropbox-config.json (not included in the git repo)
 
 Usage:
 
-  $ cat config/dropbox-token.txt | python3 make-download-index.py > html/download-links.json
+    python3 make-download-links.py [options] <config.json> <links-output.txt> > docs/download-links.json
+
+Options:
+
+  --jobs=N           links to create at once (default: 4)
+  --retries=N        times to retry a failed request (default: 3)
+  --cache=FILE       JSON cache of links from earlier runs (default: none)
+  --local=DIR        use LocalClient, with DIR as the Dropbox root (config.json isn't read)
+  --local-delay=SEC  seconds that each LocalClient request takes (default: 0)
+
+The JSON index goes to standard output, and the URLs of the full
+releases go to links-output.txt, one per line (for batch downloads).
 
 """
 
-import dropbox, json, re, sys
+import concurrent.futures, hashlib, json, os, re, sys, threading, time
+
+
+CACHE_VERSION = 1
+
+# Dropbox folder with the releases
+DOWNLOADS_FOLDER = '/Downloads'
+
+# Full releases (.tar.zst since the packager started compressing; older buckets are still plain .tar)
+RELEASE_PATTERN = re.compile(r'^fgfs-americas-scenery-([ew][0-9]{3}[ns][0-9]{2})-([0-9]{8})\.tar(\.zst)?$')
+
+# Deltas are named for the release they update and the release they lead to
+DELTA_PATTERN = re.compile(r'^fgfs-americas-scenery-([ew][0-9]{3}[ns][0-9]{2})-([0-9]{8})-([0-9]{8})\.tar\.zst$')
+
+# Seconds to wait before the first retry (doubles for each later retry)
+RETRY_DELAY = 2
+
+# Size of the blocks in a Dropbox content hash
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class RemoteFile:
+    """ A file in a client's folder listing """
+
+    __slots__ = ('name', 'size', 'content_hash',)
+
+    def __init__(self, name, size, content_hash):
+        self.name = name
+        self.size = size
+        self.content_hash = content_hash
+
+
+class DropboxClient:
+    """ Lists folders and creates shared links with the Dropbox API """
+
+    def __init__(self, token):
+        import dropbox, requests
+        self.dropbox = dropbox
+        self.token = token
+        self.local = threading.local()
+        # errors worth retrying
+        self.retry_errors = (
+            dropbox.exceptions.RateLimitError, dropbox.exceptions.InternalServerError, requests.exceptions.RequestException,
+        )
+
+    def get_connection(self):
+        """ Return a Dropbox connection for the current thread """
+        if not hasattr(self.local, 'dbx'):
+            self.local.dbx = self.dropbox.Dropbox(self.token)
+        return self.local.dbx
+
+    def list_page(self, path, cursor=None):
+        """ Return a tuple (files, cursor,) for one page of a folder listing, starting a new listing if cursor is None
+        The returned cursor is None after the last page.
+
+        """
+        dbx = self.get_connection()
+        result = dbx.files_list_folder(path) if cursor is None else dbx.files_list_folder_continue(cursor)
+        files = [
+            RemoteFile(entry.name, entry.size, entry.content_hash)
+            for entry in result.entries if isinstance(entry, self.dropbox.files.FileMetadata)
+        ]
+        return (files, result.cursor if result.has_more else None,)
+
+    def create_link(self, path):
+        """ Return a shared link for a file (the existing one, if there is one) """
+        return self.get_connection().sharing_create_shared_link(path).url
+
+
+class LocalClient:
+    """ Stands in for DropboxClient, using a local directory as the Dropbox root """
 
-if len(sys.argv) != 3:
-    print("Usage: python3 {} CONFIG.json LINKS_OUTPUT.txt", file=sys.stderr)
-    exit(2)
+    PAGE_SIZE = 100
 
-config_file = sys.argv[1]
-links_file = sys.argv[2]
+    def __init__(self, root, delay=0):
+        self.root = os.path.abspath(root)
+        self.delay = delay
+        self.retry_errors = ()
 
-with open(config_file, 'r') as input:
-    config = json.load(input)
+    def list_page(self, path, cursor=None):
+        """ Return a tuple (files, cursor,) for one page of a folder listing, as DropboxClient does """
+        time.sleep(self.delay)
+        dir = os.path.join(self.root, path.lstrip('/'))
+        names = sorted(name for name in os.listdir(dir) if os.path.isfile(os.path.join(dir, name)))
+        start = cursor or 0
+        files = [
+            RemoteFile(name, os.path.getsize(os.path.join(dir, name)), get_content_hash(os.path.join(dir, name)))
+            for name in names[start:start+self.PAGE_SIZE]
+        ]
+        return (files, start + self.PAGE_SIZE if start + self.PAGE_SIZE < len(names) else None,)
 
-dbx = dropbox.Dropbox(config["token"])
+    def create_link(self, path):
+        """ Return a file:// link for a file, in the form of a Dropbox preview link """
+        time.sleep(self.delay)
+        return 'file://' + os.path.join(self.root, path.lstrip('/')) + '?dl=0'
 
-# list all the files in the /Downloads director
-listing = dbx.files_list_folder("/Downloads")
 
-downloads = {}
+def get_content_hash(filename):
+    """ Return the Dropbox content hash of a local file (SHA-256 of the SHA-256 of each 4 MB block) """
+    hash = hashlib.sha256()
+    with open(filename, 'rb') as input:
+        for block in iter(lambda: input.read(CONTENT_HASH_BLOCK_SIZE), b''):
+            hash.update(hashlib.sha256(block).digest())
+    return hash.hexdigest()
 
-# iterate over all files that match the pattern
-for entry in sorted(listing.entries, key=lambda entry: entry.name):
 
-    if isinstance(entry, dropbox.files.FileMetadata):
-        result = re.match('^fgfs-americas-scenery-([ew][0-9]{3}[ns][0-9]{2})-([0-9]{8}).tar$', entry.name)
+def list_folder(client, path):
+    """ Return every file in a folder, reading all the pages of the listing """
+    (files, cursor,) = client.list_page(path)
+    while cursor is not None:
+        (more_files, cursor,) = client.list_page(path, cursor)
+        files += more_files
+    return files
+
+
+def get_download_url(url):
+    """ Change a shared link to download the file directly instead of showing a preview """
+    if "?dl=0" in url:
+        return url.replace('?dl=0', '?dl=1')
+    elif "&dl=0" in url:
+        return url.replace('&dl=0', '&dl=1')
+    else:
+        return url + "?dl=1"
+
+
+def create_link(client, path, retries):
+    """ Create a shared link, retrying transient errors with a backoff """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return client.create_link(path)
+        except client.retry_errors as e:
+            if attempts > retries:
+                raise
+            # Dropbox says how long to back off after a rate limit
+            delay = getattr(e, 'backoff', None) or RETRY_DELAY * 2 ** (attempts - 1)
+            print("{}: {}; retrying in {} s".format(path, e, delay), file=sys.stderr)
+            time.sleep(delay)
+
+
+def load_cache(filename):
+    """ Load the cached links, as a dict of {name: {"content_hash": ..., "url": ...}}, or return an empty dict """
+    if filename is None:
+        return {}
+    try:
+        with open(filename, 'r') as input:
+            cache = json.load(input)
+    except FileNotFoundError:
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache['links']
+
+
+def save_cache(filename, links):
+    """ Save the cached links """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as output:
+        json.dump({'version': CACHE_VERSION, 'links': links}, output, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def get_links(client, folder, files, cache, jobs=4, retries=3):
+    """ Get a download URL for each file, from the cache if its name and content hash match, or from the client
+    Returns a tuple (links, failed,), where links is a new cache dict with just these files, and failed is a list of names
+
+    """
+    links = {}
+    pending = []
+    for file in files:
+        cached = cache.get(file.name)
+        if cached is not None and cached['content_hash'] == file.content_hash:
+            links[file.name] = cached
+        else:
+            pending.append(file)
+    print("{} links from the cache, {} to create".format(len(links), len(pending)), file=sys.stderr)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(create_link, client, "{}/{}".format(folder, file.name), retries): file
+            for file in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            file = futures[future]
+            try:
+                links[file.name] = {'content_hash': file.content_hash, 'url': get_download_url(future.result())}
+            except Exception as e:
+                print("{}: can't create a link: {}".format(file.name, e), file=sys.stderr)
+                failed.append(file.name)
+    return (links, sorted(failed),)
+
+
+def make_index(client, cache, jobs=4, retries=3):
+    """ Make the index of download links for the latest release of each bucket, and its deltas
+    Returns a tuple (downloads, links, failed,), where links is the new cache and failed is a list of file names
+
+    """
+    releases = {}
+    deltas = {}
+    for file in sorted(list_folder(client, DOWNLOADS_FOLDER), key=lambda file: file.name):
+        result = RELEASE_PATTERN.match(file.name)
+        if result:
+            # the latest release replaces the earlier ones
+            releases[result.group(1)] = (file, result.group(2),)
+            continue
+        result = DELTA_PATTERN.match(file.name)
         if result:
+            deltas.setdefault(result.group(1), []).append((file, result.group(2), result.group(3),))
+
+    # only the deltas that lead to the latest release
+    for bucket in deltas:
+        deltas[bucket] = [delta for delta in deltas[bucket] if bucket in releases and delta[2] == releases[bucket][1]]
+
+    files = [file for (file, _,) in releases.values()] + [delta[0] for bucket_deltas in deltas.values() for delta in bucket_deltas]
+    (links, failed,) = get_links(client, DOWNLOADS_FOLDER, files, cache, jobs, retries)
+
+    downloads = {}
+    for bucket in sorted(releases):
+        (file, date,) = releases[bucket]
+        if file.name not in links:
+            continue
+        downloads[bucket] = {
+            "name": file.name,
+            "date": date,
+            "url": links[file.name]['url'],
+            "size": file.size,
+            "deltas": [
+                {
+                    "name": delta.name,
+                    "from": from_date,
+                    "date": to_date,
+                    "url": links[delta.name]['url'],
+                    "size": delta.size,
+                }
+                for (delta, from_date, to_date,) in deltas.get(bucket, []) if delta.name in links
+            ],
+        }
+    return (downloads, links, failed,)
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--jobs=N] [--retries=N] [--cache=FILE] [--local=DIR] [--local-delay=SEC] <config.json> <links-output.txt>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    options = {
+        'jobs': '4',
+        'retries': '3',
+        'cache': None,
+        'local': None,
+        'local-delay': '0',
+    }
 
-            # extract fields from the filename
-            bucket = result.group(1)
-            date = result.group(2)
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in options:
+            usage()
+        elif value:
+            options[key] = value
 
-            # get existing shared link or create a new one
-            sharing = dbx.sharing_create_shared_link("/Downloads/{}".format(entry.name))
+    if len(args) != 2:
+        usage()
 
-            url = sharing.url
+    (config_file, links_file,) = args
 
+    if options['local']:
+        client = LocalClient(options['local'], float(options['local-delay']))
+    else:
+        with open(config_file, 'r') as input:
+            config = json.load(input)
+        client = DropboxClient(config["token"])
 
-            if "?dl=0" in url:
-                url = url.replace('?dl=0', '?dl=1')
-            elif "&dl=0" in url:
-                url = url.replace('&dl=0', '&dl=1')
-            else:
-                url = url + "?dl=1"
+    (downloads, links, failed,) = make_index(client, load_cache(options['cache']), int(options['jobs']), int(options['retries']))
 
-            # add the new entry
-            downloads[bucket] = {
-                "name": entry.name,
-                "date": date,
-                "url": url,
-                "size": entry.size,
-            }
+    # keep the links that worked, even if some didn't
+    if options['cache']:
+        save_cache(options['cache'], links)
 
-# Save the output as JSON
-print(json.dumps(downloads, indent=2))
+    if failed:
+        print("Failed to create links for: {}".format(' '.join(failed)), file=sys.stderr)
+        sys.exit(1)
 
-with open(links_file, 'w') as output:
-    for bucket in downloads:
-        print(downloads[bucket]['url'], file=output)
+    # Save the output as JSON
+    print(json.dumps(downloads, indent=2))
 
+    with open(links_file, 'w') as output:
+        for bucket in downloads:
+            print(downloads[bucket]['url'], file=output)
 
-exit()
+    sys.exit(0)
@@ -0,0 +1,216 @@
+""" Generate the OSM extraction queries from config/osm-layers.tsv
+
+The ogr2ogr steps that extract OSM lines and areas from the PBF used
+hand-written queries in the Makefile, which had to be kept in step
+with the layers TSV and grew to take in features that no layer uses
+(e.g. every feature with a natural tag). This script builds the
+queries from the included TSV rows instead, so the extracts have only
+features that some layer will decode, and only the attribute columns
+that the layer queries refer to.
+
+Simple layer queries (field = 'value' or field IN (...)) on the same
+field are merged into one IN (...); other queries are included as
+they are. Duplicate values and queries are dropped.
+
+Usage:
+
+    python3 osm-queries.py sql [--min-area=DEG2] [--osmconf=FILE] <layers.tsv> <area|line>
+    python3 osm-queries.py report <layers.tsv> <area|line> <shapefile>
+
+sql: print an OGR SQL SELECT statement for ogr2ogr -sql. With
+--min-area, features smaller than DEG2 square degrees are left out of
+the layers with "yes" in the TSV's "Min area" column (e.g. landuse
+areas), but not out of the others (e.g. water). With --osmconf, check that every field the queries use is one of
+the attributes in the GDAL OSM driver configuration.
+
+report: count the features in an extracted shapefile for each layer
+(the first match, as in partition.py), and the features that no layer
+uses, with the bytes they take up (estimated from the size of their
+geometries). Running it on an extract made with an older, wider query
+shows what the generated query saves. Needs the GDAL Python bindings.
+
+"""
+
+import os, sys
+
+from partition import compile_query, read_layers, tokenize
+
+
+# OGR OSM driver layer for each type of layer in the TSV
+OSM_LAYERS = {
+    'area': 'multipolygons',
+    'line': 'lines',
+}
+
+# Shapefile parts, for the total size of an extract (FlatGeobuf and GeoPackage extracts are single files)
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg', '.qix',)
+
+
+def parse_simple_query(query):
+    """ Return (field, [values],) if a query is just field = literal or field IN (literals), or None """
+    tokens = tokenize(query)
+    if len(tokens) == 3 and tokens[0][0] == 'field' and tokens[1] == ('op', '=',) and tokens[2][0] == 'literal':
+        return (tokens[0][1], [tokens[2][1]],)
+    if len(tokens) >= 5 and tokens[0][0] == 'field' and tokens[1] == ('keyword', 'in',) and tokens[2] == ('op', '(',) and tokens[-1] == ('op', ')',):
+        values = tokens[3:-1:2]
+        separators = tokens[4:-1:2]
+        if all(token[0] == 'literal' for token in values) and all(token == ('op', ',',) for token in separators):
+            return (tokens[0][1], [token[1] for token in values],)
+    return None
+
+
+def format_literal(value):
+    """ Format a literal for OGR SQL """
+    if isinstance(value, float):
+        return "{:g}".format(value)
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def make_where(layers):
+    """ Return an OGR SQL where clause that matches any feature that some layer's query matches """
+    values_by_field = {}
+    others = []
+    for layer in layers:
+        query = layer['query'].strip()
+        simple = parse_simple_query(query)
+        if simple is not None:
+            values = values_by_field.setdefault(simple[0], [])
+            values += [value for value in simple[1] if value not in values]
+        elif query not in others:
+            others.append(query)
+
+    terms = []
+    for field in sorted(values_by_field):
+        values = sorted(values_by_field[field], key=str)
+        terms.append("{} IN ({})".format(field, ', '.join(format_literal(value) for value in values)))
+    terms += ['(' + query + ')' for query in others]
+    return ' OR '.join(terms)
+
+
+def get_fields(layers):
+    """ Return a sorted list of all the fields that the layers' queries use """
+    fields = set()
+    for layer in layers:
+        fields.update(compile_query(layer['query'])[1])
+    return sorted(fields)
+
+
+def make_sql(layers, type, min_area=None):
+    """ Return an OGR SQL statement to extract the features used by a list of layers
+    If min_area is not None, it applies only to the layers with "yes" in the TSV's min_area column.
+
+    """
+    if min_area is None:
+        where = make_where(layers) or '0 = 1'
+    else:
+        sized_layers = [layer for layer in layers if layer['min_area'] == 'yes']
+        terms = []
+        if len(sized_layers) < len(layers):
+            terms.append('(' + make_where([layer for layer in layers if layer['min_area'] != 'yes']) + ')')
+        if sized_layers:
+            terms.append("(OGR_GEOM_AREA >= {} AND ({}))".format(min_area, make_where(sized_layers)))
+        where = ' OR '.join(terms) or '0 = 1'
+    return "SELECT {} FROM {} WHERE {}".format(', '.join(get_fields(layers)) or '*', OSM_LAYERS[type], where)
+
+
+def read_osmconf_attributes(filename, type):
+    """ Return the set of attributes that the GDAL OSM driver configuration gives a layer
+    (The file has settings before the first section, so configparser can't read it.)
+
+    """
+    section = None
+    attributes = set()
+    with open(filename, 'r') as input:
+        for line in input:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1]
+            elif section == OSM_LAYERS[type] and line.startswith('attributes='):
+                attributes.update(attribute.strip().lower() for attribute in line[11:].split(',') if attribute.strip())
+    return attributes
+
+
+def report_extract(layers, shapefile, output=sys.stdout):
+    """ Print the feature counts for each layer in an extract, and the features and bytes no layer uses """
+    from osgeo import ogr
+    ogr.UseExceptions()
+
+    queries = [(layer['name'], compile_query(layer['query'])[0],) for layer in layers]
+    fields = get_fields(layers)
+    counts = {name: 0 for (name, _,) in queries}
+    unused = 0
+    unused_bytes = 0
+    total = 0
+    total_bytes = 0
+
+    source = ogr.Open(shapefile)
+    source_layer = source.GetLayer(0)
+    definition = source_layer.GetLayerDefn()
+    field_indices = {name: definition.GetFieldIndex(name) for name in fields}
+    for feature in source_layer:
+        row = {field: feature.GetField(i) if i >= 0 and feature.IsFieldSetAndNotNull(i) else None for field, i in field_indices.items()}
+        geometry = feature.GetGeometryRef()
+        size = geometry.WkbSize() if geometry is not None else 0
+        total += 1
+        total_bytes += size
+        for (name, function,) in queries:
+            if function(row):
+                counts[name] += 1
+                break
+        else:
+            unused += 1
+            unused_bytes += size
+
+    (base, ext,) = os.path.splitext(shapefile)
+    if ext.lower() == '.shp':
+        file_bytes = sum(os.path.getsize(base + ext) for ext in SHAPEFILE_EXTENSIONS if os.path.exists(base + ext))
+    else:
+        file_bytes = os.path.getsize(shapefile)
+    saved_bytes = int(file_bytes * unused_bytes / total_bytes) if total_bytes else 0
+
+    for name, count in counts.items():
+        print("{:>10,d}  {}".format(count, name), file=output)
+    print("{:>10,d}  (no layer)".format(unused), file=output)
+    print("{}: {:,d} of {:,d} features used by no layer; about {:,d} of {:,d} bytes could be saved".format(
+        shapefile, unused, total, saved_bytes, file_bytes,
+    ), file=output)
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} sql [--min-area=DEG2] [--osmconf=FILE] <layers.tsv> <area|line>".format(sys.argv[0]), file=sys.stderr)
+    print("       {} report <layers.tsv> <area|line> <shapefile>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    args = sys.argv[2:]
+
+    options = {}
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in ('min-area', 'osmconf',) or not value:
+            usage()
+        options[key] = value
+
+    if command == 'sql' and len(args) == 2 and args[1] in OSM_LAYERS:
+        layers = read_layers(args[0], args[1])
+        if 'osmconf' in options:
+            missing = set(get_fields(layers)) - read_osmconf_attributes(options['osmconf'], args[1])
+            if missing:
+                print("Fields not in the attributes for {} in {}: {}".format(OSM_LAYERS[args[1]], options['osmconf'], ', '.join(sorted(missing))), file=sys.stderr)
+                sys.exit(1)
+        print(make_sql(layers, args[1], options.get('min-area')))
+
+    elif command == 'report' and not options and len(args) == 3 and args[1] in OSM_LAYERS:
+        report_extract(read_layers(args[0], args[1]), args[2])
+
+    else:
+        usage()
+
+    sys.exit(0)
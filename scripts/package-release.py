@@ -0,0 +1,410 @@
+""" Package a scenery bucket as a zstd-compressed tarball with a manifest
+
+Replaces the single-threaded, uncompressed tar in the Makefile's
+archive target. The files are listed and hashed by several threads at
+once, then written to a tar stream that the zstd command compresses
+with several threads, so a bucket's download is a fraction of the
+size of the old .tar.
+
+Next to the tarball, <archive>.manifest.tsv lists every file in it
+(path, size, and SHA-256), in the same order. After writing, the
+tarball is read back and checked against the manifest, and both are
+moved into place only if they match. Tar members are sorted and have
+no owner, so the same files make the same tar stream.
+
+Usage:
+
+    python3 package-release.py pack [options] <archive.tar.zst> <base-dir> <path...>
+    python3 package-release.py verify <archive.tar.zst> [manifest.tsv]
+    python3 package-release.py delta [options] <old> <new> <delta.tar.zst>
+
+pack: write the files and directories <path...> (relative to
+<base-dir>, and named that way in the tarball) to the archive.
+
+Options:
+
+  --threads=N  threads for hashing and for zstd (default: 1)
+  --level=N    zstd compression level (default: 10)
+
+verify: check an archive against its manifest (by default,
+<archive>.manifest.tsv).
+
+delta: compare two releases by content hash, and write a delta
+archive (with its own manifest) of the files that were added or
+changed, so that users with the old release can download only those.
+<old> is a manifest, an archive (using its manifest), or a directory;
+<new> is an archive or a directory. The delta also has a script,
+<top-level dir>/Deltas/<delta name>.sh, to run after unpacking it: it
+removes the files that are gone from the new release and checks the
+ones that were unpacked. Nothing is written if nothing changed.
+
+Example (from the Makefile):
+
+    python3 package-release.py pack --threads=8 fgfs-americas-scenery-w080n40-20240911.tar.zst . \\
+        fgfs-americas-scenery/Airports fgfs-americas-scenery/Terrain/w080n40
+
+    python3 package-release.py delta --threads=8 fgfs-americas-scenery-w080n40-20240911.tar.zst.manifest.tsv \\
+        fgfs-americas-scenery-w080n40-20240920.tar.zst fgfs-americas-scenery-w080n40-20240911-20240920.tar.zst
+
+Unpack with "tar --zstd -xf <archive>" (or "zstd -d" then "tar xf").
+
+"""
+
+import concurrent.futures, contextlib, csv, hashlib, io, os, subprocess, sys, tarfile, time
+
+
+# Columns in the manifest
+MANIFEST_FIELDS = ('path', 'size', 'sha256',)
+
+# Default zstd compression level (the higher levels are much slower for little gain)
+ZSTD_LEVEL = 10
+
+# Bytes to read at a time when hashing or copying
+READ_SIZE = 1024 * 1024
+
+
+def get_manifest_path(archive):
+    """ Return the default manifest filename for an archive """
+    return archive + '.manifest.tsv'
+
+
+def walk_files(base_dir, path):
+    """ Return the relative paths of all the regular files under a path in base_dir """
+    full_path = os.path.join(base_dir, path)
+    if os.path.isfile(full_path):
+        return [path]
+    paths = []
+    for (dir, _, filenames,) in os.walk(full_path):
+        for filename in filenames:
+            if os.path.isfile(os.path.join(dir, filename)):
+                paths.append(os.path.relpath(os.path.join(dir, filename), base_dir))
+    return paths
+
+
+def hash_file(filename):
+    """ Return a tuple (size, sha256,) for a file """
+    digest = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as input:
+        for block in iter(lambda: input.read(READ_SIZE), b''):
+            digest.update(block)
+            size += len(block)
+    return (size, digest.hexdigest(),)
+
+
+def list_files(base_dir, paths, threads=1):
+    """ Walk and hash the files under a list of paths in base_dir, several directories and files at a time
+    Returns a list of manifest rows (path, size, sha256,), sorted by path
+
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        # walk each top-level subdirectory separately (e.g. each cell of a bucket)
+        roots = []
+        for path in paths:
+            full_path = os.path.join(base_dir, path)
+            if not os.path.exists(full_path):
+                raise FileNotFoundError("No such file or directory: {}".format(full_path))
+            if os.path.isdir(full_path):
+                with os.scandir(full_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir() or entry.is_file():
+                            roots.append(os.path.join(path, entry.name))
+            else:
+                roots.append(path)
+        filenames = sorted(set(name for names in executor.map(lambda root: walk_files(base_dir, root), roots) for name in names))
+
+        hashes = executor.map(lambda filename: hash_file(os.path.join(base_dir, filename)), filenames)
+        return [(filename.replace(os.sep, '/'), size, sha256,) for (filename, (size, sha256,),) in zip(filenames, hashes)]
+
+
+def write_manifest(filename, rows):
+    """ Write a manifest TSV file """
+    with open(filename, 'w', encoding='utf-8', newline='') as output:
+        writer = csv.writer(output, delimiter='\t', quoting=csv.QUOTE_NONE, lineterminator='\n')
+        writer.writerow(MANIFEST_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+
+
+def read_manifest(filename):
+    """ Read a manifest TSV file into a list of (path, size, sha256,) rows """
+    rows = []
+    with open(filename, 'r', encoding='utf-8', newline='') as input:
+        reader = csv.reader(input, delimiter='\t', quoting=csv.QUOTE_NONE)
+        next(reader, None) # skip the header
+        for row in reader:
+            rows.append((row[0], int(row[1]), row[2],))
+    return rows
+
+
+def file_members(base_dir, rows):
+    """ Yield a tuple (TarInfo, file,) for each file in a list of manifest rows, read from base_dir """
+    for (path, _, _,) in rows:
+        filename = os.path.join(base_dir, path)
+        stat = os.stat(filename)
+        info = tarfile.TarInfo(path)
+        info.size = stat.st_size
+        info.mtime = stat.st_mtime
+        info.mode = stat.st_mode & 0o7777
+        with open(filename, 'rb') as input:
+            yield (info, input,)
+
+
+def archive_members(tar, paths):
+    """ Yield a tuple (TarInfo, file,) for each member of an open archive whose name is in paths """
+    for info in tar:
+        if info.isfile() and info.name in paths:
+            yield (info, tar.extractfile(info),)
+
+
+@contextlib.contextmanager
+def open_archive(archive):
+    """ Open a zstd-compressed tarball to read as a stream (in order, once) """
+    process = subprocess.Popen(['zstd', '-q', '-d', '-c', archive], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+            yield tar
+        # read any padding after the end of the tar, so that zstd can finish
+        while process.stdout.read(READ_SIZE):
+            pass
+    finally:
+        process.stdout.close()
+        status = process.wait()
+    if status != 0:
+        raise IOError("zstd failed to decompress {} (status {})".format(archive, status))
+
+
+def write_tar(archive, members, threads=1, level=ZSTD_LEVEL):
+    """ Write (TarInfo, file,) tuples to a zstd-compressed tarball
+    Returns the exit status of zstd
+
+    """
+    process = subprocess.Popen(
+        ['zstd', '-q', '-f', '-T{}'.format(threads), '-{}'.format(level), '-o', archive],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        with tarfile.open(fileobj=process.stdin, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for (info, input,) in members:
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                tar.addfile(info, input)
+    finally:
+        process.stdin.close()
+        status = process.wait()
+    return status
+
+
+def verify_archive(archive, rows):
+    """ Check that an archive has exactly the files in a list of manifest rows, in order
+    Returns a list of problems (empty if it matches)
+
+    """
+    problems = []
+    expected = iter(rows)
+    try:
+        with open_archive(archive) as tar:
+            for info in tar:
+                row = next(expected, None)
+                if row is None:
+                    problems.append("{}: not in the manifest".format(info.name))
+                    continue
+                if info.name != row[0]:
+                    problems.append("{}: expected {}".format(info.name, row[0]))
+                    continue
+                digest = hashlib.sha256()
+                input = tar.extractfile(info)
+                for block in iter(lambda: input.read(READ_SIZE), b''):
+                    digest.update(block)
+                if (info.size, digest.hexdigest(),) != (row[1], row[2],):
+                    problems.append("{}: size or SHA-256 doesn't match the manifest".format(info.name))
+    except (tarfile.TarError, IOError) as e:
+        problems.append("{}: {}".format(archive, e))
+    for row in expected:
+        problems.append("{}: missing from the archive".format(row[0]))
+    return problems
+
+
+def write_release(archive, rows, members, threads=1, level=ZSTD_LEVEL):
+    """ Write an archive and its manifest, and move them into place if the archive verifies
+    Returns a list of problems (empty if it worked)
+
+    """
+    manifest = get_manifest_path(archive)
+    tmp_archive = archive + '.tmp'
+    tmp_manifest = manifest + '.tmp'
+    write_manifest(tmp_manifest, rows)
+    problems = []
+    status = write_tar(tmp_archive, members, threads, level)
+    if status != 0:
+        problems.append("zstd failed with status {}".format(status))
+    else:
+        problems = verify_archive(tmp_archive, read_manifest(tmp_manifest))
+
+    if problems:
+        for filename in (tmp_archive, tmp_manifest,):
+            if os.path.exists(filename):
+                os.remove(filename)
+        return problems
+
+    os.replace(tmp_archive, archive)
+    os.replace(tmp_manifest, manifest)
+    print("Wrote {} ({:,d} bytes) and {}".format(archive, os.path.getsize(archive), manifest))
+    return []
+
+
+def pack(archive, base_dir, paths, threads=1, level=ZSTD_LEVEL):
+    """ Write the files under a list of paths in base_dir to an archive with a manifest
+    Returns a list of problems (empty if it worked)
+
+    """
+    rows = list_files(base_dir, paths, threads)
+    print("Packing {} files ({:,d} bytes) into {}".format(len(rows), sum(row[1] for row in rows), archive))
+    return write_release(archive, rows, file_members(base_dir, rows), threads, level)
+
+
+#
+# Deltas
+#
+
+def read_release_rows(source, threads=1):
+    """ Return the manifest rows for a manifest file, an archive (from its manifest), or a directory tree """
+    if os.path.isdir(source):
+        return list_files(source, sorted(os.listdir(source)), threads)
+    if source.endswith('.tsv'):
+        return read_manifest(source)
+    return read_manifest(get_manifest_path(source))
+
+
+def quote_shell(value):
+    """ Quote a string for sh """
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def make_apply_script(name, changed, removed):
+    """ Return the text of a shell script that finishes applying an unpacked delta
+    It removes the files that the delta deletes, then checks the files that it adds or changes.
+
+    """
+    lines = [
+        '#!/bin/sh',
+        '# Finish applying the scenery delta {}'.format(name),
+        '# Unpack the delta where the scenery is installed, then run this script',
+        '',
+        'set -e',
+        'cd "$(dirname "$0")/../.."',
+        '',
+    ]
+    for path in removed:
+        lines.append('rm -f {}'.format(quote_shell(path)))
+    lines += [
+        '',
+        'if command -v sha256sum > /dev/null; then',
+        '    sha256sum -c --quiet << \'END_OF_SUMS\'',
+    ]
+    for (path, _, sha256,) in changed:
+        lines.append('{}  {}'.format(sha256, path))
+    lines += [
+        'END_OF_SUMS',
+        'fi',
+        '',
+        'echo "Applied {}: {} files added or changed, {} removed"'.format(name, len(changed), len(removed)),
+        '',
+    ]
+    return "\n".join(lines).encode('utf-8')
+
+
+def make_delta(old, new, delta, threads=1, level=ZSTD_LEVEL):
+    """ Write a delta archive with the files that are new or changed from old to new, and a script to remove the rest
+    old is a manifest, an archive with a manifest, or a directory; new is an archive with a manifest or a directory.
+    The script goes in <top-level dir>/Deltas/<delta name>.sh, and is the last member of the archive.
+    Returns a list of problems (empty if it worked)
+
+    """
+    old_rows = read_release_rows(old, threads)
+    new_rows = read_release_rows(new, threads)
+    old_files = {path: (size, sha256,) for (path, size, sha256,) in old_rows}
+    new_paths = set(path for (path, _, _,) in new_rows)
+
+    changed = [row for row in new_rows if old_files.get(row[0]) != (row[1], row[2],)]
+    removed = sorted(set(old_files) - new_paths)
+    print("{} files added or changed, {} removed (of {})".format(len(changed), len(removed), len(new_rows)))
+    if not changed and not removed:
+        print("No changes; no delta written")
+        return []
+
+    name = os.path.basename(delta)
+    if name.endswith('.tar.zst'):
+        name = name[:-8]
+    top = new_rows[0][0].split('/')[0] if new_rows else 'delta'
+    script = make_apply_script(name, changed, removed)
+    script_info = tarfile.TarInfo('{}/Deltas/{}.sh'.format(top, name))
+    script_info.size = len(script)
+    script_info.mode = 0o755
+    script_info.mtime = time.time()
+    rows = changed + [(script_info.name, len(script), hashlib.sha256(script).hexdigest(),)]
+
+    def get_members(tar=None):
+        if tar is None:
+            yield from file_members(new, changed)
+        else:
+            yield from archive_members(tar, set(path for (path, _, _,) in changed))
+        yield (script_info, io.BytesIO(script),)
+
+    if os.path.isdir(new):
+        return write_release(delta, rows, get_members(), threads, level)
+    try:
+        with open_archive(new) as tar:
+            return write_release(delta, rows, get_members(tar), threads, level)
+    except (tarfile.TarError, IOError) as e:
+        return ["{}: {}".format(new, e)]
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} pack [--threads=N] [--level=N] <archive.tar.zst> <base-dir> <path...>".format(sys.argv[0]), file=sys.stderr)
+    print("       {} verify <archive.tar.zst> [manifest.tsv]".format(sys.argv[0]), file=sys.stderr)
+    print("       {} delta [--threads=N] [--level=N] <old> <new> <delta.tar.zst>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    args = sys.argv[2:]
+
+    options = {
+        'threads': '1',
+        'level': str(ZSTD_LEVEL),
+    }
+    while command in ('pack', 'delta',) and args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key not in options:
+            usage()
+        elif value:
+            options[key] = value
+
+    if command == 'pack' and len(args) >= 3:
+        problems = pack(args[0], args[1], args[2:], int(options['threads']), int(options['level']))
+
+    elif command == 'delta' and len(args) == 3:
+        problems = make_delta(args[0], args[1], args[2], int(options['threads']), int(options['level']))
+
+    elif command == 'verify' and len(args) in (1, 2,):
+        manifest = args[1] if len(args) == 2 else get_manifest_path(args[0])
+        problems = verify_archive(args[0], read_manifest(manifest))
+        if not problems:
+            print("{}: OK".format(args[0]))
+
+    else:
+        usage()
+
+    if problems:
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
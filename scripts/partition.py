@@ -0,0 +1,384 @@
+""" Split a shapefile into one small shapefile per layer, in a single pass
+
+Without this, every row of a layers TSV file runs ogr-decode --where
+against the whole extract, so a multi-GB shapefile is read and its
+attributes tested once per layer. Instead, this module reads each
+feature once, tests it against the queries of all the layers, and
+writes it to <output-dir>/<layer-name>.shp. Each ogr-decode then reads
+only its own features, with no --where.
+
+The per-layer files have the same format as the input (shapefile,
+FlatGeobuf, or GeoPackage, by extension) unless --format says
+otherwise. FlatGeobuf and GeoPackage files get a spatial index as
+they're written.
+
+By default, each feature goes only to the first layer whose query it
+matches, in TSV order. With all_matches (--all-matches), it's copied
+to every matching layer, as separate --where queries did; the build
+(decode-layers.py) needs that, because some layers share a query on
+purpose (e.g. each highway easement and its road layer). Only
+geometries are written.
+
+The queries use the subset of OGR SQL found in the layers TSV files:
+field comparisons with a literal (=, !=, <>, <, <=, >, >=), IN (...),
+IS [NOT] NULL, AND, OR, NOT, and parentheses, with SQL NULL logic.
+
+Reading and writing need the GDAL Python bindings (osgeo.ogr); the
+query compiler doesn't.
+
+Command-line usage:
+
+    python3 partition.py [--all-matches] [--format=shp|fgb|gpkg] <layers.tsv> <area|line> <shapefile> <output-dir>
+
+"""
+
+import csv, os, re, sys
+
+
+# Columns in the layers TSV files
+TSV_FIELDS = ('name', 'include', 'type', 'material', 'line_width', 'query', 'min_area',)
+
+# Defaults for the optional columns at the end (min_area: whether the minimum feature area applies; see osm-queries.py)
+TSV_DEFAULTS = {'min_area': 'no'}
+
+# Keep the .dbf header date fixed, so that unchanged layers have unchanged files (for the build cache)
+DBF_DATE = '2000-01-01'
+
+# OGR driver, extension, and layer creation options for each output format
+FORMATS = {
+    'shp': ('ESRI Shapefile', '.shp', ['DBF_DATE_LAST_UPDATE=' + DBF_DATE],),
+    'fgb': ('FlatGeobuf', '.fgb', ['SPATIAL_INDEX=YES'],),
+    'gpkg': ('GPKG', '.gpkg', ['SPATIAL_INDEX=YES'],),
+}
+
+# Timestamp for GeoPackage metadata, fixed for the same reason as DBF_DATE
+GPKG_DATE = DBF_DATE + 'T00:00:00.000Z'
+
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*')
+    |(?P<number>-?\d+(?:\.\d+)?)
+    |(?P<op><>|!=|<=|>=|=|<|>|\(|\)|,)
+    |(?P<word>[A-Za-z_][A-Za-z0-9_:]*)
+    |(?P<quoted>"[^"]+")
+)""", re.VERBOSE)
+
+COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+class QueryError(Exception):
+    pass
+
+
+#
+# Query compiler
+#
+
+def tokenize(query):
+    """ Split an OGR SQL where clause into a list of (kind, value,) tuples """
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        result = TOKEN_PATTERN.match(query, pos)
+        if not result or result.end() == pos:
+            raise QueryError("Can't parse query at \"{}\"".format(query[pos:]))
+        pos = result.end()
+        kind = result.lastgroup
+        value = result.group(kind)
+        if kind == 'string':
+            tokens.append(('literal', value[1:-1].replace("''", "'"),))
+        elif kind == 'number':
+            tokens.append(('literal', float(value),))
+        elif kind == 'quoted':
+            tokens.append(('field', value[1:-1].lower(),))
+        elif kind == 'word' and value.lower() in ('and', 'or', 'not', 'in', 'is', 'null',):
+            tokens.append(('keyword', value.lower(),))
+        elif kind == 'word':
+            tokens.append(('field', value.lower(),))
+        else:
+            tokens.append(('op', value,))
+    return tokens
+
+
+def coerce(value, literal):
+    """ Convert a field value for comparison with a literal, or return None if it's NULL """
+    if value is None:
+        return None
+    if isinstance(literal, float):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return str(value)
+
+
+def compile_query(query):
+    """ Compile an OGR SQL where clause into a function
+    The function takes a dict of lower-case field names and values, and
+    returns True, False, or None (SQL NULL, which doesn't match).
+
+    Returns a tuple (function, fields,) where fields is the set of field names used.
+
+    """
+    tokens = tokenize(query)
+    fields = set()
+    pos = 0
+
+    def peek(kind=None, value=None):
+        if pos >= len(tokens):
+            return False
+        return (kind is None or tokens[pos][0] == kind) and (value is None or tokens[pos][1] == value)
+
+    def take(kind=None, value=None):
+        nonlocal pos
+        if not peek(kind, value):
+            raise QueryError("Expected {} in \"{}\"".format(value or kind, query))
+        pos += 1
+        return tokens[pos - 1][1]
+
+    def parse_or():
+        terms = [parse_and()]
+        while peek('keyword', 'or'):
+            take()
+            terms.append(parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        def evaluate(row):
+            result = False
+            for term in terms:
+                value = term(row)
+                if value:
+                    return True
+                elif value is None:
+                    result = None
+            return result
+        return evaluate
+
+    def parse_and():
+        terms = [parse_not()]
+        while peek('keyword', 'and'):
+            take()
+            terms.append(parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        def evaluate(row):
+            result = True
+            for term in terms:
+                value = term(row)
+                if value is False:
+                    return False
+                elif value is None:
+                    result = None
+            return result
+        return evaluate
+
+    def parse_not():
+        if peek('keyword', 'not'):
+            take()
+            term = parse_not()
+            def evaluate(row):
+                value = term(row)
+                return None if value is None else not value
+            return evaluate
+        return parse_term()
+
+    def parse_term():
+        if peek('op', '('):
+            take()
+            term = parse_or()
+            take('op', ')')
+            return term
+
+        field = take('field')
+        fields.add(field)
+
+        if peek('keyword', 'is'):
+            take()
+            negate = peek('keyword', 'not')
+            if negate:
+                take()
+            take('keyword', 'null')
+            return lambda row: (row.get(field) is None) != negate
+
+        negate = peek('keyword', 'not')
+        if negate:
+            take()
+        if peek('keyword', 'in'):
+            take()
+            take('op', '(')
+            literals = [take('literal')]
+            while peek('op', ','):
+                take()
+                literals.append(take('literal'))
+            take('op', ')')
+            def evaluate(row):
+                values = [coerce(row.get(field), literal) for literal in literals]
+                if values[0] is None:
+                    return None
+                return any(value == literal for value, literal in zip(values, literals)) != negate
+            return evaluate
+        if negate:
+            raise QueryError("Expected IN after NOT in \"{}\"".format(query))
+
+        compare = COMPARISONS[take('op')] if peek('op') and tokens[pos][1] in COMPARISONS else None
+        if compare is None:
+            raise QueryError("Expected a comparison after {} in \"{}\"".format(field, query))
+        literal = take('literal')
+        def evaluate(row):
+            value = coerce(row.get(field), literal)
+            return None if value is None else compare(value, literal)
+        return evaluate
+
+    function = parse_or()
+    if pos != len(tokens):
+        raise QueryError("Unexpected \"{}\" in \"{}\"".format(tokens[pos][1], query))
+    return (function, fields,)
+
+
+def read_layers(filename, type):
+    """ Read the included layers of one type (area or line) from a layers TSV file
+    Returns a list of dicts with the keys in TSV_FIELDS, in TSV order (optional columns get TSV_DEFAULTS)
+
+    """
+    layers = []
+    with open(filename, 'r', encoding='utf-8', newline='') as input:
+        reader = csv.reader(input, delimiter='\t', quoting=csv.QUOTE_NONE)
+        next(reader, None) # skip the header
+        for row in reader:
+            if len(row) < len(TSV_FIELDS) - len(TSV_DEFAULTS):
+                continue
+            layer = dict(TSV_DEFAULTS)
+            layer.update(zip(TSV_FIELDS, row))
+            if layer['include'] == 'yes' and layer['type'] == type:
+                layers.append(layer)
+    return layers
+
+
+#
+# Partitioning
+#
+
+def get_format(filename):
+    """ Return the format of a data file from its extension (shp if it isn't one of FORMATS) """
+    extension = os.path.splitext(filename)[1].lower()
+    for format, (_, format_extension, _,) in FORMATS.items():
+        if extension == format_extension:
+            return format
+    return 'shp'
+
+
+def layer_path(output_dir, name, format='shp'):
+    """ Return the filename of a layer's partition """
+    return os.path.join(output_dir, name + FORMATS[format][1])
+
+
+def partition_layers(layers, shapefile, output_dir, all_matches=False, format=None):
+    """ Write the features of a shapefile to one file per layer in output_dir
+    The files are in the same format as the shapefile (see get_format), unless format is given.
+    Every layer gets a file, even if it has no features.
+    Returns a dict of feature counts by layer name.
+
+    """
+    from osgeo import gdal, ogr, osr
+    ogr.UseExceptions()
+
+    if format is None:
+        format = get_format(shapefile)
+    (driver_name, _, creation_options,) = FORMATS[format]
+    if format == 'gpkg':
+        gdal.SetConfigOption('OGR_CURRENT_DATE', GPKG_DATE)
+
+    queries = [(layer['name'], compile_query(layer['query']),) for layer in layers]
+    fields = set()
+    for (name, (function, query_fields,),) in queries:
+        fields.update(query_fields)
+
+    source = ogr.Open(shapefile)
+    if source is None:
+        raise IOError("Can't open {}".format(shapefile))
+    source_layer = source.GetLayer(0)
+    definition = source_layer.GetLayerDefn()
+    field_indices = {}
+    for i in range(definition.GetFieldCount()):
+        field_name = definition.GetFieldDefn(i).GetName().lower()
+        if field_name in fields:
+            field_indices[field_name] = i
+    # a field missing from the shapefile is always NULL, as in OGR SQL
+    for field in sorted(fields - set(field_indices)):
+        print("Warning: no field {} in {}".format(field, shapefile), file=sys.stderr)
+
+    os.makedirs(output_dir, exist_ok=True)
+    driver = ogr.GetDriverByName(driver_name)
+    outputs = {}
+    for (name, _,) in queries:
+        path = layer_path(output_dir, name, format)
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        dataset = driver.CreateDataSource(path)
+        layer = dataset.CreateLayer(
+            name, source_layer.GetSpatialRef() or osr.SpatialReference(), source_layer.GetGeomType(),
+            options=creation_options,
+        )
+        outputs[name] = (dataset, layer, layer.GetLayerDefn(),)
+    counts = {name: 0 for (name, _,) in queries}
+
+    try:
+        for feature in source_layer:
+            row = {field: feature.GetField(i) if feature.IsFieldSetAndNotNull(i) else None for field, i in field_indices.items()}
+            for (name, (function, _,),) in queries:
+                if function(row):
+                    (_, layer, layer_definition,) = outputs[name]
+                    output_feature = ogr.Feature(layer_definition)
+                    output_feature.SetGeometry(feature.GetGeometryRef())
+                    layer.CreateFeature(output_feature)
+                    counts[name] += 1
+                    if not all_matches:
+                        break
+    finally:
+        # the files close when nothing refers to their datasets
+        dataset = layer = output_feature = None
+        outputs.clear()
+
+    return counts
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--all-matches] [--format=shp|fgb|gpkg] <layers.tsv> <area|line> <shapefile> <output-dir>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    all_matches = False
+    format = None
+    while args and args[0].startswith('--'):
+        arg = args.pop(0)
+        if arg == '--all-matches':
+            all_matches = True
+        elif arg.startswith('--format=') and arg[9:] in FORMATS:
+            format = arg[9:]
+        else:
+            usage()
+
+    if len(args) != 4 or args[1] not in ('area', 'line',):
+        usage()
+
+    (tsv_file, type, shapefile, output_dir,) = args
+    counts = partition_layers(read_layers(tsv_file, type), shapefile, output_dir, all_matches, format)
+    for name, count in counts.items():
+        print("{}: {} features".format(name, count))
+
+    sys.exit(0)
@@ -7,6 +7,7 @@ set -e
 
 cd 04-output
 
-for file in $HOME/Dropbox/Downloads/fgfs-canada-us-scenery*.tar; do
-    tar xvf $file
+for file in $HOME/Dropbox/Downloads/fgfs-americas-scenery*.tar $HOME/Dropbox/Downloads/fgfs-americas-scenery*.tar.zst; do
+    [ -f $file ] || continue
+    tar xvf $file # GNU tar recognises .tar.zst
 done
@@ -1,20 +1,34 @@
-import io, re, sys
-
-if len(sys.argv) == 2:
-    output_dir = sys.argv[1]
-else:
-    print("Usage: cat <file> | python3 {} <output-dir>".format(sys.argv[0]), file=sys.stderr)
-    sys.exit(2)
-
-with io.open(sys.stdin.fileno(),'r',encoding='latin-1') as input:
-    for line in input:
-        result = re.match(r'^1\s+\d+\s+\d+\s+\d+\s+([a-zA-Z0-9]+).*$', line)
-        if result:
-            code = result.group(1)
-            filename = "{}/{}.apt.dat".format(output_dir, code)
+""" Split an apt.dat file into one file per land airport
+
+Usage:
+
+    cat apt.dat | python3 split-airports.py <output-dir>
+
+Each airport is saved as <output-dir>/<ident>.apt.dat
+
+"""
+
+import io, os, sys
+
+from aptdat import read_airports
+
+
+def split_airports(output_dir, input):
+    """ Save each land airport in input to its own file in output_dir """
+    for airport in read_airports(input, rows=(), keep_lines=True):
+        if airport.type == '1':
+            filename = os.path.join(output_dir, "{}.apt.dat".format(airport.ident))
             with open(filename, 'w') as output:
-                print(line, file=output, end='')
-                for line in input:
-                    if re.match(r'^\s+$', line):
-                        break
-                    print(line, file=output, end='')
+                output.writelines(airport.lines)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 2:
+        output_dir = sys.argv[1]
+    else:
+        print("Usage: cat <file> | python3 {} <output-dir>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
+
+    with io.open(sys.stdin.fileno(),'r',encoding='latin-1') as input:
+        split_airports(output_dir, input)
@@ -0,0 +1,184 @@
+""" Split an OSM PBF file into expanded PBF files for many buckets at once
+
+Clipping the PBF for each bucket with osmconvert reads the whole
+hemisphere file once per bucket. Instead, this script gives osmium
+extract a config file with one extract per bucket (the bucket expanded
+by 1 deg in each direction, as in the Makefile's SPAT_EXPANDED), so the
+source is read once for all of them. The smart strategy completes ways
+and multipolygon and boundary relations, like osmconvert's
+--complete-ways --complete-multipolygons --complete-boundaries.
+
+osmium keeps a set of IDs in memory for each extract, so memory grows
+with the number of extracts in a pass. --max-extracts limits that: with
+more buckets than that, the buckets are split into several passes (the
+default is enough for config/bucket-list.txt in one pass). Each
+extract has its own output, and osmium compresses PBF blocks with a
+pool of --threads threads.
+
+A bucket is skipped if its output is already newer than the source,
+so after a new planet or hemisphere file, rerunning refreshes every
+bucket, and rerunning after a failure only does what's left. Outputs
+are written to temporary files and renamed when osmium succeeds. Each
+osmium run is measured for the timings log (see instrument.py).
+
+Usage:
+
+    python3 split-osm.py [options] <source.osm.pbf> <output-dir> [bucket...]
+
+Options:
+
+  --bucket-list=FILE  also split the buckets in FILE (one per line)
+  --max-extracts=N    buckets to extract in each pass (default: 32)
+  --threads=N         osmium threads (default: osmium's own default)
+  --force             split buckets even if their outputs are up to date
+
+Each bucket goes to <output-dir>/<bucket>.osm.pbf.
+
+Example (from the Makefile):
+
+    python3 split-osm.py --bucket-list=config/bucket-list.txt --threads=8 01-inputs/osm/planet-latest.osm.pbf 02-prep/osm
+
+"""
+
+import json, os, sys, tempfile
+
+import instrument
+
+from tiles import expand_bounds, parse_bucket
+
+
+# osmium extract options (see osmium-extract(1))
+OSMIUM_OPTS = ('--strategy=smart', '--option=types=multipolygon,boundary', '--overwrite', '--no-progress',)
+
+# Degrees to expand each bucket by
+EXPAND = 1
+
+
+def read_bucket_list(filename):
+    """ Read bucket names, one per line, skipping blank lines and # comments """
+    with open(filename, 'r') as input:
+        return [line.strip() for line in input if line.strip() and not line.startswith('#')]
+
+
+def get_output_path(output_dir, bucket):
+    """ Return the PBF filename for a bucket """
+    return os.path.join(output_dir, bucket + '.osm.pbf')
+
+
+def is_current(output, source):
+    """ Check whether an output exists and is newer than the source """
+    try:
+        return os.path.getmtime(output) > os.path.getmtime(source)
+    except FileNotFoundError:
+        return False
+
+
+def make_config(output_dir, buckets):
+    """ Return an osmium extract config (as a dict) with an expanded extract for each bucket, written to temporary files """
+    return {
+        'directory': os.path.abspath(output_dir),
+        'extracts': [
+            {
+                'output': os.path.basename(get_output_path(output_dir, bucket)) + '.tmp',
+                'output_format': 'pbf',
+                'description': bucket,
+                'bbox': list(expand_bounds(parse_bucket(bucket), EXPAND)),
+            }
+            for bucket in buckets
+        ],
+    }
+
+
+def extract_buckets(source, output_dir, buckets, threads=None):
+    """ Extract the PBF files for a list of buckets in a single osmium run
+    Returns the exit status of osmium
+
+    """
+    env = dict(os.environ)
+    if threads is not None:
+        env['OSMIUM_POOL_THREADS'] = str(threads)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as config_file:
+        json.dump(make_config(output_dir, buckets), config_file, indent=1)
+        config_file.flush()
+        status = instrument.run(
+            ['osmium', 'extract', '--config=' + config_file.name] + list(OSMIUM_OPTS) + [source],
+            stage='osm-split', layer='{} buckets'.format(len(buckets)), bucket=buckets[0] if len(buckets) == 1 else None, env=env,
+        )
+
+    for bucket in buckets:
+        output = get_output_path(output_dir, bucket)
+        if status == 0:
+            os.replace(output + '.tmp', output)
+        elif os.path.exists(output + '.tmp'):
+            os.remove(output + '.tmp')
+    return status
+
+
+def split_osm(source, output_dir, buckets, max_extracts=32, threads=None, force=False):
+    """ Split the source into the PBF files for any buckets that aren't up to date, max_extracts buckets per pass
+    Returns a list of the buckets that failed
+
+    """
+    pending = [bucket for bucket in dict.fromkeys(buckets) if force or not is_current(get_output_path(output_dir, bucket), source)]
+    print("Splitting {} of {} buckets from {}".format(len(pending), len(set(buckets)), source))
+
+    os.makedirs(output_dir, exist_ok=True)
+    failed = []
+    for i in range(0, len(pending), max_extracts):
+        batch = pending[i:i+max_extracts]
+        print("Extracting {}".format(' '.join(batch)))
+        if extract_buckets(source, output_dir, batch, threads) != 0:
+            failed += batch
+    return failed
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--bucket-list=FILE] [--max-extracts=N] [--threads=N] [--force] <source.osm.pbf> <output-dir> [bucket...]".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    options = {
+        'bucket-list': None,
+        'max-extracts': '32',
+        'threads': None,
+    }
+    force = False
+
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        (key, _, value,) = args.pop(0)[2:].partition('=')
+        if key == 'force' and not value:
+            force = True
+        elif key not in options:
+            usage()
+        elif value: # empty values (e.g. --threads= with no THREADS) are ignored
+            options[key] = value
+
+    if len(args) < 2:
+        usage()
+
+    (source, output_dir, buckets,) = (args[0], args[1], args[2:],)
+    if options['bucket-list']:
+        buckets += read_bucket_list(options['bucket-list'])
+    if not buckets:
+        usage()
+    for bucket in buckets:
+        parse_bucket(bucket) # fail early on a bad bucket name
+
+    failed = split_osm(
+        source, output_dir, buckets, int(options['max-extracts']),
+        int(options['threads']) if options['threads'] else None, force,
+    )
+
+    if failed:
+        print("Failed to split: {}".format(' '.join(failed)), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,272 @@
+""" FlightGear scenery tile and bucket geometry
+
+Calculates the index of the tile containing a point, matching the
+tile numbering that tg-construct uses (e.g. for --tile-id), the
+inverse (the bounds of a tile), and the bounds of 10x10 deg buckets
+(e.g. w080n40).
+
+tile_indices() is a vectorized version of tile_index() for NumPy
+arrays or lists of points (NumPy is needed only for that function).
+
+Command-line usage:
+
+    python3 tiles.py index < points.txt
+    python3 tiles.py bounds <tile-index> [tile-index...]
+    python3 tiles.py bbox <min-lon> <min-lat> <max-lon> <max-lat>
+    python3 tiles.py bucket [--expand=DEG] <bucket>
+
+index: read "lat lon" pairs (whitespace- or comma-separated) from
+standard input, one per line, and print the tile index for each.
+
+bounds: print "min_lon min_lat max_lon max_lat" for each tile.
+
+bbox: print the index of every tile touching a bounding box.
+
+bucket: print "min_lon min_lat max_lon max_lat" for a bucket,
+optionally expanded in each direction (clamped to the globe).
+
+"""
+
+import bisect, re, sys
+
+from math import floor, trunc
+
+TILE_WIDTHS = (
+    (-89.0, 12.0,),
+    (-86.0, 4.0,),
+    (-83.0, 2.0,),
+    (-76.0, 1.0,),
+    (-62.0, 0.5,),
+    (-22.0, 0.25,),
+    (22.0, 0.125,),
+    (62.0, 0.25,),
+    (76.0, 0.5,),
+    (83.0, 1.0,),
+    (86.0, 2.0,),
+    (89.0, 4.0,),
+    (90.0, 12.0),
+)
+
+# Upper latitude limits from TILE_WIDTHS, for bisect lookups
+TILE_WIDTH_LATS = [entry[0] for entry in TILE_WIDTHS]
+
+# Tiles are always 1/8 deg high
+TILE_HEIGHT = 0.125
+
+# Number of points to handle at once in the command-line index command
+BATCH_SIZE = 1000000
+
+
+#
+# Tiles
+#
+
+def get_tile_width(lat):
+    """ Look up the tile width in degrees for a latitude """
+    i = bisect.bisect_right(TILE_WIDTH_LATS, lat)
+    return TILE_WIDTHS[min(i, len(TILE_WIDTHS) - 1)][1]
+
+
+def tile_index(lat, lon):
+    """ Return the index of the tile containing lat, lon """
+    if lat < -90 or lat > 90:
+        raise ValueError("Latitude out of range: {}".format(lat))
+    if lon < -180 or lon > 180:
+        raise ValueError("Longitude out of range: {}".format(lon))
+
+    tile_width = get_tile_width(lat)
+
+    # Do the calculations
+    base_y = floor(lat)
+    y = trunc((lat - base_y) * 8)
+    base_x = floor(floor(lon / tile_width) * tile_width)
+    x = int(floor((lon - base_x) / tile_width))
+    return (int(base_x + 180) << 14) + (int(lat + 90) << 6) + (y << 3) + x
+
+
+def tile_indices(lats, lons):
+    """ Return a NumPy array of the indices of the tiles containing each lat, lon
+    Same calculation as tile_index(), for array-likes of points.
+
+    """
+    import numpy
+
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    if numpy.any((lats < -90) | (lats > 90)):
+        raise ValueError("Latitude out of range")
+    if numpy.any((lons < -180) | (lons > 180)):
+        raise ValueError("Longitude out of range")
+
+    widths = numpy.array([entry[1] for entry in TILE_WIDTHS])
+    tile_widths = widths[numpy.minimum(numpy.searchsorted(TILE_WIDTH_LATS, lats, side='right'), len(widths) - 1)]
+
+    base_y = numpy.floor(lats)
+    y = numpy.trunc((lats - base_y) * 8).astype(numpy.int64)
+    base_x = numpy.floor(numpy.floor(lons / tile_widths) * tile_widths)
+    x = numpy.floor((lons - base_x) / tile_widths).astype(numpy.int64)
+    return ((base_x + 180).astype(numpy.int64) << 14) + ((lats + 90).astype(numpy.int64) << 6) + (y << 3) + x
+
+
+def tile_bounds(index):
+    """ Return the bounds of a tile as (min_lon, min_lat, max_lon, max_lat,) """
+    index = int(index)
+    x = index & 0x07
+    y = (index >> 3) & 0x07
+    min_lat = ((index >> 6) & 0xff) - 90 + y * TILE_HEIGHT
+    tile_width = get_tile_width(min_lat + TILE_HEIGHT / 2)
+    min_lon = (index >> 14) - 180 + x * tile_width
+    return (min_lon, min_lat, min_lon + tile_width, min_lat + TILE_HEIGHT,)
+
+
+def tiles_in_bbox(min_lon, min_lat, max_lon, max_lat):
+    """ Return a sorted list of the indices of all tiles that touch a bounding box """
+    tiles = set()
+    row_lat = floor(min_lat / TILE_HEIGHT) * TILE_HEIGHT
+    while row_lat <= max_lat and row_lat < 90:
+        lat = row_lat + TILE_HEIGHT / 2 # use the middle of the row
+        tile_width = get_tile_width(lat)
+        col_lon = floor(min_lon / tile_width) * tile_width
+        while col_lon <= max_lon and col_lon < 180:
+            tiles.add(tile_index(lat, max(-180, col_lon + tile_width / 2)))
+            col_lon += tile_width
+        row_lat += TILE_HEIGHT
+    return sorted(tiles)
+
+
+#
+# Buckets
+#
+
+def parse_bucket(bucket):
+    """ Parse a bucket into a 4-element tuple
+    (min_lon, min_lat, max_lon, max_lat,)
+
+    """
+
+    result = re.match(r'^([ew])(\d{3})([ns])(\d{2})$', bucket.lower())
+    if not result:
+        raise Exception("Badly formatted bucket \"{}\"".format(bucket))
+    min_lon = int(result.group(2))
+    if result.group(1) == 'w':
+        min_lon *= -1
+    min_lat = int(result.group(4))
+    if result.group(3) == 's':
+        min_lat *= -1
+
+    return (min_lon, min_lat, min_lon+10, min_lat+10,)
+
+
+def expand_bounds(bounds, margin=1):
+    """ Expand bounds by margin degrees in each direction, without going past the edges of the globe """
+    return (
+        max(-180, bounds[0] - margin),
+        max(-90, bounds[1] - margin),
+        min(180, bounds[2] + margin),
+        min(90, bounds[3] + margin),
+    )
+
+
+def get_bucket(lon, lat):
+    """ Get the name of the 10x10 bucket that contains lon and lat (e.g. w080n40) """
+    lon = int(floor(lon / 10) * 10)
+    lat = int(floor(lat / 10) * 10)
+    return "{}{:03d}{}{:02d}".format(
+        "w" if lon < 0 else "e",
+        abs(lon),
+        "s" if lat < 0 else "n",
+        abs(lat),
+    )
+
+
+def get_cell(lon, lat):
+    """ Get the name of the 1x1 deg cell that contains lon and lat (e.g. w074n40)
+    TerraGear keeps each tile's work files in <bucket>/<cell>/
+
+    """
+    lon = int(floor(lon))
+    lat = int(floor(lat))
+    return "{}{:03d}{}{:02d}".format(
+        "w" if lon < 0 else "e",
+        abs(lon),
+        "s" if lat < 0 else "n",
+        abs(lat),
+    )
+
+
+def get_point_buckets(lon, lat):
+    """ Return the names of all buckets containing a point
+    A point on a bucket edge belongs to the buckets on both sides.
+
+    """
+    min_lon = int(floor(lon / 10) * 10)
+    min_lat = int(floor(lat / 10) * 10)
+    lons = [min_lon]
+    lats = [min_lat]
+    if lon == min_lon and min_lon > -180:
+        lons.append(min_lon - 10)
+    if lat == min_lat and min_lat > -90:
+        lats.append(min_lat - 10)
+    return [get_bucket(x, y) for x in lons for y in lats if x < 180 and y < 90]
+
+
+def bucket_tiles(bucket):
+    """ Return a sorted list of the indices of all tiles inside a bucket """
+    (min_lon, min_lat, max_lon, max_lat,) = parse_bucket(bucket)
+    # stay just inside the edges, so that neighbouring tiles aren't included
+    return tiles_in_bbox(min_lon, min_lat, max_lon - 1e-9, max_lat - 1e-9)
+
+
+#
+# Command line
+#
+
+def print_batch_indices(input, output):
+    """ Read lat/lon pairs from input and write the tile index for each to output """
+    import numpy
+
+    def flush(lines):
+        values = numpy.array(' '.join(lines).replace(',', ' ').split(), dtype=numpy.float64).reshape(-1, 2)
+        indices = tile_indices(values[:, 0], values[:, 1])
+        output.write('\n'.join(map(str, indices.tolist())))
+        output.write('\n')
+
+    lines = []
+    for line in input:
+        if line.strip():
+            lines.append(line)
+            if len(lines) >= BATCH_SIZE:
+                flush(lines)
+                lines = []
+    if lines:
+        flush(lines)
+
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    args = sys.argv[2:]
+
+    if command == 'index' and len(args) == 0:
+        print_batch_indices(sys.stdin, sys.stdout)
+
+    elif command == 'bounds' and len(args) > 0:
+        for index in args:
+            print("{} {} {} {}".format(*tile_bounds(index)))
+
+    elif command == 'bbox' and len(args) == 4:
+        for index in tiles_in_bbox(*[float(arg) for arg in args]):
+            print(index)
+
+    elif command == 'bucket' and len(args) in (1, 2,):
+        margin = 0
+        if len(args) == 2 and args[0].startswith('--expand='):
+            margin = int(args.pop(0)[9:])
+        print("{} {} {} {}".format(*expand_bounds(parse_bucket(args[0]), margin)))
+
+    else:
+        print("Usage: {} index < points.txt".format(sys.argv[0]), file=sys.stderr)
+        print("       {} bounds <tile-index> [tile-index...]".format(sys.argv[0]), file=sys.stderr)
+        print("       {} bbox <min-lon> <min-lat> <max-lon> <max-lat>".format(sys.argv[0]), file=sys.stderr)
+        print("       {} bucket [--expand=DEG] <bucket>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
@@ -0,0 +1,176 @@
+""" Unpack downloaded DEM zipfiles straight into bucket directories
+
+Replaces unzipping FABDEM or SRTM-3 downloads into Unpacked/ by hand
+and then running sort-buckets.sh. Each .tif or .hgt member of the
+zipfiles is streamed directly to Unpacked/<bucket>/<name> (the bucket
+comes from the name, as in list-dem.py), so nothing is written twice
+and there's no unsorted copy. Zipfile members are unpacked by a pool
+of worker processes.
+
+A member is skipped if its file already exists with the same size
+and CRC-32, so rerunning after more downloads (or after a failure)
+unpacks only what's new. Each unpacked file is added to the DEM
+catalog (see demcatalog.py).
+
+Members that aren't DEM files (e.g. licence files) are ignored. If
+two zipfiles contain the same DEM file, the first one listed wins.
+
+Usage:
+
+    python3 unpack-dem.py [--processes=N] <unpacked-dir> <zipfile...>
+
+Example:
+
+    python3 unpack-dem.py --processes=8 01-inputs/FABDEM/Unpacked 01-inputs/FABDEM/Downloads/*.zip
+
+"""
+
+import multiprocessing, os, shutil, sys, zipfile, zlib
+
+import demcatalog
+
+from demcatalog import parse_dem_name
+from tiles import get_bucket
+
+
+# Members to unpack in each task for a worker (large zipfiles are split up)
+MEMBERS_PER_TASK = 16
+
+# Bytes to read at a time when checking the CRC of an existing file
+READ_SIZE = 1024 * 1024
+
+
+def get_dest_path(unpacked_dir, member_name):
+    """ Return the path in unpacked_dir for a zipfile member, or None if it isn't a DEM file """
+    name = os.path.basename(member_name)
+    latlon = parse_dem_name(name)
+    if latlon is None:
+        return None
+    (lat, lon,) = latlon
+    return os.path.join(unpacked_dir, get_bucket(lon, lat), name)
+
+
+def file_crc(filename):
+    """ Return the CRC-32 of a file, as stored in zipfiles """
+    crc = 0
+    with open(filename, 'rb') as input:
+        for block in iter(lambda: input.read(READ_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def is_unpacked(dest, info):
+    """ Check whether a zipfile member is already unpacked, with the same size and CRC-32 """
+    try:
+        if os.path.getsize(dest) != info.file_size:
+            return False
+    except FileNotFoundError:
+        return False
+    return file_crc(dest) == info.CRC
+
+
+def make_tasks(zip_filenames, unpacked_dir):
+    """ List the DEM members of the zipfiles, in tasks of up to MEMBERS_PER_TASK from the same zipfile
+    Returns a list of (zip_filename, [(member_name, dest,)...],) tuples
+
+    """
+    tasks = []
+    seen = set()
+    for zip_filename in zip_filenames:
+        with zipfile.ZipFile(zip_filename) as zip:
+            members = []
+            for info in zip.infolist():
+                dest = None if info.is_dir() else get_dest_path(unpacked_dir, info.filename)
+                if dest is not None and dest not in seen:
+                    seen.add(dest)
+                    members.append((info.filename, dest,))
+        for i in range(0, len(members), MEMBERS_PER_TASK):
+            tasks.append((zip_filename, members[i:i+MEMBERS_PER_TASK],))
+    return tasks
+
+
+def unpack_members(task):
+    """ Unpack some members of one zipfile, skipping any already unpacked (runs in a worker process)
+    Returns a tuple (unpacked_paths, skipped_count, errors,)
+
+    """
+    (zip_filename, members,) = task
+    unpacked = []
+    skipped = 0
+    errors = []
+    with zipfile.ZipFile(zip_filename) as zip:
+        for (member_name, dest,) in members:
+            info = zip.getinfo(member_name)
+            if is_unpacked(dest, info):
+                skipped += 1
+                continue
+            tmp_dest = dest + '.tmp'
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # ZipExtFile checks the CRC-32 when the member has been read to the end
+                with zip.open(info) as input, open(tmp_dest, 'wb') as output:
+                    shutil.copyfileobj(input, output, READ_SIZE)
+                os.replace(tmp_dest, dest)
+                unpacked.append(dest)
+            except (OSError, zipfile.BadZipFile) as e:
+                errors.append("{}: {}: {}".format(zip_filename, member_name, e))
+                if os.path.exists(tmp_dest):
+                    os.remove(tmp_dest)
+    return (unpacked, skipped, errors,)
+
+
+def unpack_dems(zip_filenames, unpacked_dir, processes=1):
+    """ Unpack the DEM files in a list of zipfiles into bucket directories, and add them to the catalog
+    Returns a list of error messages (empty if everything worked)
+
+    """
+    tasks = make_tasks(zip_filenames, unpacked_dir)
+    print("{} DEM files in {} zipfiles".format(sum(len(members) for (_, members,) in tasks), len(zip_filenames)))
+
+    total_unpacked = 0
+    total_skipped = 0
+    all_errors = []
+    os.makedirs(unpacked_dir, exist_ok=True)
+    db = demcatalog.open_catalog(unpacked_dir, refresh=False)
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            for (unpacked, skipped, errors,) in pool.imap_unordered(unpack_members, tasks):
+                for path in unpacked:
+                    demcatalog.add_file(db, path)
+                total_unpacked += len(unpacked)
+                total_skipped += skipped
+                all_errors += errors
+    finally:
+        db.close()
+
+    print("Unpacked {} files; {} were already there".format(total_unpacked, total_skipped))
+    return all_errors
+
+
+########################################################################
+# Main entry point
+########################################################################
+
+def usage():
+    print("Usage: {} [--processes=N] <unpacked-dir> <zipfile...>".format(sys.argv[0]), file=sys.stderr)
+    sys.exit(2)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    processes = 1
+    if args and args[0].startswith('--processes='):
+        processes = int(args.pop(0)[12:])
+
+    if len(args) < 2:
+        usage()
+
+    errors = unpack_dems(args[1:], args[0], processes)
+
+    if errors:
+        for error in errors:
+            print(error, file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)